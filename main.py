@@ -14,6 +14,7 @@ from src.core.contructs import Gender, RelationshipType, Mood
 from src.core.training_data import TrainingData
 from src.core.gui.training_data_gui import TrainingDataGui
 from src.core.adapter_manager import AdapterManager
+from src.core.persistence_worker import persistence_worker
 
 
 def check_for_existing_user_profile():
@@ -71,6 +72,7 @@ def load_user_profile():
         print("Invalid input. Please enter a valid number.")
 
     # Load the user's JSON profile data
+    persistence_worker.flush()
     user_profile_path = os.path.join(profiles_dir, username, f"{username}.json")
 
     if not os.path.exists(user_profile_path):
@@ -107,6 +109,9 @@ def load_user_profile():
                     mood=mood,
                     user_profile=user_profile
                 )
+                # Release the copy UserProfile.load_profile already created so the shared weights can be evicted
+                if profile_name in user_profile.ai_profiles:
+                    user_profile.ai_profiles[profile_name].unload_model()
                 user_profile.ai_profiles[profile_name] = ai_profile
             except KeyError as e:
                 print(f"(file: main.py, function: load_user_profile) Error loading AI profile {profile_name}: Missing key {e}")
@@ -199,6 +204,11 @@ def select_or_create_ai_profile(user_profile):
     """
     Prompts the user to either select an existing AI profile or create a new one.
     """
+    # Warm up the likely choice while the user is reading the menu
+    default_profile = user_profile.get_default_profile()
+    if default_profile is not None:
+        default_profile.prefetch_model()
+
     print("Choose an AI profile to chat with:")
     ai_profiles = user_profile.get_ai_profiles()
 
@@ -266,12 +276,15 @@ def run():
                     # Create a new adapter inside the main.py file
                     print("Create a new adapter....")
                     adapter_name = input("Enter the new adapter name: ")
-                    model = ai_profile.model
+                    model = ai_profile.acquire_training_model()  # Training must not change the shared weights
                     new_adapter = ai_profile.adapter_manager.create_new_adapter(adapter_name, model)
                     file_name = input("Enter the name of the training data file: ")
                     training_data = new_adapter.prepare_data(model, file_name)
                     print(type(training_data))
-                    new_adapter.train_adapter(model, training_data)
+                    resume = False
+                    if os.path.exists(new_adapter.get_checkpoint_dir()) and os.listdir(new_adapter.get_checkpoint_dir()):
+                        resume = input("An unfinished training run was found, resume it? (y/n): ").strip().lower() == "y"
+                    new_adapter.train_adapter(model, training_data, resume=resume)
 
                 else:
                     print("Invalid input detected.")
@@ -314,7 +327,12 @@ def train_data_gui(data_file_name):
 
 def main():
     print("AI Local launched...")
-    run()
+    try:
+        run()
+    finally:
+        # Make sure every queued profile and history write is on disk before exiting
+        persistence_worker.stop()
+        persistence_worker.print_stats()
 
 
 if __name__ == '__main__':
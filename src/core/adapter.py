@@ -4,15 +4,24 @@ This class is responsible for creating adapters
 """
 import os
 import json
-import time
 from src.core.paths import t5_adapters_dir, training_data_dir
 from transformers import EncoderDecoderCache
 from src.core.text_dataset import TextDataset, DataLoader
+from src.core.training_data_store import TrainingDataStore
+from src.core.streaming_text_dataset import StreamingTextDataset
+from src.core.pretokenizer import pretokenize, PretokenizedDataset
+from src.core.batching import DynamicPaddingCollator, LengthBucketBatchSampler, RandomBatchSampler, PaddingStats
+from src.core.sequence_packing import PackedDataset, PackedCollator, PackedAttention
+from src.core.training_metrics import TrainingMetrics
+from src.core.training_checkpoint import CheckpointManager, ResumableBatchSampler
+from src.core.training_planner import TrainingPlanner, TrainingPlan
+from src.core.precision import autocast, FP32
+from src.core.encoder_cache import EncoderStateCache, DISK
 import torch
-import torch.nn as nn
+from torch.utils.data import IterableDataset
 from torch.optim import AdamW
 from transformers import T5ForConditionalGeneration, T5Tokenizer
-from peft import LoraConfig, get_peft_model, prepare_model_for_kbit_training
+from peft import LoraConfig, PeftModel, get_peft_model, prepare_model_for_kbit_training
 
 default_lora_config = LoraConfig(
     r=8,  # Rank of the low-rank matrices
@@ -23,6 +32,17 @@ default_lora_config = LoraConfig(
     task_type="SEQ_2_SEQ_LM",  # Task type (sequence-to-sequence language modeling)
 )
 
+# Same adapter with LoRA only in the decoder (self and cross attention), the encoder stays frozen so its
+# hidden states can be cached across epochs (see EncoderStateCache)
+decoder_lora_config = LoraConfig(
+    r=8,
+    target_modules=r"decoder\.block\.\d+\.layer\.\d+\.(SelfAttention|EncDecAttention)\.(q|v)",
+    lora_alpha=16,
+    lora_dropout=0.1,
+    bias='none',
+    task_type="SEQ_2_SEQ_LM",
+)
+
 class Adapter:
     global default_lora_config
     def __init__(self, name=None, lora_config=None):
@@ -40,9 +60,20 @@ class Adapter:
         self.set_full_file_name()
 
 
-    def create_adapter(self, model):
-        model.model = prepare_model_for_kbit_training(model.model)
-        return get_peft_model(model.model, self.lora_config)
+    def create_adapter(self, model, initial_adapter=None, lora_config=None):
+        """
+        :param initial_adapter: Folder of a saved adapter to continue training, instead of a new one.
+        :param lora_config: LoRA config of a new adapter, defaults to self.lora_config.
+        """
+        # Only a quantized model needs the k-bit preparation, on a full precision model it upcasts weights
+        # and enables gradient checkpointing, which the training plan decides instead
+        base_model = model.model
+        if getattr(base_model, "is_loaded_in_8bit", False) or getattr(base_model, "is_loaded_in_4bit", False) \
+                or getattr(base_model, "is_quantized", False):
+            model.model = prepare_model_for_kbit_training(base_model)
+        if initial_adapter is not None:
+            return PeftModel.from_pretrained(model.model, initial_adapter, is_trainable=True)
+        return get_peft_model(model.model, lora_config or self.lora_config)
 
     def set_name(self, name:str):
         if name is None or name.isdigit():
@@ -65,108 +96,287 @@ class Adapter:
         print(f"Request to save adapter at: {self.full_file_name}")
         adapter.save_pretrained(self.full_file_name, safe_serialization=True)  # Save in .safetensors format
 
-    def prepare_data(self, model, filename: str):
-        file_path = os.path.join(training_data_dir, filename)
-        if not os.path.exists(file_path):
-            raise FileNotFoundError(f"File '{filename}' not found in '{training_data_dir}'")
-
-        with open(file_path, 'r', encoding="utf-8") as f:
-            data = json.load(f)
+    def prepare_data(self, model, filename, streaming=False, shuffle_buffer=10000, pretokenized=True,
+                     dynamic_padding=True, packing=False):
+        """
+        Creates the training dataset.
+        :param filename: Training data file name, or a list of file names (shards).
+        :param streaming: Read the entries lazily (StreamingTextDataset) instead of loading them all into memory.
+        :param shuffle_buffer: Size of the shuffle buffer when streaming.
+        :param pretokenized: Tokenize the corpus once into the on-disk token cache and train from it
+                             (PretokenizedDataset), instead of tokenizing every entry in every epoch.
+        :param dynamic_padding: Return unpadded items, train_adapter() then pads each batch only to its longest
+                                sequence and groups items of similar length.
+        :param packing: Pack several short examples into each sequence (PackedDataset), train_adapter() then keeps
+                        the examples from attending to each other. Needs dynamic_padding and no streaming.
+        """
+        filenames = [filename] if isinstance(filename, str) else list(filename)
+        for name in filenames:
+            if not TrainingDataStore(name).exists():
+                raise FileNotFoundError(f"File '{name}' not found in '{training_data_dir}'")
+
+        if packing and (streaming or not dynamic_padding):
+            raise ValueError("Sequence packing needs dynamic_padding=True and streaming=False.")
+        if streaming:
+            return StreamingTextDataset(filenames, model.tokenizer, shuffle_buffer=shuffle_buffer,
+                                        pad_to_max_length=not dynamic_padding)
+        if pretokenized:
+            dataset = PretokenizedDataset(pretokenize(filenames, model.tokenizer), pad_to_max_length=not dynamic_padding)
+            return PackedDataset(dataset) if packing else dataset
+
+        data = [entry for name in filenames for entry in TrainingDataStore(name).iter_entries()]
 
         # Create dataset
-        dataset = TextDataset(data, model.tokenizer)
-        return dataset
-
-    def train_adapter(self, model, training_data, epochs=3):
-        # Clear GPU Cache
-        torch.cuda.empty_cache()
-
-        # Enable gradient checkpointing
-        model.model.gradient_checkpointing_enable()
+        dataset = TextDataset(data, model.tokenizer, pad_to_max_length=not dynamic_padding)
+        return PackedDataset(dataset) if packing else dataset
+
+    @staticmethod
+    def get_collate_fn(model, training_data):
+        """
+        Returns the collate function for the dataset, None for datasets padded to max_length.
+        """
+        if isinstance(training_data, PackedDataset):
+            return PackedCollator(model.tokenizer.pad_token_id)
+        if not getattr(training_data, "pad_to_max_length", True):
+            return DynamicPaddingCollator(model.tokenizer.pad_token_id, training_data.max_length)
+        return None
+
+    def make_dataloader(self, model, training_data, batch_size=2, num_workers=8, bucket_size_multiplier=50, seed=0,
+                        record_batches=False, batch_sampler_wrapper=None):
+        """
+        Creates the DataLoader of a training dataset. Unpadded datasets (see prepare_data(dynamic_padding=True)) are
+        padded per batch, and unless streamed their items are grouped by length.
+        The batch order of a map-style dataset only depends on the seed and the epoch, so training can be resumed.
+        :param record_batches: Let the batch sampler tell which dataset indices each batch holds.
+        :param batch_sampler_wrapper: Callable wrapping the epoch's batch sampler (e.g. to take one process's share).
+        :return: (dataloader, batch_sampler), batch_sampler is None for a streaming dataset, which shuffles
+                 through its own buffer.
+        """
+        collate_fn = self.get_collate_fn(model, training_data)
+
+        if isinstance(training_data, IterableDataset):
+            loader_kwargs = {"batch_size": batch_size}
+            batch_sampler = None
+        else:
+            if collate_fn is not None and not isinstance(training_data, PackedDataset):
+                input_lengths, label_lengths = training_data.lengths()
+                sampler = LengthBucketBatchSampler(
+                    [i + l for i, l in zip(input_lengths, label_lengths)], batch_size, bucket_size_multiplier, seed=seed)
+            else:
+                sampler = RandomBatchSampler(len(training_data), batch_size, seed=seed)
+            if batch_sampler_wrapper is not None:
+                sampler = batch_sampler_wrapper(sampler)
+            batch_sampler = ResumableBatchSampler(sampler, record_batches=record_batches)
+            loader_kwargs = {"batch_sampler": batch_sampler}
+        if collate_fn is not None:
+            loader_kwargs["collate_fn"] = collate_fn
 
-        # Create DataLoader
         dataloader = DataLoader(
             training_data,
-            batch_size=2,  # Reduced batch size
-            shuffle=True,
-            num_workers=8,
+            num_workers=num_workers,
             pin_memory=True,
+            **loader_kwargs,
         )
+        return dataloader, batch_sampler
+
+    def get_checkpoint_dir(self):
+        return os.path.join(self.adapter_dir, f"{self.name}.checkpoints")
+
+    def train_adapter(self, model, training_data, epochs=3, report_every=50, report_interval=30.0, debug=False,
+                      resume=False, checkpoint_every=100, checkpoint_interval=600.0, keep_checkpoints=3, seed=0,
+                      plan=None, memory_budget=None, precision=FP32, decoder_only=False, encoder_cache=DISK,
+                      batch_sampler_wrapper=None, before_optimizer_step=None, is_main_process=True, save=True,
+                      initial_adapter=None, on_adapter_created=None):
+        """
+        Trains a new LoRA adapter on the training data and saves it.
+        :param report_every: Print the average loss every this many batches.
+        :param report_interval: Also print it when this many seconds passed since the last report.
+        :param debug: Scan parameters, logits and labels for nan/inf values (slow, syncs on every batch).
+        :param resume: Continue from the newest checkpoint of this adapter, if there is one.
+        :param checkpoint_every: Save a checkpoint every this many optimizer steps, 0 disables it.
+        :param checkpoint_interval: Also save one when this many seconds passed since the last one, 0 disables it.
+        :param keep_checkpoints: Number of checkpoints kept on disk.
+        :param seed: Seed of the batch order, must be the same when resuming.
+        :param plan: TrainingPlan to train with. By default a TrainingPlanner chooses one within memory_budget.
+        :param memory_budget: Maximum memory of the training process in bytes for the planner (see TrainingPlanner).
+        :param precision: "fp32", or "bf16" to run the forward pass under bfloat16 autocast (see precision.py).
+        :param decoder_only: Train LoRA in the decoder only (decoder_lora_config). The frozen encoder then runs once
+                             per example, its hidden states are cached and reused in the later epochs.
+        :param encoder_cache: Where the encoder states are kept in decoder_only mode, "memory" or "disk".
+        :param batch_sampler_wrapper: See make_dataloader(), used by data-parallel training to shard the batches.
+        :param before_optimizer_step: Callable(adapter) run before every optimizer step, e.g. to all-reduce the
+                                      gradients of data-parallel processes.
+        :param on_adapter_created: Callable(adapter) run once the adapter is created and on its device, e.g. to
+                                   broadcast the initial LoRA weights of data-parallel processes.
+        :param is_main_process: Only the main process writes checkpoints and the adapter.
+        :param save: Save the trained adapter at the end.
+        :param initial_adapter: Folder of a saved adapter to keep training (see create_adapter()), its LoRA config
+                                is used instead of self.lora_config.
+        """
+        if getattr(model, "registry_key", None) is not None:
+            raise ValueError("Training changes the weights it runs on, it needs a model with private weights "
+                             "(model_registry.acquire(..., exclusive=True)), not the weights shared by the profiles.")
+
+        # Clear GPU Cache
+        torch.cuda.empty_cache()
+        autocast(device=model.device, precision=precision)  # Rejects an unknown precision before any work is done
 
         # Create adapter
-        adapter = self.create_adapter(model)
+        streaming = isinstance(training_data, IterableDataset)
+        if streaming and batch_sampler_wrapper is not None:
+            raise ValueError("A streaming dataset has no batch sampler to wrap.")
+        if decoder_only and streaming:
+            raise ValueError("decoder_only training caches encoder states per example and cannot stream.")
+        lora_config = decoder_lora_config if decoder_only else self.lora_config
+        adapter = self.create_adapter(model, initial_adapter=initial_adapter, lora_config=lora_config)
         device = model.device
         model.model.to(device)
         adapter.to(device)
+        if on_adapter_created is not None:
+            on_adapter_created(adapter)
 
         # Debugging: Check model parameters
-        for name, param in adapter.named_parameters():
-            if torch.isnan(param).any() or torch.isinf(param).any():
-                print(f"Parameter {name} contains nan or inf values!")
+        if debug:
+            for name, param in adapter.named_parameters():
+                if not torch.isfinite(param).all():
+                    print(f"Parameter {name} contains nan or inf values!")
 
-        # Set up optimizer and loss function
+        # Set up optimizer
         optimizer = AdamW([p for p in adapter.parameters() if p.requires_grad], lr=1e-5)  # Reduced learning rate
-        loss_fn = nn.CrossEntropyLoss(ignore_index=-100)
+        metrics = TrainingMetrics(report_every=report_every, report_interval=report_interval, debug=debug)
+
+        # Restore the last checkpoint, a resumed run keeps the plan it was started with
+        checkpoints = CheckpointManager(self.get_checkpoint_dir(), keep_last=keep_checkpoints,
+                                        save_every=checkpoint_every, save_interval=checkpoint_interval)
+        start_epoch, start_batch, global_step = 0, 0, 0
+        state = checkpoints.load(adapter, optimizer) if resume else None
+        if state is not None:
+            start_epoch, start_batch, global_step = state["epoch"], state["batch"], state["global_step"]
+            if "plan" in state.get("extra", {}):
+                plan = TrainingPlan(**state["extra"]["plan"])
+
+        # Choose batch size, gradient accumulation, gradient checkpointing and workers
+        if plan is None:
+            planner = TrainingPlanner(memory_budget=memory_budget)
+            plan = planner.plan(model, adapter, training_data, self.get_collate_fn(model, training_data),
+                                forward_context=lambda: autocast(device, precision))
+        TrainingPlanner.set_gradient_checkpointing(model, plan.gradient_checkpointing)
+        print(plan.describe())
+
+        # Create DataLoader
+        dataloader, batch_sampler = self.make_dataloader(model, training_data, batch_size=plan.batch_size,
+                                                         num_workers=plan.num_workers, seed=seed,
+                                                         record_batches=decoder_only,
+                                                         batch_sampler_wrapper=batch_sampler_wrapper)
+        encoder_states = None
+        if decoder_only:
+            encoder_states = EncoderStateCache(
+                model.model.config.d_model, mode=encoder_cache,
+                disk_file=os.path.join(self.get_checkpoint_dir(), f"encoder_states.{os.getpid()}.bin"))
+        batches_per_epoch = None if streaming else len(batch_sampler.batch_sampler)
+        if state is not None and state["batches_per_epoch"] not in (None, batches_per_epoch):
+            print(f"Warning: the checkpoint was made with {state['batches_per_epoch']} batches per epoch, "
+                  f"the training data now has {batches_per_epoch}.")
+        padding_stats = PaddingStats(model.tokenizer.pad_token_id)
+        packed_attention = PackedAttention(adapter) if isinstance(training_data, PackedDataset) else None
+        checkpoint_extra = {"plan": {
+            "batch_size": plan.batch_size,
+            "gradient_accumulation_steps": plan.gradient_accumulation_steps,
+            "gradient_checkpointing": plan.gradient_checkpointing,
+            "num_workers": plan.num_workers,
+        }}
 
         # Gradient accumulation steps
-        gradient_accumulation_steps = 4
+        gradient_accumulation_steps = plan.gradient_accumulation_steps
 
-        for epoch in range(epochs):
+        for epoch in range(start_epoch, epochs):
             model.train()
             adapter.train()
-            total_loss = 0
-            epoch_start_time = time.time()
-
-            for batch_idx, batch in enumerate(dataloader):
-                batch_start_time = time.time()
+            metrics.start_epoch(epoch)
+            first_batch = start_batch if epoch == start_epoch else 0
+            if streaming:
+                training_data.set_epoch(epoch)
+                batches = iter(dataloader)
+                # A stream cannot seek, the batches trained before the checkpoint are read and dropped
+                for _ in range(first_batch):
+                    next(batches, None)
+            else:
+                batch_sampler.set_epoch(epoch, first_batch)
+                batches = iter(dataloader)
+            padding_stats.reset()
+
+            batch_idx = first_batch - 1
+            for batch_idx, batch in enumerate(batches, start=first_batch):
+                padding_stats.update(batch)
 
                 # Move batch to GPU
                 input_ids = batch["input_ids"].to(device)
                 attention_mask = batch["attention_mask"].to(device)
                 labels = batch["labels"].to(device)
                 decoder_input_ids = batch["decoder_input_ids"].to(device)
-
-                # Forward pass
-                outputs = adapter(
-                    input_ids=input_ids,
-                    attention_mask=attention_mask,
-                    labels=labels,
-                    decoder_input_ids=decoder_input_ids,
-                )
-                logits = outputs.logits
-                logits = logits.view(-1, logits.size(-1))
-                labels = labels.view(-1)
-
-                # Debugging: Check model outputs
-                if torch.isnan(logits).any() or torch.isinf(logits).any():
-                    print("Model outputs (logits) contain nan or inf values!")
-                if torch.isnan(labels).any() or torch.isinf(labels).any():
-                    print("Labels contain nan or inf values!")
-
-                loss = loss_fn(logits, labels)
-                loss = loss / gradient_accumulation_steps  # Normalize loss
-
-                # Backward pass
-                loss.backward()
+                if packed_attention is not None:
+                    packed_attention.set_segments(batch["encoder_segment_ids"].to(device),
+                                                  batch["decoder_segment_ids"].to(device))
+
+                # Forward pass, the model computes the cross entropy loss (ignoring -100 labels) itself
+                if encoder_states is not None:
+                    encoder_outputs = encoder_states.encoder_outputs(
+                        adapter.get_encoder(), batch_sampler.next_batch_indices(), input_ids, attention_mask,
+                        forward_context=lambda: autocast(device, precision))
+                    with autocast(device, precision):
+                        outputs = adapter(
+                            attention_mask=attention_mask,
+                            encoder_outputs=encoder_outputs,
+                            labels=labels,
+                            decoder_input_ids=decoder_input_ids,
+                        )
+                else:
+                    with autocast(device, precision):
+                        outputs = adapter(
+                            input_ids=input_ids,
+                            attention_mask=attention_mask,
+                            labels=labels,
+                            decoder_input_ids=decoder_input_ids,
+                        )
+                metrics.update(outputs.loss, outputs.logits, labels)
+
+                # Backward pass, normalized over the accumulated batches
+                (outputs.loss / gradient_accumulation_steps).backward()
 
                 # Accumulate gradients
                 if (batch_idx + 1) % gradient_accumulation_steps == 0:
+                    if before_optimizer_step is not None:
+                        before_optimizer_step(adapter)
                     optimizer.step()
                     optimizer.zero_grad()
-
-                total_loss += loss.item()
-
-                # Calculate time taken for the batch
-                batch_time = time.time() - batch_start_time
-
-                # Print loss and time for each batch
-                print(
-                    f"Epoch {epoch + 1}, Batch {batch_idx + 1}, Loss: {loss.item() * gradient_accumulation_steps}, Time: {batch_time:.2f} seconds")
-
-            # Calculate time taken for the epoch
-            epoch_time = time.time() - epoch_start_time
-
-            # Print average loss and time for the epoch
-            print(f"Epoch {epoch + 1}, Average Loss: {total_loss / len(dataloader)}, Time: {epoch_time:.2f} seconds")
-
-        self.save_adapter(adapter)
\ No newline at end of file
+                    global_step += 1
+                    if is_main_process and checkpoints.save_due(global_step):
+                        checkpoints.save(adapter, optimizer, epoch, batch_idx + 1, global_step, batches_per_epoch,
+                                         checkpoint_extra)
+
+            # Apply the gradients left over from the last batches, so every checkpoint is at a step boundary
+            if batch_idx >= first_batch and (batch_idx + 1) % gradient_accumulation_steps != 0:
+                if before_optimizer_step is not None:
+                    before_optimizer_step(adapter)
+                optimizer.step()
+                optimizer.zero_grad()
+                global_step += 1
+
+            metrics.end_epoch()
+            if encoder_states is not None:
+                stats = encoder_states.get_stats()
+                print(f"Epoch {epoch + 1}, Encoder state cache: {stats['entries']} examples, "
+                      f"hit rate {stats['hit_rate']:.1%}")
+            print(f"Epoch {epoch + 1}, Padding: {padding_stats.padding_ratio():.1%} of {padding_stats.total_tokens} tokens")
+            if is_main_process and epoch + 1 < epochs:
+                checkpoints.save(adapter, optimizer, epoch + 1, 0, global_step, batches_per_epoch, checkpoint_extra)
+
+        if packed_attention is not None:
+            packed_attention.remove()
+        if encoder_states is not None:
+            encoder_states.close()
+        if is_main_process:
+            if save:
+                self.save_adapter(adapter)
+            checkpoints.clear()
+        return adapter
@@ -9,6 +9,7 @@ from peft import get_peft_model
 
 from src.core.adapter import Adapter, default_lora_config
 from src.core.paths import t5_adapters_dir
+from src.core.multi_adapter_training import train_adapters
 import torch
 import peft
 class AdapterManager:
@@ -22,6 +23,18 @@ class AdapterManager:
         print(f"Creating new adapter: {new_adapter.name}, file path: {new_adapter.full_file_name}")
         return new_adapter
 
+    def train_new_adapters(self, model, training_files, epochs=3):
+        """
+        Creates and trains several adapters in one pass over the shared base model (see multi_adapter_training.py).
+        :param training_files: Dictionary of adapter name -> training data file name.
+        """
+        jobs = []
+        for adapter_name, file_name in training_files.items():
+            new_adapter = self.create_new_adapter(adapter_name, model)
+            jobs.append((new_adapter, new_adapter.prepare_data(model, file_name)))
+        train_adapters(model, jobs, epochs=epochs)
+        return [adapter for adapter, _ in jobs]
+
     def load_adapter(self, model, adapter_name:str, category:str=None):
         if adapter_name is None or adapter_name.isdigit():
             return False
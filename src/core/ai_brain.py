@@ -4,9 +4,16 @@ This class is responsible for giving more of a personality to the AiProfile
 """
 
 import re
+import time
+from collections import deque
+from contextlib import contextmanager
+
 from src.core.ai_cortex import AiCortex
 from src.core.short_term_memory import ShortTermMemory
 from src.core.long_term_memory import LongTermMemory
+from src.core.context_assembler import ContextAssembler
+from src.core.persistence_worker import persistence_worker
+from src.core.generation_policy import default_generation_policy
 
 class AiBrain:
     def __init__(self, ai_profile=None):
@@ -15,6 +22,10 @@ class AiBrain:
         self.short_term_memory = ShortTermMemory()
         self.long_term_memory = LongTermMemory()
         self.cortex = None
+        self.context_assembler = ContextAssembler(ai_profile.model) if ai_profile else None
+        self.last_tone = None
+        self.last_turn_timings = {}
+        self.turn_timings = deque(maxlen=1000)  # Timings of the most recent turns
 
     def initialize_cortex(self):
         self.cortex = AiCortex(self)
@@ -45,27 +56,81 @@ class AiBrain:
     def adjust_mood(self):
         self.ai_profile.mood = self.cortex.adjust_mood(self.ai_profile.mood)
 
-    def process_input(self, user_input):
-        self.update_memory(user_input)
+    def process_input(self, user_input, on_text=None):
+        """
+        Runs one turn through the pipeline: infer tone, build context, generate once, post-process, then record
+        the exchange in the profile history, both memories and the context history.
+        The wall-clock time of every stage is kept in self.last_turn_timings (and self.turn_timings for all turns).
+        :param on_text: Optional callback receiving the response text as it is streamed.
+        :return: The response, empty if the model could not produce one (nothing is recorded then).
+        :raises ValueError: If the message does not fit in the model's input.
+        """
+        timings = {}
+        self.last_turn_timings = timings
+        self.turn_timings.append(timings)
+        with self.timed_stage(timings, "infer_tone"):
+            self.last_tone = self.infer_tone(user_input)
+        with self.timed_stage(timings, "build_context"):
+            context = self.build_context(user_input)
+        with self.timed_stage(timings, "generate"):
+            response = self.generate_once(user_input, context, on_text)
+        with self.timed_stage(timings, "post_process"):
+            response = self.post_process_response(response)
+        if response:
+            with self.timed_stage(timings, "fan_out"):
+                self.record_turn(user_input, response)
+        timings["total"] = sum(timings.values())
+        return response
+
+    @staticmethod
+    @contextmanager
+    def timed_stage(timings, stage):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            timings[stage] = time.perf_counter() - start_time
 
-    def update_memory(self, user_input):
-       self.update_short_term_memory(user_input)
-       self.update_long_term_memory(user_input)
+    def generate_once(self, user_input, context, on_text=None):
+        """
+        Generates the single response of a turn, streamed if on_text is given.
+        Falls back to the retrying, non-streamed generation if streaming produced nothing. The stream decodes
+        greedily, so the fallback starts at the next strategy instead of repeating the same greedy attempt.
+        """
+        response = ""
+        policy = None
+        if on_text is not None:
+            response = self.generate_response_stream(user_input, context, on_text, post_process=False)
+            policy = default_generation_policy.without_first_attempt()
+        if not response:
+            response = self.generate_response(user_input, context, post_process=False, policy=policy)
+            if response and on_text is not None:
+                on_text(response)
+        return response
 
-    def update_short_term_memory(self, user_input):
-        self.short_term_memory.add_message(
-            f"{self.ai_profile.user_profile.user_name}", user_input
+    def record_turn(self, user_input, response):
+        """
+        Fans a finished exchange out to the profile history, both memories and the context history.
+        """
+        self.ai_profile.add_to_history(user_input, response)
+        timestamp = self.ai_profile.history[-1]['timestamp']
+        self.update_memory(user_input, response, timestamp)
+        self.ai_profile.add_to_context_history(user_input, response, timestamp)
+
+    def update_memory(self, user_input, response, timestamp=None):
+        self.update_short_term_memory(user_input, response, timestamp)
+        self.update_long_term_memory(user_input, response, timestamp)
+
+    def update_short_term_memory(self, user_input, response, timestamp=None):
+        self.short_term_memory.add_message_block(
+            self.ai_profile.get_user_profile_name(), user_input, self.ai_profile.name, response, timestamp
         )
-        response = self.ai_profile.model.generate_response(user_input)
-        self.short_term_memory.add_message(f"{self.ai_profile.name}", response)
         return response
 
-    def update_long_term_memory(self, user_input):
-        self.long_term_memory.add_message(
-            f"{self.ai_profile.user_profile.user_name}", user_input
+    def update_long_term_memory(self, user_input, response, timestamp=None):
+        self.long_term_memory.add_message_block(
+            self.ai_profile.get_user_profile_name(), user_input, self.ai_profile.name, response, timestamp
         )
-        response = self.ai_profile.model.generate_response(user_input)
-        self.long_term_memory.add_message(f"{self.ai_profile.name}", response)
         return response
 
     def chat(self):
@@ -74,52 +139,113 @@ class AiBrain:
         This method can be customized based on the profile's context (name, relationship type, mood).
         """
         print(f"You are now chatting with {self.ai_profile.name} (Type 'exit' to quit).")
-        user_name = self.ai_profile.get_user_profile_name()
-        ai_name = self.ai_profile.name
         while True:
             user_input = input("You: ")
             if user_input.lower() == 'exit':
                 print("Ending conversation...")
+                persistence_worker.flush()
+                persistence_worker.print_stats()
                 break
 
-            context = self.build_context(user_input)
-            model_response = self.generate_response(user_input, context)
+            print(f"{self.ai_profile.name}: ", end="", flush=True)
+            try:
+                model_response = self.process_input(user_input, on_text=lambda text: print(text, end="", flush=True))
+            except ValueError as e:
+                print(f"\n{e}")
+                continue
+            print()
+            if not model_response:
+                print(f"{self.ai_profile.name} could not come up with a reply, please try again.")
+                continue
 
             # Debugging
             print(f"DEBUG: Model response received: {model_response}")
-
-            print(f"{self.ai_profile.name}: {model_response}")
-            self.ai_profile.add_to_history(user_input, model_response)
-            latest_entry = self.ai_profile.history[-1]
-            print(f"Latest Entry in ai_profile.history:\n{latest_entry}")
-            self.short_term_memory.add_message_block(latest_entry[user_name],user_input, ai_name, model_response, latest_entry['timestamp'] )
-            self.long_term_memory.add_message_block(latest_entry[user_name],user_input, ai_name, model_response, latest_entry['timestamp'] )
-            self.ai_profile.add_to_context_history(latest_entry[user_name], model_response, latest_entry['timestamp'])
+            metrics = self.ai_profile.model.last_generation_metrics
+            if metrics.get("cached"):
+                print(f"DEBUG: Response served from cache {self.ai_profile.model.response_cache.get_stats()}")
+            if metrics.get("time_to_first_token") is not None:
+                print(f"DEBUG: Time to first token: {metrics['time_to_first_token']:.2f}s, total: {metrics['total_time']:.2f}s")
+            if metrics.get("stop_reason"):
+                print(f"DEBUG: Turn ended on {metrics['stop_reason']} after {metrics['generated_tokens']} tokens, "
+                      f"{metrics['tokens_saved']} tokens saved")
+            print("DEBUG: Turn timings: " + ", ".join(f"{stage}={seconds:.3f}s" for stage, seconds in self.last_turn_timings.items()))
+            print(f"Latest Entry in ai_profile.history:\n{self.ai_profile.history[-1]}")
             print(f"Latest Entry in Context history:\n{self.ai_profile.get_context().history[-1]}")
 
     def build_context(self, user_input):
         user_name = self.ai_profile.get_user_profile_name()
         ai_name = self.ai_profile.get_name()
-        inferred_tone = self.infer_tone(user_input)
-        context = self.ai_profile.get_context().generate_context_string()
-
-        history_context = "\n".join(
-            [
-                f"{entry.get(user_name)}\n{self.ai_profile.name}: {entry[ai_name]}" for entry in self.short_term_memory.conversation_history[-10:]]
+        context = self.ai_profile.get_context()
+        fingerprint = self.ai_profile.get_context_fingerprint()
+        if self.context_assembler.token_cache.check_fingerprint(fingerprint):
+            context.refresh()  # Name, mood or relationship changed, rebuild the persona text
+        system_prompt = context.get_system_prompt()
+
+        history_turns = [
+            f"{user_name}: {entry[user_name]}\n{ai_name}: {entry[ai_name]}"
+            for entry in self.short_term_memory.conversation_history
+            if user_name in entry and ai_name in entry
+        ]
+
+        # The user's message itself is part of the model's prompt template, the assembler keeps room for it
+        assembled = self.context_assembler.assemble(
+            system_prompt,
+            history_turns,
+            user_input,
+            instruction="\nRespond naturally and engagingly in conversational tone that is inline with your mood",
         )
-
-        if history_context:
-            context += "\nHere is your recent conversation history:\n" + history_context
-        context += f"\n{user_name}: {user_input}\nRespond naturally and engagingly in conversational tone that is inline with your mood"
         # Debugging
-        print(f"DEBUG: Context being sent to model:\n{context}")
-        return context
+        print(f"DEBUG: Context being sent to model ({assembled}):\n{assembled.text}")
+        return assembled
 
-    def generate_response(self, user_input, context):
+    def generate_response(self, user_input, context, post_process=True, policy=None):
+        """
+        :param context: AssembledContext returned by build_context().
+        :param post_process: Apply post_process_response(), process_input() does it in a stage of its own.
+        :param policy: GenerationPolicy of the model's retries, defaults to default_generation_policy.
+        """
         # Generate response using the model or a more advanced technique
+        response = self.ai_profile.model.generate_response(user_input, context.text, input_ids=context.input_ids,
+                                                           policy=policy)
+        if post_process:
+            response = self.post_process_response(response)
+        print(f"DEBUG: Model response received (repr): {repr(response)}")
+        return response
+
+    def generate_response_stream(self, user_input, context, on_text=None, post_process=True):
+        """
+        Generates a response while passing the text to on_text as it arrives.
+        A leading "name:" prefix is held back until it can be told apart from the reply and is never shown.
+        :param context: AssembledContext returned by build_context().
+        :param post_process: Apply post_process_response(), process_input() does it in a stage of its own.
+        :return: The complete response after the same cleanup generate_response() applies.
+        """
+        model = self.ai_profile.model
+        prefixes = [f"{self.ai_profile.name}:", f"{self.ai_profile.get_user_profile_name()}:"]
+        raw_response = ""
+        shown = 0
+        prefix_checked = False
+        for text in model.generate_response_stream(user_input, context.text, input_ids=context.input_ids):
+            raw_response += text
+            if not prefix_checked:
+                pending = raw_response.lstrip()
+                if any(prefix.startswith(pending) for prefix in prefixes):
+                    continue  # Could still turn out to be a name prefix
+                match = re.match(rf"^\s*({'|'.join(re.escape(prefix) for prefix in prefixes)})\s*", raw_response)
+                shown = match.end() if match else len(raw_response) - len(pending)
+                prefix_checked = True
+            if on_text is not None and len(raw_response) > shown:
+                on_text(re.sub(r"\n+", " ", raw_response[shown:]))
+            shown = len(raw_response)
+        if not prefix_checked and on_text is not None:
+            # The stream ended while the text could still have been a name prefix, it is the whole (short) reply
+            pending = raw_response.strip()
+            if pending and pending not in prefixes:
+                on_text(re.sub(r"\n+", " ", pending))
+        response = model.clean_response(raw_response)
+        return self.post_process_response(response) if post_process else response
+
+    def post_process_response(self, response):
         user_name = self.ai_profile.user_profile.user_name
-        response = self.ai_profile.model.generate_response(user_input, context)
         # Remove unintended echoes of the user's name
-        response = re.sub(rf"\b{re.escape(user_name)}:\s*", "", response).strip()
-        print(f"DEBUG: Model response received (repr): {repr(response)}")
-        return response
\ No newline at end of file
+        return re.sub(rf"\b{re.escape(user_name)}:\s*", "", response).strip()
\ No newline at end of file
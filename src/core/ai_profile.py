@@ -10,7 +10,12 @@ from datetime import datetime
 from src.core.adapter_manager import AdapterManager
 from src.core.contructs import Gender, RelationshipType, Mood
 from src.core.paths import profiles_dir, t5_dir
-from src.core.t5_model import T5Model
+from src.core.model_registry import model_registry
+from src.core.lazy_model import LazyModel
+from src.core.response_cache import ResponseCache
+from src.core.conversation_log import ConversationLog
+from src.core.continual_trainer import ContinualTrainer
+from src.core.persistence_worker import persistence_worker
 from src.core.ai_brain import AiBrain
 from src.core.context import Context
 
@@ -28,7 +33,7 @@ class AiProfile:
         self.mood = mood
         self.history = history if history else []
         self.user_profile = user_profile  # Reference to the UserProfile this AI profile belongs to
-        self.model = self.load_model()
+        self.model = LazyModel(self.load_model)  # Loaded on first use, see prefetch_model()
         self.brain = None
         self.context = None
         self.adapter_manager =AdapterManager()
@@ -39,16 +44,42 @@ class AiProfile:
         if not os.path.exists(self.profile_folder):
             os.makedirs(self.profile_folder)
             print(f"Created new profile folder for {self.name} at {self.profile_folder}")
+        self.conversation_log = ConversationLog(self.profile_folder)
+        self.continual_trainer = ContinualTrainer(self)  # Fine-tunes the profile's adapter on new turns
 
         # Load the profile data if available
         self.load_profile()
 
     def load_model(self):
         if self.model_name == "T5":
-            model = T5Model(model_dir=t5_dir, ai_profile_name=self.name, user_profile_name=self.user_profile.user_name)
+            model = model_registry.acquire("T5", t5_dir, ai_profile_name=self.name, user_profile_name=self.user_profile.user_name)
+            model.response_cache = ResponseCache(disk_dir=os.path.join(self.profile_folder, "response_cache"))
             model.check_for_cuda()
+            self.continual_trainer.loaded_version = None  # A new wrapper has no profile adapter yet
+            self.continual_trainer.load_into(model)
             return model
 
+    def acquire_training_model(self):
+        """
+        Returns a T5 wrapper with its own copy of the weights to train adapters on. Training injects LoRA layers and
+        switches the weights to train mode, on the shared weights every other profile would generate through them.
+        """
+        return model_registry.acquire("T5", t5_dir, exclusive=True, ai_profile_name=self.name,
+                                      user_profile_name=self.user_profile.user_name)
+
+    def prefetch_model(self):
+        """
+        Starts loading the model in the background so it is warm by the time the chat starts.
+        """
+        self.model.prefetch()
+
+    def unload_model(self):
+        """
+        Hands the model back to the shared registry, the weights stay resident while other profiles use them.
+        """
+        if self.model.is_loaded():
+            model_registry.release(self.model.reset())
+
     def initialize_brain_and_cortex(self):
         self.brain = AiBrain(self)
         self.brain.initialize_cortex()
@@ -59,9 +90,9 @@ class AiProfile:
         Loads the profile data (name, relationship_type, mood, and conversation history)
         from the profile folder if the files exist.
         """
+        persistence_worker.flush()  # Read what earlier saves queued
         try:
             profile_file = os.path.join(self.profile_folder, "profile_data.json")
-            history_file = os.path.join(self.profile_folder, "conversation_history.json")
 
             # Load profile data if the file exists
             if os.path.exists(profile_file):
@@ -76,10 +107,10 @@ class AiProfile:
                     mood_str = profile_data.get('mood', self.mood.name)
                     self.mood = Mood[mood_str.upper()]
 
-            # Load conversation history if the file exists
-            if os.path.exists(history_file):
-                with open(history_file, 'r') as f:
-                    self.history = json.load(f)
+            # Load conversation history, converting the old single JSON file on first run
+            self.conversation_log.migrate()
+            if os.path.exists(self.conversation_log.log_file):
+                self.history = self.conversation_log.read_all()
         except Exception as e:
             print(f"(file: ai_profile.py, method: load_profile) Error loading profile data: {e}")
 
@@ -99,8 +130,8 @@ class AiProfile:
 
             profile_file = os.path.join(self.profile_folder, "profile_data.json")
 
-            with open(profile_file, "w") as f:
-                json.dump(profile_data, f, indent=4)
+            # Written atomically in the background by the persistence worker
+            persistence_worker.write_json(profile_file, profile_data)
 
             print(f"Profile saved for {self.name}.")
         except Exception as e:
@@ -112,28 +143,49 @@ class AiProfile:
         """
         timestamp = datetime.now()
         user_name = self.user_profile.user_name
-        self.history.append({
+        entry = {
             f'timestamp': timestamp.isoformat(),
             f'{user_name}': user_input,
             f'{self.name}': model_response
-        })
+        }
+        self.history.append(entry)
+
+        # Append the turn to the conversation log (conversation_history.jsonl)
+        try:
+            self.conversation_log.append(entry)
+        except Exception as e:
+            print(f"Error saving conversation history: {e}")
 
-        # Save history to a separate file (conversation_history.json)
-        self.save_conversation_history()
+        # Swap in a freshly trained adapter, or start training one in the background
+        if self.model_name == "T5":
+            try:
+                self.continual_trainer.on_new_turn()
+            except Exception as e:
+                print(f"(file: ai_profile.py, method: add_to_history) Error in background adapter training: {e}")
 
     def save_conversation_history(self):
         """
-        Saves the conversation history to a separate JSON file.
+        Rewrites the whole conversation log from self.history, add_to_history() only appends the new turn.
         """
         try:
-            history_file = os.path.join(self.profile_folder, "conversation_history.json")
-            with open(history_file, "w") as f:
-                json.dump(self.history, f, indent=4)
-
+            self.conversation_log.rewrite(self.history)
             print(f"Conversation history saved for {self.name}.")
         except Exception as e:
             print(f"Error saving conversation history: {e}")
 
+    def get_recent_history(self, count):
+        """
+        Returns the last 'count' turns, read from the end of the conversation log.
+        """
+        return self.conversation_log.tail(count)
+
+    def compact_conversation_history(self, keep_last=None):
+        """
+        Compacts the conversation log, see ConversationLog.compact().
+        """
+        remaining = self.conversation_log.compact(keep_last)
+        self.history = self.history[-remaining:] if remaining else []
+
     def update_profile(self, name=None, relationship_type=None, mood=None):
         """
         Updates the user's profile details (name, relationship_type, mood).
@@ -144,6 +196,8 @@ class AiProfile:
             self.relationship_type = relationship_type
         if mood:
             self.mood = mood
+        if self.context:
+            self.context.refresh()
         self.save_profile()  # Save profile after updating
 
     def get_profile_summary(self):
@@ -168,6 +222,7 @@ class AiProfile:
         Clears the conversation history.
         """
         self.history = []
+        self.conversation_log.clear()
         self.save_profile()  # Save profile after clearing history
 
     def get_conversation_history(self):
@@ -204,6 +259,12 @@ class AiProfile:
     def get_context(self):
         return self.context
 
+    def get_context_fingerprint(self):
+        """
+        Returns the profile state the context is built from, cached context tokens are only valid for the same value.
+        """
+        return self.name, self.get_user_profile_name(), self.gender, self.relationship_type, self.mood
+
     def add_to_context_history(self, user_message, ai_message, timestamp=None):
         self.context.add_to_history(user_message, ai_message, timestamp)
 
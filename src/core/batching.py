@@ -0,0 +1,164 @@
+# src/core/batching.py
+"""
+This file is responsible for building training batches with as little padding as possible.
+DynamicPaddingCollator pads every batch only to its own longest sequence instead of max_length, and
+LengthBucketBatchSampler puts examples of similar length in the same batch, so few pad tokens are left to compute.
+"""
+import random
+
+import torch
+from torch.utils.data import Sampler
+
+LABEL_PAD_ID = -100  # Ignored by the loss
+
+
+class DynamicPaddingCollator:
+    def __init__(self, pad_token_id, max_length=512):
+        """
+        Pads a list of unpadded examples (input_ids, attention_mask, labels) into a batch.
+        :param pad_token_id: Pad id of the tokenizer, used for input_ids and decoder_input_ids.
+        :param max_length: Maximum sequence length of the dataset.
+        """
+        self.pad_token_id = pad_token_id
+        self.max_length = max_length
+
+    @staticmethod
+    def pad_stack(sequences, length, value):
+        return torch.stack([
+            torch.nn.functional.pad(sequence[:length], (0, length - len(sequence[:length])), value=value)
+            for sequence in sequences
+        ])
+
+    def __call__(self, items):
+        input_length = max(len(item["input_ids"]) for item in items)
+        # One column more than the longest label, so the shift below keeps the last label token like
+        # padding to max_length did
+        label_length = min(max(len(item["labels"]) for item in items) + 1, self.max_length)
+
+        input_ids = self.pad_stack([item["input_ids"] for item in items], input_length, self.pad_token_id)
+        attention_mask = self.pad_stack([item["attention_mask"] for item in items], input_length, 0)
+        label_ids = self.pad_stack([item["labels"] for item in items], label_length, self.pad_token_id)
+        label_mask = self.pad_stack([torch.ones_like(item["labels"]) for item in items], label_length, 0)
+
+        # Same shift as TextDataset: labels without the last token, padded back to full length
+        decoder_input_ids = torch.nn.functional.pad(label_ids[:, :-1], (0, 1), value=self.pad_token_id)
+        labels = label_ids.masked_fill(label_mask == 0, LABEL_PAD_ID)
+        return {
+            "input_ids": input_ids,
+            "attention_mask": attention_mask,
+            "labels": labels,
+            "decoder_input_ids": decoder_input_ids,
+        }
+
+
+class LengthBucketBatchSampler(Sampler):
+    def __init__(self, lengths, batch_size, bucket_size_multiplier=50, shuffle=True, seed=0, drop_last=False):
+        """
+        Yields batches of indices of similar length. The indices are shuffled, cut into buckets of
+        batch_size * bucket_size_multiplier, sorted by length inside each bucket and cut into batches;
+        the batch order is shuffled again so an epoch does not run from short to long examples.
+        :param lengths: Length of every example (e.g. input tokens + label tokens).
+        :param batch_size: Number of examples per batch.
+        :param bucket_size_multiplier: Number of batches per bucket, larger buckets give tighter batches but less
+                                       randomness.
+        :param shuffle: Shuffle the examples and batches, otherwise the batches follow the dataset order.
+        :param seed: Base seed of the shuffling, combined with the epoch (see set_epoch()).
+        :param drop_last: Skip the last batch of a bucket if it is smaller than batch_size.
+        """
+        self.lengths = [int(length) for length in lengths]
+        self.batch_size = batch_size
+        self.bucket_size = batch_size * bucket_size_multiplier
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.drop_last = drop_last
+
+    def set_epoch(self, epoch):
+        """
+        Changes the shuffle order for the next pass, call it before iterating each epoch.
+        """
+        self.epoch = epoch
+
+    def make_batches(self):
+        indices = list(range(len(self.lengths)))
+        rng = random.Random(self.seed + self.epoch)
+        if self.shuffle:
+            rng.shuffle(indices)
+
+        batches = []
+        for start in range(0, len(indices), self.bucket_size):
+            bucket = sorted(indices[start:start + self.bucket_size], key=lambda idx: self.lengths[idx])
+            for batch_start in range(0, len(bucket), self.batch_size):
+                batch = bucket[batch_start:batch_start + self.batch_size]
+                if len(batch) < self.batch_size and self.drop_last:
+                    continue
+                batches.append(batch)
+        if self.shuffle:
+            rng.shuffle(batches)
+        return batches
+
+    def __iter__(self):
+        return iter(self.make_batches())
+
+    def __len__(self):
+        if self.drop_last:
+            full_buckets, rest = divmod(len(self.lengths), self.bucket_size)
+            return full_buckets * (self.bucket_size // self.batch_size) + rest // self.batch_size
+        return sum(
+            -(-min(self.bucket_size, len(self.lengths) - start) // self.batch_size)
+            for start in range(0, len(self.lengths), self.bucket_size)
+        )
+
+
+class RandomBatchSampler(Sampler):
+    def __init__(self, num_items, batch_size, seed=0, drop_last=False):
+        """
+        Yields shuffled batches of indices, in an order that only depends on the seed and the epoch, so a
+        training run can be resumed in the middle of an epoch.
+        """
+        self.num_items = num_items
+        self.batch_size = batch_size
+        self.seed = seed
+        self.epoch = 0
+        self.drop_last = drop_last
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        generator = torch.Generator().manual_seed(self.seed + self.epoch)
+        indices = torch.randperm(self.num_items, generator=generator).tolist()
+        for start in range(0, self.num_items, self.batch_size):
+            batch = indices[start:start + self.batch_size]
+            if len(batch) < self.batch_size and self.drop_last:
+                return
+            yield batch
+
+    def __len__(self):
+        if self.drop_last:
+            return self.num_items // self.batch_size
+        return -(-self.num_items // self.batch_size)
+
+
+class PaddingStats:
+    """
+    Counts real and pad tokens of the batches of an epoch, to report how much of the compute goes to padding.
+    """
+    def __init__(self, pad_token_id):
+        self.pad_token_id = pad_token_id
+        self.reset()
+
+    def reset(self):
+        self.real_tokens = 0
+        self.total_tokens = 0
+
+    def update(self, batch):
+        labels = batch["labels"]
+        self.real_tokens += int(batch["attention_mask"].sum())
+        self.real_tokens += int(((labels != LABEL_PAD_ID) & (labels != self.pad_token_id)).sum())
+        self.total_tokens += batch["attention_mask"].numel() + labels.numel()
+
+    def padding_ratio(self):
+        if self.total_tokens == 0:
+            return 0.0
+        return 1.0 - self.real_tokens / self.total_tokens
@@ -57,6 +57,20 @@ class Context:
         #return personality_text + history_text
         return context_string
 
+    def refresh(self):
+        """
+        Picks up changes to the profile (name, gender, relationship, mood) and rebuilds the initial context.
+        """
+        self.relationship_status = self.ai_profile.relationship_type
+        self.mood = self.ai_profile.mood
+        self.create_initial_context()
+
+    def get_system_prompt(self):
+        """
+        Returns the persona part of the context, the part that has to be sent with every turn.
+        """
+        return self.initial_context
+
     def create_initial_context(self):
         name_text = f"Your name is {self.ai_profile.get_name()}.\n"
         gender_text = f"Your gender is {self.ai_profile.get_gender().value}.\n"
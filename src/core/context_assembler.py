@@ -0,0 +1,113 @@
+# src/core/context_assembler.py
+"""
+This class is responsible for fitting the context into the model's input length.
+It works in token counts: the system prompt and the current user turn are always kept, the conversation history
+is added newest first until the budget runs out, so the tokenizer never has to truncate the user's question.
+The input is built from token ids of cached segments (see SegmentTokenCache), only the new user message is
+tokenized on each turn.
+"""
+from src.core.token_cache import SegmentTokenCache
+
+HISTORY_HEADER = "\nHere is your recent conversation history:\n"
+TURN_SEPARATOR = "\n"
+
+
+class AssembledContext:
+    def __init__(self, text, input_ids, max_tokens, history_turns=0, system_prompt_truncated=False):
+        """
+        :param text: Context string, what the input_ids hold between the template's head and the user turn.
+        :param input_ids: Token ids of the complete model input (template, context and user turn).
+        :param max_tokens: Budget the context was assembled against.
+        :param history_turns: Number of history turns that fit.
+        :param system_prompt_truncated: True if even the system prompt had to be shortened.
+        """
+        self.text = text
+        self.input_ids = input_ids
+        self.token_count = len(input_ids)
+        self.max_tokens = max_tokens
+        self.history_turns = history_turns
+        self.system_prompt_truncated = system_prompt_truncated
+
+    def __repr__(self):
+        return (f"AssembledContext(tokens={self.token_count}/{self.max_tokens}, history_turns={self.history_turns}, "
+                f"system_prompt_truncated={self.system_prompt_truncated})")
+
+
+class ContextAssembler:
+    def __init__(self, model, max_tokens=None):
+        """
+        :param model: T5Model (or LazyModel handle) providing the tokenizer, prompt_fragments() and max_input_length.
+        :param max_tokens: Token budget for the whole model input, defaults to the model's maximum input length.
+        """
+        self.model = model
+        self.max_tokens = max_tokens
+        self.token_cache = SegmentTokenCache(model)
+
+    def get_max_tokens(self):
+        return self.max_tokens if self.max_tokens is not None else self.model.max_input_length
+
+    def assemble(self, system_prompt, history_turns, user_input, instruction="", fingerprint=None):
+        """
+        Builds the model input for one turn.
+        :param system_prompt: Persona text, always included (shortened only if it alone overflows the budget).
+        :param history_turns: Formatted history turns, oldest first.
+        :param user_input: The current user message, never truncated.
+        :param instruction: Text closing the context, always included.
+        :param fingerprint: Profile state the cached segments belong to, a different value clears the cache.
+        :return: AssembledContext whose input_ids are at most max_tokens long.
+        :raises ValueError: If the user message alone does not fit in the budget.
+        """
+        if fingerprint is not None:
+            self.token_cache.check_fingerprint(fingerprint)
+        encode = self.token_cache.encode
+        max_tokens = self.get_max_tokens()
+        head, middle, tail = self.model.prompt_fragments()
+        eos = [self.model.tokenizer.eos_token_id] if self.model.tokenizer.eos_token_id is not None else []
+
+        # The user message is the only segment that is new every turn, it is not cached
+        user_ids = self.model.tokenizer(user_input, add_special_tokens=False).input_ids
+        turn_ids = encode(middle) + user_ids + encode(tail) + eos
+        head_ids = encode(head)
+        instruction_ids = encode(instruction)
+        if len(head_ids) + len(turn_ids) > max_tokens:
+            raise ValueError(f"The message is too long for the model ({max_tokens} tokens maximum).")
+
+        system_ids = encode(system_prompt)
+        available = max_tokens - len(head_ids) - len(instruction_ids) - len(turn_ids)
+        system_prompt_truncated = len(system_ids) > available
+        if system_prompt_truncated:
+            system_ids = system_ids[:max(available, 0)]
+            system_prompt = self.model.tokenizer.decode(system_ids, skip_special_tokens=True)
+
+        # Fill the history newest first with the remaining budget
+        budget = available - len(system_ids) - len(encode(HISTORY_HEADER))
+        separator_ids = encode(TURN_SEPARATOR)
+        # Only turns that can possibly fit are tokenized, new ones in one batch
+        candidates = history_turns[-max(budget, 0):] if budget > 0 else []
+        selected = []
+        for turn, ids in reversed(list(zip(candidates, self.token_cache.encode_many(candidates)))):
+            cost = len(ids) + (len(separator_ids) if selected else 0)
+            if cost > budget:
+                break
+            selected.insert(0, (turn, ids))
+            budget -= cost
+
+        context_ids = list(system_ids)
+        if selected:
+            context_ids += encode(HISTORY_HEADER)
+            for index, (turn, ids) in enumerate(selected):
+                if index:
+                    context_ids += separator_ids
+                context_ids += ids
+        context_ids += instruction_ids
+
+        text = self.join(system_prompt, [turn for turn, ids in selected], instruction)
+        return AssembledContext(text, head_ids + context_ids + turn_ids, max_tokens, len(selected),
+                                system_prompt_truncated)
+
+    @staticmethod
+    def join(system_prompt, history_turns, instruction):
+        context = system_prompt
+        if history_turns:
+            context += HISTORY_HEADER + TURN_SEPARATOR.join(history_turns)
+        return context + instruction
@@ -0,0 +1,362 @@
+# src/core/continual_trainer.py
+"""
+This class is responsible for fine-tuning an AI profile's adapter in the background on the conversation turns that
+were added since its last training run.
+When enough new turns have piled up, the chat starts a separate training process with the lowest CPU priority, few
+threads and a duty cycle throttle, so generation keeps the CPU. The process continues training the profile's current
+adapter (or starts a new one), saves the result as a new version folder and then replaces the pointer file
+continual_adapter.json with one atomic rename. The chat sees the new version on its next turn and swaps it in.
+Run one training pass by hand with: python -m src.core.continual_trainer <profile folder> <user name> <ai name>
+"""
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+from src.core.paths import root_dir, t5_dir
+from src.core.conversation_log import ConversationLog
+from src.core.persistence_worker import persistence_worker, atomic_write_json
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+POINTER_FILE_NAME = "continual_adapter.json"
+VERSIONS_DIR_NAME = "continual_adapter"
+LOCK_FILE_NAME = "continual_training.lock"
+LOG_FILE_NAME = "continual_training.log"
+KEEP_VERSIONS = 2  # The previous version stays on disk while the chat may still be loading it
+PROFILE_ADAPTER_PREFIX = "profile-"  # Adapter names of the per-profile adapters on the shared weights
+VERSION_FOLDER_PATTERN = re.compile(r"v(\d+)\.safetensors")
+# Free memory a training pass needs, as a multiple of the size of the weights it loads (weights, activations,
+# LoRA gradients and optimizer state)
+MEMORY_FACTOR = 2.0
+
+
+def version_folder_name(version):
+    """
+    Folder name of an adapter version, with the .safetensors suffix Adapter.save_adapter() gives every adapter.
+    """
+    return f"v{version}.safetensors"
+
+
+def read_pointer(profile_folder):
+    """
+    Returns the pointer to the profile's current adapter ({"version", "path", "trained_until", "examples"}), or None
+    if no adapter was trained yet.
+    """
+    pointer_file = os.path.join(profile_folder, POINTER_FILE_NAME)
+    if not os.path.exists(pointer_file):
+        return None
+    try:
+        with open(pointer_file, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        print(f"(file: continual_trainer.py, method: read_pointer) Could not read {pointer_file}: {e}")
+        return None
+
+
+def parse_timestamp(timestamp):
+    try:
+        return datetime.fromisoformat(timestamp)
+    except (TypeError, ValueError):
+        return None
+
+
+def is_new_entry(entry, since):
+    timestamp = parse_timestamp(entry.get("timestamp"))
+    return timestamp is not None and (since is None or timestamp > since)
+
+
+def new_exchanges(profile_folder, user_name, ai_name, since=None):
+    """
+    Reads the exchanges of the conversation log that are newer than 'since' as training pairs.
+    :param since: Timestamp (ISO format) of the last trained entry, None for the whole log.
+    :return: (list of {'user_input', 'ai_response'} entries, timestamp of the newest entry read or 'since')
+    """
+    since = parse_timestamp(since)
+    pairs = []
+    newest = since
+    for entry in ConversationLog(profile_folder).iter_entries():
+        if not is_new_entry(entry, since):
+            continue
+        newest = parse_timestamp(entry["timestamp"])
+        user_input, ai_response = entry.get(user_name), entry.get(ai_name)
+        if user_input and ai_response:
+            pairs.append({"user_input": user_input, "ai_response": ai_response})
+    return pairs, newest.isoformat() if newest else None
+
+
+def process_is_running(pid):
+    if psutil is not None:
+        return psutil.pid_exists(pid)
+    if os.name == "nt":
+        return True  # os.kill() would end the process on Windows
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True  # Exists, but belongs to someone else
+    return True
+
+
+class TrainingLock:
+    def __init__(self, profile_folder):
+        """
+        Makes sure only one training process works on a profile. The lock file holds the pid of its owner, a lock
+        left behind by a process that died is taken over.
+        """
+        self.lock_file = os.path.join(profile_folder, LOCK_FILE_NAME)
+        self.locked = False
+
+    def acquire(self):
+        for _ in range(2):
+            try:
+                fd = os.open(self.lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if self.holder_is_running():
+                    return False
+                os.remove(self.lock_file)
+                continue
+            with os.fdopen(fd, "w") as f:
+                f.write(str(os.getpid()))
+            self.locked = True
+            return True
+        return False
+
+    def holder_is_running(self):
+        try:
+            with open(self.lock_file, "r") as f:
+                return process_is_running(int(f.read().strip()))
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError):
+            return True  # Being written right now
+
+    def release(self):
+        if self.locked and os.path.exists(self.lock_file):
+            os.remove(self.lock_file)
+        self.locked = False
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class Throttle:
+    def __init__(self, duty_cycle=0.5):
+        """
+        Called after every optimizer step, sleeps so training uses the CPU at most duty_cycle of the time.
+        """
+        self.duty_cycle = duty_cycle
+        self.last = None
+
+    def __call__(self, adapter=None):
+        if self.last is not None:
+            busy = time.monotonic() - self.last
+            time.sleep(busy * (1 - self.duty_cycle) / self.duty_cycle)
+        self.last = time.monotonic()
+
+
+def lower_priority(threads=1):
+    """
+    Gives the current process the lowest CPU priority and limits torch to 'threads' threads.
+    """
+    import torch
+
+    if hasattr(os, "nice"):
+        os.nice(19)
+    torch.set_num_threads(threads)
+
+
+def weights_size(model_dir):
+    return sum(os.path.getsize(os.path.join(model_dir, name)) for name in os.listdir(model_dir)
+               if name.endswith((".safetensors", ".bin")))
+
+
+def has_memory_for_training(model_dir=t5_dir, memory_factor=MEMORY_FACTOR):
+    """
+    True when enough memory is free to load a second copy of the weights and train on it, so the training pass
+    does not push the chat's model into swap. Also True when the free memory cannot be read.
+    """
+    from src.core.training_planner import available_memory
+
+    available = available_memory()
+    needed = weights_size(model_dir) * memory_factor
+    if available is not None and available < needed:
+        print(f"Skipping background training: {available / 2 ** 30:.1f} GiB free, {needed / 2 ** 30:.1f} GiB needed.")
+        return False
+    return True
+
+
+def publish_adapter(profile_folder, version, path, trained_until, examples):
+    """
+    Points the profile at a new adapter version. The pointer file is replaced atomically, a reader sees either the
+    old or the new version, never a partly written adapter. Versions older than the last KEEP_VERSIONS are removed.
+    """
+    atomic_write_json(os.path.join(profile_folder, POINTER_FILE_NAME), {
+        "version": version,
+        "path": path,
+        "trained_until": trained_until,
+        "examples": examples,
+    })
+    versions_dir = os.path.join(profile_folder, VERSIONS_DIR_NAME)
+    for folder in os.listdir(versions_dir):
+        match = VERSION_FOLDER_PATTERN.fullmatch(folder)
+        if match and int(match.group(1)) <= version - KEEP_VERSIONS:
+            shutil.rmtree(os.path.join(versions_dir, folder), ignore_errors=True)
+
+
+def train_continual(profile_folder, user_name, ai_name, min_new_entries=16, max_examples=1024, epochs=1,
+                    duty_cycle=0.5, threads=1):
+    """
+    One background training pass: continues the profile's adapter on the exchanges added since it was last
+    trained, on the CPU with low priority, and publishes the result as the next version.
+    :param min_new_entries: Do nothing if fewer new exchanges are available.
+    :param max_examples: Train on at most the newest this many exchanges.
+    :param duty_cycle: Fraction of the time the training may use the CPU (see Throttle).
+    :param threads: Torch intra-op threads.
+    :return: The pointer of the published version, or None if nothing was trained.
+    """
+    from src.core.adapter import Adapter
+    from src.core.t5_model import T5Model
+    from src.core.text_dataset import TextDataset
+    from src.core.training_planner import TrainingPlan
+
+    with TrainingLock(profile_folder) as locked:
+        if not locked:
+            print(f"Another process is training the adapter of {ai_name}.")
+            return None
+        pointer = read_pointer(profile_folder)
+        pairs, trained_until = new_exchanges(profile_folder, user_name, ai_name,
+                                             pointer["trained_until"] if pointer else None)
+        if len(pairs) < min_new_entries:
+            print(f"{len(pairs)} new exchanges for {ai_name}, waiting for {min_new_entries}.")
+            return None
+        pairs = pairs[-max_examples:]
+        if not has_memory_for_training():
+            return None
+
+        lower_priority(threads)
+        model = T5Model(t5_dir, ai_profile_name=ai_name, user_profile_name=user_name, device="cpu")
+        version = pointer["version"] + 1 if pointer else 1
+        adapter = Adapter(name=f"{ai_name}-continual")
+        adapter.adapter_dir = os.path.join(profile_folder, VERSIONS_DIR_NAME)
+        adapter.full_file_name = os.path.join(adapter.adapter_dir, version_folder_name(version))
+        initial_adapter = pointer["path"] if pointer and os.path.isdir(pointer["path"]) else None
+        print(f"Training {ai_name} v{version} on {len(pairs)} new exchanges"
+              f"{' from v' + str(pointer['version']) if initial_adapter else ''}")
+
+        start = time.time()
+        adapter.train_adapter(
+            model, TextDataset(pairs, model.tokenizer, pad_to_max_length=False), epochs=epochs,
+            plan=TrainingPlan(batch_size=2, gradient_accumulation_steps=1, gradient_checkpointing=True, num_workers=0),
+            checkpoint_every=0, checkpoint_interval=0, before_optimizer_step=Throttle(duty_cycle),
+            initial_adapter=initial_adapter,
+        )
+        publish_adapter(profile_folder, version, adapter.full_file_name, trained_until, len(pairs))
+        print(f"Published {ai_name} v{version} after {time.time() - start:.0f}s")
+        return read_pointer(profile_folder)
+
+
+class ContinualTrainer:
+    def __init__(self, ai_profile, min_new_entries=16, duty_cycle=0.5, threads=1):
+        """
+        Starts background training passes for an AI profile and swaps the adapters they publish into its model.
+        :param min_new_entries: New exchanges needed before a training pass is started.
+        :param duty_cycle: See Throttle, passed to the training process.
+        :param threads: Torch threads of the training process.
+        """
+        self.ai_profile = ai_profile
+        self.min_new_entries = min_new_entries
+        self.duty_cycle = duty_cycle
+        self.threads = threads
+        self.process = None
+        self.loaded_version = None
+        self.pending_entries = None  # Exchanges since the last trained one, counted once from the log
+
+    def is_training(self):
+        return self.process is not None and self.process.poll() is None
+
+    def count_new_entries(self):
+        pointer = read_pointer(self.ai_profile.profile_folder)
+        since = parse_timestamp(pointer["trained_until"]) if pointer else None
+        return sum(1 for entry in self.ai_profile.history if is_new_entry(entry, since))
+
+    def on_new_turn(self):
+        """
+        Called after every exchange: swaps in a newly published adapter and starts a training pass once enough
+        new exchanges piled up.
+        """
+        self.poll()
+        if self.is_training():
+            return
+        if self.pending_entries is None:
+            self.pending_entries = self.count_new_entries()
+        else:
+            self.pending_entries += 1
+        if self.pending_entries >= self.min_new_entries:
+            self.start()
+
+    def start(self):
+        persistence_worker.flush()  # The training process reads the turns from the log
+        profile = self.ai_profile
+        if TrainingLock(profile.profile_folder).holder_is_running() or not has_memory_for_training():
+            return
+        log = open(os.path.join(profile.profile_folder, LOG_FILE_NAME), "a")
+        command = [sys.executable, "-m", "src.core.continual_trainer", profile.profile_folder,
+                   profile.get_user_profile_name(), profile.name, str(self.min_new_entries), str(self.duty_cycle),
+                   str(self.threads)]
+        if os.name == "nt":
+            options = {"creationflags": subprocess.IDLE_PRIORITY_CLASS}
+        else:
+            options = {"start_new_session": True}  # Ctrl+C in the chat does not stop the training
+        self.process = subprocess.Popen(command, cwd=root_dir, stdout=log, stderr=subprocess.STDOUT, **options)
+        log.close()
+        self.pending_entries = None
+        print(f"Started background training of {profile.name}'s adapter (pid {self.process.pid})")
+
+    def poll(self):
+        """
+        Swaps the newest published adapter into the model, if the model is loaded.
+        :return: True if an adapter was swapped in.
+        """
+        if not self.ai_profile.model.is_loaded():
+            return False
+        return self.load_into(self.ai_profile.model)
+
+    def load_into(self, model):
+        """
+        Loads the newest published adapter into a T5Model, unless it already has that version.
+        :return: True if an adapter was swapped in.
+        """
+        pointer = read_pointer(self.ai_profile.profile_folder)
+        if pointer is None or pointer["version"] == self.loaded_version:
+            return False
+        try:
+            model.swap_profile_adapter(
+                pointer["path"], f"{PROFILE_ADAPTER_PREFIX}{self.ai_profile.name}-v{pointer['version']}")
+        except Exception as e:
+            print(f"(file: continual_trainer.py, method: load_into) Could not load {pointer['path']}: {e}")
+            return False
+        self.loaded_version = pointer["version"]
+        return True
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 4:
+        print("Usage: python -m src.core.continual_trainer <profile folder> <user name> <ai name> "
+              "[min new entries] [duty cycle] [threads]")
+        sys.exit(1)
+    train_continual(sys.argv[1], sys.argv[2], sys.argv[3],
+                    min_new_entries=int(sys.argv[4]) if len(sys.argv) > 4 else 16,
+                    duty_cycle=float(sys.argv[5]) if len(sys.argv) > 5 else 0.5,
+                    threads=int(sys.argv[6]) if len(sys.argv) > 6 else 1)
@@ -0,0 +1,123 @@
+# src/core/conversation_log.py
+"""
+This class is responsible for storing an AI profile's conversation history as an append-only log.
+Every turn is one JSON line added to the end of the file, so saving a turn costs the same no matter how long
+the conversation already is. The old conversation_history.json (a single JSON list) is migrated once.
+"""
+import json
+import os
+
+from src.core.persistence_worker import persistence_worker, atomic_write_text
+
+LOG_FILE_NAME = "conversation_history.jsonl"
+LEGACY_FILE_NAME = "conversation_history.json"
+ARCHIVE_FILE_NAME = "conversation_history.archive.jsonl"
+
+
+class ConversationLog:
+    def __init__(self, folder):
+        """
+        :param folder: The AI profile folder the log lives in.
+        """
+        self.folder = folder
+        self.log_file = os.path.join(folder, LOG_FILE_NAME)
+        self.legacy_file = os.path.join(folder, LEGACY_FILE_NAME)
+        self.archive_file = os.path.join(folder, ARCHIVE_FILE_NAME)
+
+    def migrate(self):
+        """
+        Converts the legacy conversation_history.json into the log, once. The legacy file is kept
+        as conversation_history.json.migrated.
+        :return: Number of migrated entries.
+        """
+        if not os.path.exists(self.legacy_file) or os.path.exists(self.log_file):
+            return 0
+        with open(self.legacy_file, "r", encoding="utf-8") as f:
+            entries = json.load(f)
+        self.rewrite(entries)
+        os.replace(self.legacy_file, self.legacy_file + ".migrated")
+        print(f"Migrated {len(entries)} conversation entries to {self.log_file}")
+        return len(entries)
+
+    def append(self, entry):
+        """
+        Queues one entry to be added to the end of the log by the persistence worker.
+        """
+        persistence_worker.append_line(self.log_file, json.dumps(entry, ensure_ascii=False))
+
+    def iter_entries(self):
+        """
+        Yields the entries in order. A line that is not valid JSON (e.g. cut off by a crash) is skipped.
+        """
+        persistence_worker.flush()
+        if not os.path.exists(self.log_file):
+            return
+        with open(self.log_file, "r", encoding="utf-8") as f:
+            for line_number, line in enumerate(f, start=1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    print(f"(file: conversation_log.py, method: iter_entries) Skipping damaged line {line_number} in {self.log_file}")
+
+    def read_all(self):
+        return list(self.iter_entries())
+
+    def tail(self, count, block_size=8192):
+        """
+        Returns the last 'count' entries, reading the file backwards so only the end of the log is read.
+        """
+        persistence_worker.flush()
+        if count <= 0 or not os.path.exists(self.log_file):
+            return []
+        with open(self.log_file, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            position = f.tell()
+            data = b""
+            # One more line than needed, the first one read may be partial
+            while position > 0 and data.count(b"\n") <= count:
+                read_size = min(block_size, position)
+                position -= read_size
+                f.seek(position)
+                data = f.read(read_size) + data
+        lines = data.split(b"\n")
+        if position > 0:
+            lines = lines[1:]
+        entries = []
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entries.append(json.loads(line.decode("utf-8")))
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                continue
+        return entries[-count:]
+
+    def rewrite(self, entries):
+        """
+        Replaces the whole log with the given entries, written to a temporary file first so a crash
+        never leaves a half written log.
+        """
+        persistence_worker.flush()  # Queued appends must not land after the rewrite
+        atomic_write_text(self.log_file, "".join(json.dumps(entry, ensure_ascii=False) + "\n" for entry in entries))
+
+    def compact(self, keep_last=None):
+        """
+        Rewrites the log without damaged lines. With keep_last, older entries are moved to the archive log
+        so the live log stays short.
+        :return: Number of entries left in the log.
+        """
+        entries = self.read_all()
+        if keep_last is not None and len(entries) > keep_last:
+            archived, entries = entries[:len(entries) - keep_last], entries[len(entries) - keep_last:]
+            for entry in archived:
+                persistence_worker.append_line(self.archive_file, json.dumps(entry, ensure_ascii=False))
+            print(f"Archived {len(archived)} conversation entries to {self.archive_file}")
+        self.rewrite(entries)
+        return len(entries)
+
+    def clear(self):
+        self.rewrite([])
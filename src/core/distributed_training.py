@@ -0,0 +1,185 @@
+# src/core/distributed_training.py
+"""
+This file is responsible for training one adapter with several CPU processes (data parallel).
+Every process loads the model, takes its own share of each epoch's batches and runs Adapter.train_adapter() with
+a few intra-op threads. Once the adapter is created, process 0 broadcasts its LoRA weights to the others. Before
+every optimizer step the gradients of the LoRA weights, the only trainable ones, are averaged over the processes
+with a gloo all-reduce, so all processes keep identical adapters; process 0 writes the checkpoints and the final
+adapter.
+Run the scaling benchmark with: python -m src.core.distributed_training [training data file] [max processes]
+"""
+import os
+import socket
+import sys
+import time
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.utils.data import Sampler
+
+from src.core.paths import t5_dir
+from src.core.pretokenizer import pretokenize
+from src.core.t5_model import T5Model
+from src.core.training_planner import TrainingPlan
+
+
+class ShardedBatchSampler(Sampler):
+    def __init__(self, batch_sampler, rank, world_size):
+        """
+        Gives process 'rank' every world_size-th batch of the wrapped sampler. Every process gets the same number of
+        batches (the last incomplete round is dropped), so they all reach each all-reduce.
+        The wrapped sampler must produce the same order in every process (same seed and epoch).
+        """
+        self.batch_sampler = batch_sampler
+        self.rank = rank
+        self.world_size = world_size
+
+    def set_epoch(self, epoch):
+        if hasattr(self.batch_sampler, "set_epoch"):
+            self.batch_sampler.set_epoch(epoch)
+
+    def __iter__(self):
+        for position, batch in enumerate(iter(self.batch_sampler)):
+            if position >= len(self) * self.world_size:
+                return
+            if position % self.world_size == self.rank:
+                yield batch
+
+    def __len__(self):
+        return len(self.batch_sampler) // self.world_size
+
+
+def broadcast_trainable_parameters(adapter):
+    """
+    Copies the trainable (LoRA) parameters of process 0 to every other process, so all processes start from the
+    same adapter no matter which random numbers each one drew for the initialization.
+    """
+    with torch.no_grad():
+        for param in adapter.parameters():
+            if param.requires_grad:
+                dist.broadcast(param.data, src=0)
+
+
+class LoraGradientAllReduce:
+    """
+    Averages the gradients of the trainable (LoRA) parameters over all processes, in one flat all-reduce.
+    The frozen base model has no gradients and is never communicated.
+    """
+    def __init__(self, world_size):
+        self.world_size = world_size
+
+    def __call__(self, adapter):
+        params = [p for p in adapter.parameters() if p.requires_grad]
+        grads = [p.grad if p.grad is not None else torch.zeros_like(p) for p in params]
+        flat = torch.cat([grad.reshape(-1) for grad in grads])
+        dist.all_reduce(flat, op=dist.ReduceOp.SUM)
+        flat /= self.world_size
+        offset = 0
+        for param in params:
+            count = param.numel()
+            param.grad = flat[offset:offset + count].view_as(param).clone()
+            offset += count
+
+
+def find_free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def run_worker(rank, world_size, port, adapter_name, data_file, epochs, plan_settings, seed, threads, save,
+               result_queue):
+    from src.core.adapter import Adapter
+
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(port)
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    torch.set_num_threads(threads)
+    try:
+        torch.manual_seed(seed)
+        model = T5Model(t5_dir, device="cpu")
+        adapter = Adapter(name=adapter_name)
+        training_data = adapter.prepare_data(model, data_file)
+        start = time.time()
+        adapter.train_adapter(
+            model, training_data, epochs=epochs, seed=seed,
+            plan=TrainingPlan(**plan_settings),
+            batch_sampler_wrapper=lambda sampler: ShardedBatchSampler(sampler, rank, world_size),
+            on_adapter_created=broadcast_trainable_parameters,
+            before_optimizer_step=LoraGradientAllReduce(world_size),
+            is_main_process=rank == 0,
+            save=save,
+        )
+        dist.barrier()
+        if rank == 0 and result_queue is not None:
+            result_queue.put({"processes": world_size, "seconds": time.time() - start, "examples": len(training_data)})
+    finally:
+        dist.destroy_process_group()
+
+
+def train_data_parallel(adapter_name, data_file, num_processes=None, epochs=3, batch_size=2,
+                        gradient_accumulation_steps=4, seed=0, save=True, result_queue=None):
+    """
+    Trains one adapter with num_processes CPU processes and saves it once (from process 0).
+    :param num_processes: Number of processes, defaults to one per 4 CPUs.
+    :param batch_size: Batch size per process, the effective batch is batch_size * gradient_accumulation_steps
+                       * num_processes.
+    :param save: Save the adapter, the scaling benchmark trains without saving.
+    :param result_queue: Queue process 0 puts its training time into.
+    """
+    cpus = os.cpu_count() or 1
+    num_processes = num_processes or max(cpus // 4, 1)
+    threads = max(cpus // num_processes, 1)
+    # Tokenize once here instead of racing on the token cache in every process
+    pretokenize([data_file], T5Model.load_tokenizer(t5_dir))
+    plan_settings = {
+        "batch_size": batch_size,
+        "gradient_accumulation_steps": gradient_accumulation_steps,
+        "gradient_checkpointing": True,
+        "num_workers": 0,
+    }
+    print(f"Training '{adapter_name}' with {num_processes} processes x {threads} threads")
+    mp.spawn(
+        run_worker,
+        args=(num_processes, find_free_port(), adapter_name, data_file, epochs, plan_settings, seed, threads, save,
+              result_queue),
+        nprocs=num_processes,
+        join=True,
+    )
+
+
+def benchmark_scaling(data_file="training_data.json", max_processes=None, epochs=1, batch_size=2):
+    """
+    Trains one epoch with 1, 2, 4, ... up to max_processes processes and reports examples per second and the
+    speedup over one process. Nothing is saved.
+    :return: List of result dictionaries (processes, seconds, examples).
+    """
+    max_processes = max_processes or max((os.cpu_count() or 1) // 4, 1)
+    counts = []
+    count = 1
+    while count < max_processes:
+        counts.append(count)
+        count *= 2
+    counts.append(max_processes)
+
+    result_queue = mp.get_context("spawn").SimpleQueue()
+    results = []
+    for count in counts:
+        train_data_parallel("scaling-benchmark", data_file, num_processes=count, epochs=epochs, batch_size=batch_size,
+                            save=False, result_queue=result_queue)
+        results.append(result_queue.get())
+
+    base = results[0]["examples"] * epochs / results[0]["seconds"]
+    print(f"{'processes':>10}{'seconds':>10}{'examples/s':>12}{'speedup':>9}{'efficiency':>12}")
+    for result in results:
+        rate = result["examples"] * epochs / result["seconds"]
+        print(f"{result['processes']:>10}{result['seconds']:>10.1f}{rate:>12.2f}{rate / base:>8.2f}x"
+              f"{rate / base / result['processes']:>12.0%}")
+    return results
+
+
+if __name__ == "__main__":
+    file_name = sys.argv[1] if len(sys.argv) > 1 else "training_data.json"
+    process_count = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    benchmark_scaling(file_name, process_count)
@@ -0,0 +1,110 @@
+# src/core/encoder_cache.py
+"""
+This class is responsible for keeping the T5 encoder's hidden states of the training examples.
+When only the decoder is trained (decoder-only LoRA) the encoder is frozen, so the hidden states of an example are
+the same in every epoch. They are computed the first time the example is seen and read back in the later epochs,
+either from memory or from a file on disk that is read through a memory map.
+"""
+import contextlib
+import os
+
+import numpy as np
+import torch
+from transformers.modeling_outputs import BaseModelOutput
+
+MEMORY = "memory"
+DISK = "disk"
+
+
+class EncoderStateCache:
+    def __init__(self, hidden_size, mode=MEMORY, disk_file=None):
+        """
+        :param hidden_size: Size of the encoder hidden states (d_model).
+        :param mode: "memory" to keep the states in RAM, "disk" to append them to disk_file.
+        :param disk_file: File the states are written to in "disk" mode, it is removed by close().
+        """
+        if mode == DISK and disk_file is None:
+            raise ValueError("The disk mode of EncoderStateCache needs a disk_file.")
+        self.hidden_size = hidden_size
+        self.mode = mode
+        self.disk_file = disk_file
+        self.states = {}  # Dataset index -> tensor in memory mode, (row offset, length) in disk mode
+        self.rows_written = 0
+        self.writer = None
+        self.reader = None
+        self.hits = 0
+        self.misses = 0
+        if mode == DISK:
+            os.makedirs(os.path.dirname(disk_file), exist_ok=True)
+            self.writer = open(disk_file, "wb")
+
+    def __contains__(self, index):
+        return index in self.states
+
+    def store(self, index, state):
+        """
+        Stores the unpadded hidden states (length, hidden_size) of one example.
+        """
+        state = state.detach().to("cpu", torch.float32)
+        if self.mode == MEMORY:
+            self.states[index] = state.clone()
+            return
+        self.writer.write(state.numpy().tobytes())
+        self.states[index] = (self.rows_written, len(state))
+        self.rows_written += len(state)
+
+    def load(self, index):
+        if self.mode == MEMORY:
+            return self.states[index]
+        offset, length = self.states[index]
+        if self.reader is None or len(self.reader) < offset + length:
+            # Written since the memory map was opened
+            self.writer.flush()
+            self.reader = np.memmap(self.disk_file, dtype=np.float32, mode="r").reshape(-1, self.hidden_size)
+        return torch.from_numpy(np.array(self.reader[offset:offset + length]))
+
+    def encoder_outputs(self, encoder, indices, input_ids, attention_mask, forward_context=None):
+        """
+        Returns the encoder outputs of a batch, padded like input_ids. The examples that are not cached yet are
+        encoded (in eval mode, without gradients) and stored.
+        :param encoder: The frozen T5 encoder.
+        :param indices: Dataset indices of the batch rows.
+        :param forward_context: Callable returning the context the encoder runs in (e.g. bf16 autocast).
+        """
+        lengths = attention_mask.sum(dim=1).tolist()
+        missing = [row for row, index in enumerate(indices) if index not in self.states]
+        self.hits += len(indices) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            was_training = encoder.training
+            encoder.eval()
+            # The whole batch is encoded, masks attached to the batch (e.g. sequence packing) keep their shape
+            with torch.no_grad(), forward_context() if forward_context else contextlib.nullcontext():
+                hidden = encoder(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state
+            encoder.train(was_training)
+            for row in missing:
+                self.store(indices[row], hidden[row, :lengths[row]])
+
+        batch_size, sequence_length = input_ids.shape
+        states = torch.zeros(batch_size, sequence_length, self.hidden_size, dtype=torch.float32)
+        for row, index in enumerate(indices):
+            states[row, :lengths[row]] = self.load(index)
+        return BaseModelOutput(last_hidden_state=states.to(input_ids.device))
+
+    def get_stats(self):
+        total = self.hits + self.misses
+        return {
+            "entries": len(self.states),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        self.reader = None
+        self.states = {}
+        if self.mode == DISK and os.path.exists(self.disk_file):
+            os.remove(self.disk_file)
@@ -0,0 +1,68 @@
+# src/core/generation_policy.py
+"""
+This class is responsible for bounding how much work a single response may cost.
+It caps the number of attempts, the wall-clock time and the number of new tokens, and decides which
+decoding strategy each retry uses so a failed attempt is not simply repeated.
+"""
+
+GREEDY = "greedy"
+SAMPLE = "sample"
+SHORT_CONTEXT = "short_context"
+
+
+class GenerationPolicy:
+    def __init__(self, max_attempts=3, deadline=30.0, max_new_tokens=200, strategies=(GREEDY, SAMPLE, SHORT_CONTEXT),
+                 temperature=0.8, top_p=0.9, short_context_ratio=0.5):
+        """
+        :param max_attempts: Maximum number of generate() calls for one response.
+        :param deadline: Wall-clock budget in seconds shared by all attempts.
+        :param max_new_tokens: Maximum number of tokens a single attempt may generate.
+        :param strategies: Decoding strategy per attempt, the last one is reused if there are more attempts.
+        :param temperature: Sampling temperature for the sampled strategies.
+        :param top_p: Nucleus sampling threshold for the sampled strategies.
+        :param short_context_ratio: Share of the context lines (newest last) kept by the short_context strategy.
+        """
+        self.max_attempts = max_attempts
+        self.deadline = deadline
+        self.max_new_tokens = max_new_tokens
+        self.strategies = tuple(strategies)
+        self.temperature = temperature
+        self.top_p = top_p
+        self.short_context_ratio = short_context_ratio
+
+    def strategy_for(self, attempt):
+        return self.strategies[min(attempt, len(self.strategies) - 1)]
+
+    def without_first_attempt(self):
+        """
+        Returns a copy of the policy that starts at the second strategy with one attempt less, for a retry after
+        the first attempt already ran elsewhere (e.g. the greedy streamed generation).
+        """
+        return GenerationPolicy(
+            max_attempts=max(self.max_attempts - 1, 1), deadline=self.deadline, max_new_tokens=self.max_new_tokens,
+            strategies=self.strategies[1:] or self.strategies, temperature=self.temperature, top_p=self.top_p,
+            short_context_ratio=self.short_context_ratio,
+        )
+
+    def decoding_kwargs(self, strategy):
+        """
+        Returns the generate() keyword arguments for a strategy.
+        """
+        if strategy == GREEDY:
+            return {"do_sample": False}
+        return {"do_sample": True, "temperature": self.temperature, "top_p": self.top_p}
+
+    def shorten_context(self, context):
+        """
+        Keeps the newest share of the context lines, used by the short_context strategy.
+        """
+        lines = context.splitlines()
+        keep = max(1, int(len(lines) * self.short_context_ratio))
+        return "\n".join(lines[-keep:])
+
+    def __repr__(self):
+        return (f"GenerationPolicy(max_attempts={self.max_attempts}, deadline={self.deadline}, "
+                f"max_new_tokens={self.max_new_tokens}, strategies={self.strategies})")
+
+
+default_generation_policy = GenerationPolicy()
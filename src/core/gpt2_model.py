@@ -1,20 +1,41 @@
 # src/core/gpt2_model.py
-from transformers import GPT2Tokenizer, GPT2LMHeadModel
+from transformers import GPT2Tokenizer, GPT2TokenizerFast, GPT2LMHeadModel
 import torch
 
 
 class GPT2Model:
-    def __init__(self, model_dir, device="cuda" if torch.cuda.is_available() else "cpu"):
+    def __init__(self, model_dir, device="cuda" if torch.cuda.is_available() else "cpu", tokenizer=None, model=None):
         self.device = device
-        self.tokenizer = GPT2Tokenizer.from_pretrained(model_dir, local_files_only=True)
-        self.model = GPT2LMHeadModel.from_pretrained(model_dir, local_files_only=True)
-        self.model.to(self.device)
+        self.model_dir = model_dir
+        self.tokenizer = tokenizer if tokenizer is not None else self.load_tokenizer(model_dir)
+        self.model = model if model is not None else self.load_weights(model_dir, self.device)
+        self.registry_key = None
 
         # Add padding token if not already set
         if self.tokenizer.pad_token is None:
             self.tokenizer.pad_token = self.tokenizer.eos_token  # Set padding token to eos_token
             self.model.resize_token_embeddings(len(self.tokenizer))  # Resize model embeddings to accommodate the padding token
 
+    @staticmethod
+    def load_tokenizer(model_dir):
+        """
+        Loads the Rust backed fast tokenizer, built from vocab.json and merges.txt.
+        """
+        return GPT2TokenizerFast.from_pretrained(model_dir, local_files_only=True)
+
+    @staticmethod
+    def load_slow_tokenizer(model_dir):
+        """
+        Loads the pure Python tokenizer, only used to check the fast tokenizer against it.
+        """
+        return GPT2Tokenizer.from_pretrained(model_dir, local_files_only=True)
+
+    @staticmethod
+    def load_weights(model_dir, device, dtype=None):
+        model = GPT2LMHeadModel.from_pretrained(model_dir, local_files_only=True, torch_dtype=dtype)
+        model.to(device)
+        return model
+
     def generate_response(self, user_input, max_length=100):
         # Refined instructional prompt
         prompt = f"You are an AI assistant. If someone asks you for your name, provide your name or say 'I don't have a name.' Answer the question directly: {user_input}"
@@ -39,5 +60,5 @@ class GPT2Model:
             pad_token_id=self.tokenizer.eos_token_id  # Ensure padding token is treated correctly
         )
 
-        response = self.tokenizer.decode(output_ids[0], skip_special_tokens=True)
+        response = self.tokenizer.batch_decode(output_ids, skip_special_tokens=True)[0]
         return response
@@ -0,0 +1,72 @@
+# src/core/lazy_model.py
+"""
+This class is responsible for deferring a model load until the model is actually used.
+It stands in for the model object, the first attribute access (generate_response, tokenizer, model, ...)
+runs the loader, every later access goes straight to the loaded model.
+"""
+import threading
+
+
+class LazyModel:
+    _own_attributes = ("_loader", "_model", "_lock", "_prefetch_thread")
+
+    def __init__(self, loader):
+        """
+        :param loader: Callable without arguments that returns the loaded model.
+        """
+        self._loader = loader
+        self._model = None
+        self._lock = threading.Lock()
+        self._prefetch_thread = None
+
+    def is_loaded(self):
+        return self._model is not None
+
+    def get(self):
+        """
+        Returns the loaded model, loading it first if needed. Concurrent callers wait for the same load.
+        """
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    self._model = self._loader()
+        return self._model
+
+    def prefetch(self):
+        """
+        Starts loading the model on a background thread, the first real use waits for it to finish.
+        """
+        if self._model is not None or self._prefetch_thread is not None:
+            return
+        self._prefetch_thread = threading.Thread(target=self._prefetch, name="model-prefetch", daemon=True)
+        self._prefetch_thread.start()
+
+    def _prefetch(self):
+        try:
+            self.get()
+        except Exception as e:
+            print(f"(file: lazy_model.py, method: _prefetch) Error prefetching model: {e}")
+
+    def reset(self):
+        """
+        Forgets the loaded model and returns it, the next access loads it again.
+        """
+        with self._lock:
+            model, self._model = self._model, None
+            self._prefetch_thread = None
+        return model
+
+    def __getattr__(self, name):
+        if name.startswith("__") or name in LazyModel._own_attributes:
+            raise AttributeError(name)
+        return getattr(self.get(), name)
+
+    def __setattr__(self, name, value):
+        if name in LazyModel._own_attributes:
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self.get(), name, value)
+
+    def __repr__(self):
+        state = "loaded" if self.is_loaded() else "not loaded"
+        return f"LazyModel({state}, model={self._model!r})"
@@ -0,0 +1,169 @@
+# src/core/model_registry.py
+"""
+This class is responsible for sharing loaded models between AiProfiles.
+Weights and tokenizers are loaded once per (model_name, model_dir, device, dtype) key and handed out
+as reference counted entries, every AiProfile gets its own light T5Model/GPT2Model wrapper around them.
+"""
+import threading
+from collections import OrderedDict
+
+import torch
+
+from src.core.t5_model import T5Model
+from src.core.gpt2_model import GPT2Model
+
+
+class RegistryEntry:
+    def __init__(self, key, model_class, weights, tokenizer):
+        """
+        Holds one set of shared weights and the number of wrappers currently using them.
+        :param key: (model_name, model_dir, device, dtype) tuple the entry is stored under.
+        :param model_class: Wrapper class handed out for this entry (T5Model or GPT2Model).
+        :param weights: The loaded Hugging Face model.
+        :param tokenizer: The shared tokenizer.
+        """
+        self.key = key
+        self.model_class = model_class
+        self.weights = weights
+        self.tokenizer = tokenizer
+        self.ref_count = 0
+
+    def memory_bytes(self):
+        """
+        Returns the number of bytes used by the parameters and buffers of the shared weights.
+        """
+        total = 0
+        for tensor in list(self.weights.parameters()) + list(self.weights.buffers()):
+            total += tensor.numel() * tensor.element_size()
+        return total
+
+
+class ModelRegistry:
+    model_classes = {
+        "T5": T5Model,
+        "GPT2": GPT2Model,
+    }
+
+    def __init__(self, max_idle_entries=1):
+        """
+        :param max_idle_entries: Eviction policy, the number of unreferenced entries kept resident
+                                 (least recently released first out). 0 evicts an entry as soon as it is released.
+        """
+        self.max_idle_entries = max_idle_entries
+        self.entries = OrderedDict()  # key -> RegistryEntry, ordered from least to most recently used
+        self.tokenizers = {}  # (model_name, model_dir) -> tokenizer, shared across devices and dtypes
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def make_key(model_name, model_dir, device=None, dtype=None):
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        if dtype is None:
+            dtype = torch.float32
+        return model_name, model_dir, str(device), str(dtype).replace("torch.", "")
+
+    def get_tokenizer(self, model_name, model_dir):
+        """
+        Returns the shared tokenizer for a model directory, loading it on first use.
+        """
+        with self.lock:
+            key = (model_name, model_dir)
+            if key not in self.tokenizers:
+                self.tokenizers[key] = self.model_classes[model_name].load_tokenizer(model_dir)
+            return self.tokenizers[key]
+
+    def acquire(self, model_name, model_dir, device=None, dtype=None, exclusive=False, **kwargs):
+        """
+        Returns a model wrapper bound to the shared weights for the key, loading them if they are not resident.
+        Every call must be paired with a call to release().
+        :param exclusive: Load a private copy of the weights that is not shared or registered, for code that changes
+                          the weights in place (adapter training). Only the tokenizer is shared, release() is a no-op.
+        :param kwargs: Extra arguments passed to the wrapper, e.g. ai_profile_name and user_profile_name for T5.
+        """
+        if model_name not in self.model_classes:
+            raise ValueError(f"Unknown model name '{model_name}', expected one of {list(self.model_classes)}")
+        key = self.make_key(model_name, model_dir, device, dtype)
+        model_class = self.model_classes[model_name]
+        if exclusive:
+            print(f"ModelRegistry: loading a private copy of {model_name} from {model_dir} on {key[2]} ({key[3]})")
+            weights = model_class.load_weights(model_dir, key[2], getattr(torch, key[3]))
+            return model_class(model_dir, device=key[2], tokenizer=self.get_tokenizer(model_name, model_dir),
+                               model=weights, **kwargs)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                print(f"ModelRegistry: loading {model_name} from {model_dir} on {key[2]} ({key[3]})")
+                tokenizer = self.get_tokenizer(model_name, model_dir)
+                weights = model_class.load_weights(model_dir, key[2], getattr(torch, key[3]))
+                entry = RegistryEntry(key, model_class, weights, tokenizer)
+                self.entries[key] = entry
+            self.entries.move_to_end(key)
+            entry.ref_count += 1
+            model = model_class(model_dir, device=key[2], tokenizer=entry.tokenizer, model=entry.weights, **kwargs)
+            model.registry_key = key
+            return model
+
+    def release(self, model):
+        """
+        Drops one reference to the weights used by the given wrapper and applies the eviction policy.
+        """
+        with self.lock:
+            entry = self.entries.get(getattr(model, "registry_key", None))
+            if entry is not None and entry.ref_count > 0:
+                entry.ref_count -= 1
+                self.entries.move_to_end(entry.key)
+            model.registry_key = None
+            self.evict_idle()
+
+    def evict_idle(self, keep=None):
+        """
+        Evicts unreferenced entries, least recently used first, until at most 'keep' idle entries remain.
+        :param keep: Number of idle entries to keep, defaults to max_idle_entries.
+        :return: The keys that were evicted.
+        """
+        if keep is None:
+            keep = self.max_idle_entries
+        evicted = []
+        with self.lock:
+            idle = [key for key, entry in self.entries.items() if entry.ref_count == 0]
+            for key in idle[:max(len(idle) - keep, 0)]:
+                del self.entries[key]
+                evicted.append(key)
+            if evicted:
+                used_tokenizers = {(entry.key[0], entry.key[1]) for entry in self.entries.values()}
+                for tokenizer_key in list(self.tokenizers):
+                    if tokenizer_key not in used_tokenizers:
+                        del self.tokenizers[tokenizer_key]
+                if torch.cuda.is_available():
+                    torch.cuda.empty_cache()
+        for key in evicted:
+            print(f"ModelRegistry: evicted {key}")
+        return evicted
+
+    def report(self):
+        """
+        Returns a list of dicts describing every resident entry and how much memory it uses.
+        """
+        with self.lock:
+            return [
+                {
+                    "model_name": entry.key[0],
+                    "model_dir": entry.key[1],
+                    "device": entry.key[2],
+                    "dtype": entry.key[3],
+                    "ref_count": entry.ref_count,
+                    "memory_mb": entry.memory_bytes() / (1024 * 1024),
+                }
+                for entry in self.entries.values()
+            ]
+
+    def print_report(self):
+        rows = self.report()
+        print(f"ModelRegistry: {len(rows)} resident model(s), {len(self.tokenizers)} tokenizer(s)")
+        for row in rows:
+            print(f"  {row['model_name']} [{row['device']}, {row['dtype']}] refs={row['ref_count']} "
+                  f"memory={row['memory_mb']:.1f} MB dir={row['model_dir']}")
+
+
+# Process wide registry used by every AiProfile
+model_registry = ModelRegistry()
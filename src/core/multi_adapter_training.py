@@ -0,0 +1,406 @@
+# src/core/multi_adapter_training.py
+"""
+This file is responsible for training the adapters of several profiles in one job.
+The frozen T5 weights are loaded and prepared once. Every wrapped linear layer (the LoRA target modules) gets the
+LoRA weights of all adapters, and each batch is a mixed batch holding rows of every adapter: the frozen matmuls run
+once over the combined batch and each row goes through the LoRA weights of its own adapter (RoutedLora). The loss is
+averaged per adapter, so every adapter gets the gradients it would get when trained alone, and has its own
+optimizer. At the end each adapter is saved on its own, in the layout Adapter.save_adapter() writes.
+benchmark_multi_adapter() measures it against training the adapters one after the other.
+Run it with: python -m src.core.multi_adapter_training <adapter name>=<training data file> ...
+Run the benchmark with: python -m src.core.multi_adapter_training --benchmark [training data file] [adapters]
+"""
+import copy
+import math
+import multiprocessing
+import os
+import re
+import sys
+import time
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+from torch.optim import AdamW
+from torch.utils.data import IterableDataset
+from safetensors.torch import save_file
+
+from src.core.batching import LABEL_PAD_ID
+from src.core.paths import t5_dir
+from src.core.precision import autocast, FP32
+from src.core.pretokenizer import pretokenize
+from src.core.sequence_packing import PackedDataset
+from src.core.t5_model import T5Model
+from src.core.training_metrics import TrainingMetrics
+from src.core.training_planner import TrainingPlanner, TrainingPlan, PeakMemoryMonitor
+
+DEFAULT_TARGET_MODULES = ["q", "v"]  # What peft targets in T5 when the config names no modules
+
+
+class AdapterJob:
+    def __init__(self, adapter, training_data, key):
+        """
+        One adapter trained by train_adapters().
+        :param adapter: The Adapter (name, LoRA config, file name).
+        :param training_data: Its dataset (see Adapter.prepare_data()).
+        :param key: Name of the adapter inside the routed LoRA layers.
+        """
+        self.adapter = adapter
+        self.training_data = training_data
+        self.key = key
+        self.dataloader = None
+        self.batch_sampler = None
+        self.optimizer = None
+        self.metrics = None
+        self.batches_since_step = 0
+
+
+def is_target_module(name, target_modules):
+    """
+    Same matching as peft: a string is a regular expression for the full module name, a list holds module name
+    suffixes.
+    """
+    target_modules = target_modules or DEFAULT_TARGET_MODULES
+    if isinstance(target_modules, str):
+        return re.fullmatch(target_modules, name) is not None
+    return any(name == target or name.endswith("." + target) for target in target_modules)
+
+
+class RoutedLoraLinear(nn.Module):
+    def __init__(self, base_layer, routing):
+        """
+        A frozen linear layer plus the LoRA weights of several adapters. The rows of the batch given to
+        RoutedLora.set_rows() go through the LoRA weights of their adapter, the frozen layer runs once for all rows.
+        """
+        super().__init__()
+        self.base_layer = base_layer
+        self.routing = routing
+        self.lora_A = nn.ModuleDict()
+        self.lora_B = nn.ModuleDict()
+        self.lora_dropout = nn.ModuleDict()
+        self.scaling = {}
+
+    def add_adapter(self, key, lora_config):
+        r = lora_config.r
+        self.lora_A[key] = nn.Linear(self.base_layer.in_features, r, bias=False)
+        self.lora_B[key] = nn.Linear(r, self.base_layer.out_features, bias=False)
+        # peft's default initialization: A like a linear layer, B zero, so a new adapter starts as a no-op
+        nn.init.kaiming_uniform_(self.lora_A[key].weight, a=math.sqrt(5))
+        nn.init.zeros_(self.lora_B[key].weight)
+        self.lora_A[key].to(self.base_layer.weight.device)
+        self.lora_B[key].to(self.base_layer.weight.device)
+        dropout = lora_config.lora_dropout
+        self.lora_dropout[key] = nn.Dropout(dropout) if dropout > 0 else nn.Identity()
+        rank = math.sqrt(r) if getattr(lora_config, "use_rslora", False) else r
+        self.scaling[key] = lora_config.lora_alpha / rank
+
+    def forward(self, x):
+        result = self.base_layer(x)
+        delta = None
+        for key, rows in self.routing.rows.items():
+            if key not in self.lora_A:
+                continue
+            x_rows = self.lora_dropout[key](x.index_select(0, rows))
+            update = self.lora_B[key](self.lora_A[key](x_rows)) * self.scaling[key]
+            delta = update.new_zeros(result.shape).index_add(0, rows, update) if delta is None \
+                else delta.index_add(0, rows, update)
+        return result if delta is None else result + delta.to(result.dtype)
+
+
+class RoutedLora:
+    def __init__(self, base_model, jobs):
+        """
+        Wraps the target modules of every job's LoRA config in RoutedLoraLinear layers and freezes the base model.
+        The rows given to set_rows() stay in effect until replaced, so the forward passes recomputed by gradient
+        checkpointing during backward route the same way.
+        :param base_model: The T5ForConditionalGeneration model, changed in place until remove().
+        :param jobs: The AdapterJobs, their keys name the adapters.
+        """
+        self.base_model = base_model
+        self.rows = {}  # Adapter key -> row indices of the current batch
+        self.layers = {}  # Module name -> RoutedLoraLinear
+        for param in base_model.parameters():
+            param.requires_grad = False
+        for name, module in list(base_model.named_modules()):
+            if not isinstance(module, nn.Linear):
+                continue
+            owners = [job for job in jobs if is_target_module(name, job.adapter.lora_config.target_modules)]
+            if not owners:
+                continue
+            layer = RoutedLoraLinear(module, self)
+            for job in owners:
+                layer.add_adapter(job.key, job.adapter.lora_config)
+            parent_name, _, child_name = name.rpartition(".")
+            setattr(base_model.get_submodule(parent_name) if parent_name else base_model, child_name, layer)
+            self.layers[name] = layer
+
+    def set_rows(self, rows):
+        """
+        :param rows: Dictionary of adapter key -> tensor of the batch rows of that adapter.
+        """
+        self.rows = rows
+
+    def parameters(self, key):
+        params = []
+        for layer in self.layers.values():
+            if key in layer.lora_A:
+                params += [layer.lora_A[key].weight, layer.lora_B[key].weight]
+        return params
+
+    def state_dict(self, key):
+        """
+        The weights of one adapter under the names peft saves a single adapter with.
+        """
+        state_dict = {}
+        for name, layer in self.layers.items():
+            if key in layer.lora_A:
+                prefix = f"base_model.model.{name}"
+                state_dict[f"{prefix}.lora_A.weight"] = layer.lora_A[key].weight.detach().contiguous()
+                state_dict[f"{prefix}.lora_B.weight"] = layer.lora_B[key].weight.detach().contiguous()
+        return state_dict
+
+    def remove(self):
+        """
+        Puts the original linear layers back.
+        """
+        for name, layer in self.layers.items():
+            parent_name, _, child_name = name.rpartition(".")
+            parent = self.base_model.get_submodule(parent_name) if parent_name else self.base_model
+            setattr(parent, child_name, layer.base_layer)
+        self.layers = {}
+        self.rows = {}
+
+
+def save_routed_adapter(routed_lora, job, base_model_name_or_path=None):
+    """
+    Saves one adapter of the routed LoRA layers as a single peft adapter: adapter_model.safetensors and
+    adapter_config.json in the adapter folder.
+    """
+    full_file_name = job.adapter.full_file_name
+    os.makedirs(full_file_name, exist_ok=True)
+    save_file(routed_lora.state_dict(job.key), os.path.join(full_file_name, "adapter_model.safetensors"))
+    config = copy.deepcopy(job.adapter.lora_config)
+    config.base_model_name_or_path = base_model_name_or_path
+    config.save_pretrained(full_file_name)
+    print(f"Saved adapter at: {full_file_name}")
+
+
+def merge_batches(batches, pad_token_id):
+    """
+    Stacks the batches of several adapters into one mixed batch, padding them to the longest input and label.
+    :return: (mixed batch, list of the row index tensors of every batch)
+    """
+    input_length = max(batch["input_ids"].shape[1] for batch in batches)
+    label_length = max(batch["labels"].shape[1] for batch in batches)
+    padding = {
+        "input_ids": (input_length, pad_token_id),
+        "attention_mask": (input_length, 0),
+        "labels": (label_length, LABEL_PAD_ID),
+        "decoder_input_ids": (label_length, pad_token_id),
+    }
+    merged = {
+        key: torch.cat([F.pad(batch[key], (0, length - batch[key].shape[1]), value=value) for batch in batches])
+        for key, (length, value) in padding.items()
+    }
+    rows, offset = [], 0
+    for batch in batches:
+        count = len(batch["input_ids"])
+        rows.append(torch.arange(offset, offset + count))
+        offset += count
+    return merged, rows
+
+
+def step_optimizer(job):
+    job.optimizer.step()
+    job.optimizer.zero_grad(set_to_none=True)
+    job.batches_since_step = 0
+
+
+def train_adapters(model, jobs, epochs=3, batch_size=2, gradient_accumulation_steps=4, num_workers=0, seed=0,
+                   precision=FP32, gradient_checkpointing=True, report_every=50, save=True):
+    """
+    Trains several adapters at once on one base model, with mixed batches.
+    :param model: The T5Model wrapper, its frozen weights are shared by all adapters. It must own its weights
+                  (not come from the shared model registry), the adapters are injected into them.
+    :param jobs: List of (Adapter, training dataset) pairs.
+    :param epochs: Passes over every adapter's training data.
+    :param batch_size: Examples per adapter in each mixed batch, a mixed batch holds up to batch_size * adapters rows.
+    :param gradient_accumulation_steps: Mixed batches per optimizer step of every adapter.
+    :param precision: "fp32" or "bf16" (see precision.py).
+    :param save: Save the trained adapters, the benchmark trains without saving.
+    """
+    if not jobs:
+        return
+    if getattr(model, "registry_key", None) is not None:
+        raise ValueError("Training changes the weights it runs on, it needs a model with private weights "
+                         "(model_registry.acquire(..., exclusive=True)), not the weights shared by the profiles.")
+    jobs = [AdapterJob(adapter, training_data, f"adapter_{i}") for i, (adapter, training_data) in enumerate(jobs)]
+    for job in jobs:
+        if isinstance(job.training_data, PackedDataset):
+            raise ValueError(f"Adapter '{job.adapter.name}': packed datasets are not supported by multi-adapter training.")
+    device = model.device
+    pad_token_id = model.tokenizer.pad_token_id
+
+    # One set of frozen weights, the LoRA weights of every adapter next to each target layer
+    model.model.to(device)
+    routed_lora = RoutedLora(model.model, jobs)
+    TrainingPlanner.set_gradient_checkpointing(model, gradient_checkpointing)
+
+    for job in jobs:
+        job.optimizer = AdamW(routed_lora.parameters(job.key), lr=1e-5)
+        job.dataloader, job.batch_sampler = job.adapter.make_dataloader(
+            model, job.training_data, batch_size=batch_size, num_workers=num_workers, seed=seed)
+        job.metrics = TrainingMetrics(report_every=report_every)
+        print(f"Training adapter '{job.adapter.name}' as {job.key}")
+
+    for epoch in range(epochs):
+        model.model.train()
+        iterators = {}
+        for job in jobs:
+            job.metrics.start_epoch(epoch)
+            if isinstance(job.training_data, IterableDataset):
+                job.training_data.set_epoch(epoch)
+            else:
+                job.batch_sampler.set_epoch(epoch)
+            iterators[job.key] = iter(job.dataloader)
+
+        # Every mixed batch takes the next batch of each adapter that has not finished its epoch
+        active = list(jobs)
+        while active:
+            batches = []
+            for job in list(active):
+                job_batch = next(iterators[job.key], None)
+                if job_batch is None:
+                    active.remove(job)
+                    if job.batches_since_step:
+                        step_optimizer(job)
+                    continue
+                batches.append((job, job_batch))
+            if not batches:
+                break
+
+            batch, rows = merge_batches([job_batch for _, job_batch in batches], pad_token_id)
+            rows = [row.to(device) for row in rows]
+            routed_lora.set_rows({job.key: row for (job, _), row in zip(batches, rows)})
+            labels = batch["labels"].to(device)
+            with autocast(device, precision):
+                logits = model.model(
+                    input_ids=batch["input_ids"].to(device),
+                    attention_mask=batch["attention_mask"].to(device),
+                    decoder_input_ids=batch["decoder_input_ids"].to(device),
+                ).logits
+            token_losses = F.cross_entropy(logits.float().reshape(-1, logits.shape[-1]), labels.reshape(-1),
+                                           ignore_index=LABEL_PAD_ID, reduction="none").view(labels.shape)
+
+            # Each adapter's loss is the mean over its own tokens, as if it had been trained alone
+            total_loss = 0.0
+            for (job, _), row in zip(batches, rows):
+                tokens = (labels.index_select(0, row) != LABEL_PAD_ID).sum().clamp(min=1)
+                loss = token_losses.index_select(0, row).sum() / tokens
+                job.metrics.update(loss)
+                total_loss = total_loss + loss
+            (total_loss / gradient_accumulation_steps).backward()
+
+            for job, _ in batches:
+                job.batches_since_step += 1
+                if job.batches_since_step == gradient_accumulation_steps:
+                    step_optimizer(job)
+
+        for job in jobs:
+            print(f"Adapter '{job.adapter.name}':")
+            job.metrics.end_epoch()
+
+    routed_lora.set_rows({})
+    if save:
+        for job in jobs:
+            save_routed_adapter(routed_lora, job, getattr(model.model, "name_or_path", None))
+    routed_lora.remove()
+    model.model.eval()
+
+
+def run_sequential_trial(data_files, epochs, batch_size):
+    """
+    Trains one adapter per data file one after the other, each with its own freshly loaded model, the way
+    separate training runs would.
+    :return: Dictionary with the mode, seconds and peak memory.
+    """
+    from src.core.adapter import Adapter
+
+    start = time.time()
+    with PeakMemoryMonitor() as monitor:
+        for i, data_file in enumerate(data_files):
+            model = T5Model(t5_dir, device="cpu")
+            adapter = Adapter(name=f"multi-adapter-benchmark-{i}")
+            training_data = adapter.prepare_data(model, data_file)
+            adapter.train_adapter(
+                model, training_data, epochs=epochs,
+                plan=TrainingPlan(batch_size=batch_size, gradient_accumulation_steps=4, gradient_checkpointing=True,
+                                  num_workers=0),
+                checkpoint_every=0, checkpoint_interval=0, save=False,
+            )
+            del model, adapter, training_data
+    return {"mode": "sequential", "seconds": time.time() - start, "peak_memory": monitor.peak}
+
+
+def run_multi_adapter_trial(data_files, epochs, batch_size):
+    """
+    Trains the same adapters as run_sequential_trial() in one train_adapters() job.
+    """
+    from src.core.adapter import Adapter
+
+    start = time.time()
+    with PeakMemoryMonitor() as monitor:
+        model = T5Model(t5_dir, device="cpu")
+        jobs = []
+        for i, data_file in enumerate(data_files):
+            adapter = Adapter(name=f"multi-adapter-benchmark-{i}")
+            jobs.append((adapter, adapter.prepare_data(model, data_file)))
+        train_adapters(model, jobs, epochs=epochs, batch_size=batch_size, gradient_accumulation_steps=4, save=False)
+    return {"mode": "multi-adapter", "seconds": time.time() - start, "peak_memory": monitor.peak}
+
+
+def benchmark_multi_adapter(data_file="training_data.json", adapters=3, epochs=1, batch_size=2):
+    """
+    Trains 'adapters' adapters on the same data once sequentially and once in one multi-adapter job, each in its
+    own process so the peak memory of one run does not include the other, and reports time and peak memory.
+    Nothing is saved.
+    :return: Dictionary of results per mode.
+    """
+    # Tokenize once here, the trial processes cannot start the pre-tokenizer's own worker processes
+    pretokenize([data_file], T5Model.load_tokenizer(t5_dir))
+    data_files = [data_file] * adapters
+    context = multiprocessing.get_context("spawn")
+    results = {}
+    for trial in (run_sequential_trial, run_multi_adapter_trial):
+        with context.Pool(1) as pool:
+            result = pool.apply(trial, (data_files, epochs, batch_size))
+        results[result["mode"]] = result
+
+    sequential, multi = results["sequential"], results["multi-adapter"]
+    print(f"{adapters} adapters, {epochs} epoch(s)")
+    print(f"{'mode':<15}{'seconds':>10}{'peak GiB':>10}")
+    for result in (sequential, multi):
+        print(f"{result['mode']:<15}{result['seconds']:>10.1f}{result['peak_memory'] / 2 ** 30:>10.2f}")
+    print(f"multi-adapter speedup: {sequential['seconds'] / multi['seconds']:.2f}x, "
+          f"memory: {multi['peak_memory'] / sequential['peak_memory']:.0%} of sequential")
+    return results
+
+
+if __name__ == "__main__":
+    from src.core.adapter import Adapter
+
+    if len(sys.argv) > 1 and sys.argv[1] == "--benchmark":
+        file_name = sys.argv[2] if len(sys.argv) > 2 else "training_data.json"
+        adapter_count = int(sys.argv[3]) if len(sys.argv) > 3 else 3
+        benchmark_multi_adapter(file_name, adapter_count)
+        sys.exit(0)
+    if len(sys.argv) < 2:
+        print("Usage: python -m src.core.multi_adapter_training <adapter name>=<training data file> ...")
+        sys.exit(1)
+    t5 = T5Model(t5_dir)
+    adapter_jobs = []
+    for argument in sys.argv[1:]:
+        name, data_file = argument.split("=", 1)
+        new_adapter = Adapter(name=name)
+        adapter_jobs.append((new_adapter, new_adapter.prepare_data(t5, data_file)))
+    train_adapters(t5, adapter_jobs)
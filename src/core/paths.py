@@ -14,4 +14,5 @@ t5_dir = os.path.join(models_dir, "t5", "safe")
 profiles_dir = os.path.join(root_dir,"profiles")
 adapters_dir = os.path.join(src_dir, "core", "adapters")
 t5_adapters_dir = os.path.join(adapters_dir, "t5")
-training_data_dir = os.path.join(src_dir,"core", "training data")
\ No newline at end of file
+training_data_dir = os.path.join(src_dir,"core", "training data")
+token_cache_dir = os.path.join(src_dir, "core", "token cache")
\ No newline at end of file
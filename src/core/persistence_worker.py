@@ -0,0 +1,192 @@
+# src/core/persistence_worker.py
+"""
+This class is responsible for writing profile and history files in the background.
+Writes are queued so the chat loop never waits on the disk, writes that arrive within a short window are
+coalesced (the newest version of a JSON file wins, appends to the same log are committed together with one fsync),
+and JSON files are replaced atomically (temporary file, fsync, rename) so a crash never leaves a truncated file.
+"""
+import atexit
+import json
+import os
+import queue
+import tempfile
+import threading
+import time
+
+REPLACE = "replace"
+APPEND = "append"
+_FLUSH = object()
+_STOP = object()
+
+
+def atomic_write_text(path, text):
+    """
+    Writes text to path so that path holds either the old or the new content, never a partial file.
+    """
+    folder = os.path.dirname(path) or "."
+    os.makedirs(folder, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp", dir=folder)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    # Make the rename itself durable, not supported on every platform
+    try:
+        dir_fd = os.open(folder, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+    except OSError:
+        pass
+
+
+def atomic_write_json(path, data, indent=4):
+    atomic_write_text(path, json.dumps(data, indent=indent))
+
+
+class PersistenceWorker:
+    def __init__(self, coalesce_window=0.25):
+        """
+        :param coalesce_window: Seconds the worker waits after the first queued write to collect more writes
+                                and commit them together.
+        """
+        self.coalesce_window = coalesce_window
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.writes = 0  # Files actually written
+        self.jobs = 0  # Writes requested
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.last_latency = 0.0
+
+    def start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name="persistence-worker", daemon=True)
+                self.thread.start()
+
+    def write_json(self, path, data, indent=4):
+        """
+        Queues an atomic replacement of a JSON file. The data is serialized now, later changes to it are not saved.
+        """
+        self.submit(REPLACE, path, json.dumps(data, indent=indent))
+
+    def write_text(self, path, text):
+        self.submit(REPLACE, path, text)
+
+    def append_line(self, path, line):
+        """
+        Queues a line to be appended to a file, e.g. a JSONL log.
+        """
+        self.submit(APPEND, path, line if line.endswith("\n") else line + "\n")
+
+    def submit(self, kind, path, payload):
+        self.start()
+        self.queue.put((kind, path, payload, time.perf_counter()))
+
+    def flush(self):
+        """
+        Blocks until every write queued so far is on disk.
+        """
+        if self.thread is None or not self.thread.is_alive():
+            return
+        self.queue.put(_FLUSH)
+        self.queue.join()
+
+    def stop(self):
+        """
+        Writes everything that is queued and stops the worker thread, registered to run at exit.
+        """
+        if self.thread is None or not self.thread.is_alive():
+            return
+        self.queue.put(_STOP)
+        self.thread.join()
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            # Collect more writes for the rest of the window, a flush or stop request ends the window early
+            deadline = time.perf_counter() + self.coalesce_window
+            while batch[-1] is not _FLUSH and batch[-1] is not _STOP:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            jobs = [job for job in batch if job is not _FLUSH and job is not _STOP]
+            try:
+                self.commit(jobs)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+            if any(job is _STOP for job in batch):
+                return
+
+    def commit(self, jobs):
+        """
+        Writes a batch of jobs, one file operation per path: a replace supersedes everything queued before it
+        for the same path and consecutive appends are written together.
+        """
+        operations = {}  # path -> list of [kind, payload]
+        for kind, path, payload, queued_at in jobs:
+            pending = operations.setdefault(path, [])
+            if kind == REPLACE:
+                pending[:] = [[REPLACE, payload]]
+            elif pending and pending[-1][0] == APPEND:
+                pending[-1][1] += payload
+            else:
+                pending.append([APPEND, payload])
+
+        for path, pending in operations.items():
+            for kind, payload in pending:
+                try:
+                    if kind == REPLACE:
+                        atomic_write_text(path, payload)
+                    else:
+                        with open(path, "a", encoding="utf-8") as f:
+                            f.write(payload)
+                            f.flush()
+                            os.fsync(f.fileno())
+                    self.writes += 1
+                except Exception as e:
+                    print(f"(file: persistence_worker.py, method: commit) Error writing {path}: {e}")
+
+        now = time.perf_counter()
+        for kind, path, payload, queued_at in jobs:
+            latency = now - queued_at
+            self.jobs += 1
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+            self.last_latency = latency
+
+    def get_stats(self):
+        return {
+            "queue_depth": self.queue.qsize(),
+            "jobs": self.jobs,
+            "writes": self.writes,
+            "coalesced": self.jobs - self.writes,
+            "avg_latency": self.total_latency / self.jobs if self.jobs else 0.0,
+            "max_latency": self.max_latency,
+            "last_latency": self.last_latency,
+        }
+
+    def print_stats(self):
+        stats = self.get_stats()
+        print(f"PersistenceWorker: queue depth {stats['queue_depth']}, {stats['jobs']} writes requested, "
+              f"{stats['writes']} committed, write latency avg {stats['avg_latency'] * 1000:.1f} ms, "
+              f"max {stats['max_latency'] * 1000:.1f} ms")
+
+
+# Process wide worker, flushed when the program exits
+persistence_worker = PersistenceWorker()
+atexit.register(persistence_worker.stop)
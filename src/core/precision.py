@@ -0,0 +1,131 @@
+# src/core/precision.py
+"""
+This file is responsible for the numeric precision of adapter training.
+With precision "bf16" the T5 forward pass (and so the backward pass of the autocast operations) runs in bfloat16
+through torch.autocast, while the LoRA weights, their gradients and the optimizer state stay in float32.
+bfloat16 has the exponent range of float32, so the loss does not need scaling the way float16 training does.
+Run the comparison with: python -m src.core.precision [training data file] [steps]
+"""
+import contextlib
+import multiprocessing
+import sys
+import time
+
+import torch
+
+from src.core.paths import t5_dir
+from src.core.pretokenizer import pretokenize
+from src.core.t5_model import T5Model
+from src.core.training_planner import PeakMemoryMonitor, TrainingPlan
+
+FP32 = "fp32"
+BF16 = "bf16"
+PRECISIONS = (FP32, BF16)
+
+# A bf16 run passes when its final loss is at most this much (relative) above the fp32 run on the same data,
+# seed and number of steps.
+BF16_LOSS_TOLERANCE = 0.05
+
+
+def autocast(device, precision=FP32):
+    """
+    Returns the context the forward pass runs in for the given precision.
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision '{precision}', expected one of {PRECISIONS}.")
+    if precision == FP32:
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16)
+
+
+def bf16_is_native():
+    """
+    True when the CPU has bfloat16 instructions (AVX512-BF16 or AMX), without them bf16 is emulated and slower.
+    """
+    check = getattr(torch.backends.mkldnn, "is_bf16_supported", None) or getattr(torch.cpu, "_is_avx512_bf16_supported", None)
+    try:
+        return bool(check()) if check else False
+    except RuntimeError:
+        return False
+
+
+def run_precision_trial(precision, data_file, steps, batch_size, seed):
+    """
+    Trains a fresh adapter for 'steps' optimizer steps with the given precision.
+    :return: Dictionary with the precision, seconds per step, peak memory and final loss.
+    """
+    from src.core.adapter import Adapter
+
+    torch.manual_seed(seed)
+    model = T5Model(t5_dir, device="cpu")
+    adapter_trainer = Adapter(name=f"precision-benchmark-{precision}")
+    training_data = adapter_trainer.prepare_data(model, data_file)
+    adapter = adapter_trainer.create_adapter(model)
+    plan = TrainingPlan(batch_size=batch_size, gradient_accumulation_steps=1, gradient_checkpointing=False, num_workers=0)
+    dataloader, batch_sampler = adapter_trainer.make_dataloader(model, training_data, plan.batch_size,
+                                                                plan.num_workers, seed=seed)
+    optimizer = torch.optim.AdamW([p for p in adapter.parameters() if p.requires_grad], lr=1e-5)
+    adapter.train()
+
+    losses, step_times = [], []
+    epoch = 0
+    with PeakMemoryMonitor() as monitor:
+        while len(losses) < steps:
+            batch_sampler.set_epoch(epoch)
+            for batch in dataloader:
+                start = time.time()
+                inputs = {key: batch[key] for key in ("input_ids", "attention_mask", "labels", "decoder_input_ids")}
+                with autocast("cpu", precision):
+                    loss = adapter(**inputs).loss
+                loss.backward()
+                optimizer.step()
+                optimizer.zero_grad()
+                losses.append(loss.item())
+                step_times.append(time.time() - start)
+                if len(losses) == steps:
+                    break
+            epoch += 1
+
+    measured = step_times[1:] or step_times  # The first step includes one-time setup
+    tail = losses[-min(10, len(losses)):]
+    return {
+        "precision": precision,
+        "step_time": sum(measured) / len(measured),
+        "peak_memory": monitor.peak,
+        "final_loss": sum(tail) / len(tail),
+    }
+
+
+def benchmark_precision(data_file="training_data.json", steps=50, batch_size=4, seed=0):
+    """
+    Trains the same adapter on the same batches in fp32 and bf16, each in its own process so the peak memory of
+    one run does not include the other, and reports step time, peak memory and final loss.
+    :return: (results per precision, True if the bf16 loss is within BF16_LOSS_TOLERANCE)
+    """
+    if not bf16_is_native():
+        print("Warning: this CPU has no native bfloat16 support, bf16 will be emulated and slower.")
+    # Tokenize once here, the trial processes cannot start the pre-tokenizer's own worker processes
+    pretokenize([data_file], T5Model.load_tokenizer(t5_dir))
+    context = multiprocessing.get_context("spawn")
+    results = {}
+    for precision in PRECISIONS:
+        with context.Pool(1) as pool:
+            results[precision] = pool.apply(run_precision_trial, (precision, data_file, steps, batch_size, seed))
+
+    fp32, bf16 = results[FP32], results[BF16]
+    print(f"{'precision':<10}{'s/step':>10}{'peak GiB':>10}{'final loss':>12}")
+    for result in (fp32, bf16):
+        print(f"{result['precision']:<10}{result['step_time']:>10.3f}{result['peak_memory'] / 2 ** 30:>10.2f}"
+              f"{result['final_loss']:>12.4f}")
+    print(f"bf16 speedup: {fp32['step_time'] / bf16['step_time']:.2f}x, "
+          f"memory: {bf16['peak_memory'] / fp32['peak_memory']:.0%} of fp32")
+
+    within_tolerance = bf16["final_loss"] <= fp32["final_loss"] * (1 + BF16_LOSS_TOLERANCE)
+    print(f"bf16 final loss {'within' if within_tolerance else 'OUTSIDE'} the {BF16_LOSS_TOLERANCE:.0%} tolerance.")
+    return results, within_tolerance
+
+
+if __name__ == "__main__":
+    file_name = sys.argv[1] if len(sys.argv) > 1 else "training_data.json"
+    step_count = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    sys.exit(0 if benchmark_precision(file_name, step_count)[1] else 1)
@@ -0,0 +1,203 @@
+# src/core/pretokenizer.py
+"""
+This file is responsible for tokenizing a training corpus once and keeping the token ids on disk.
+The entries are tokenized on a process pool and stored as flat int32 arrays (input ids, label ids) plus an index
+of offsets and lengths. The cache folder is named after a hash of the tokenizer, max_length and the data files,
+so later runs and every epoch read token ids through a memory map without tokenizing anything.
+"""
+import hashlib
+import json
+import os
+import shutil
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+from src.core.paths import token_cache_dir
+from src.core.training_data_store import TrainingDataStore
+
+INPUTS_FILE = "input_ids.bin"
+LABELS_FILE = "labels.bin"
+INDEX_FILE = "index.npy"  # Rows of (input_offset, input_length, label_offset, label_length)
+META_FILE = "meta.json"
+
+_worker_tokenizer = None
+
+
+def tokenizer_fingerprint(tokenizer):
+    """
+    Hashes everything about the tokenizer that decides the ids it produces.
+    """
+    digest = hashlib.sha256(type(tokenizer).__name__.encode("utf-8"))
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    if backend is not None:
+        digest.update(backend.to_str().encode("utf-8"))
+    else:
+        digest.update(json.dumps(sorted(tokenizer.get_vocab().items())).encode("utf-8"))
+    digest.update(json.dumps(tokenizer.special_tokens_map, sort_keys=True, default=str).encode("utf-8"))
+    digest.update(str(getattr(tokenizer, "truncation_side", "right")).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def data_fingerprint(filenames):
+    """
+    Hashes the contents of the training data files.
+    """
+    digest = hashlib.sha256()
+    for filename in filenames:
+        store = TrainingDataStore(filename)
+        store.migrate()
+        digest.update(os.path.basename(store.store_file).encode("utf-8"))
+        with open(store.store_file, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def _init_worker(tokenizer):
+    global _worker_tokenizer
+    _worker_tokenizer = tokenizer
+    torch.set_num_threads(1)
+
+
+def _tokenize_chunk(user_inputs, ai_responses, max_length):
+    inputs = _worker_tokenizer(user_inputs, add_special_tokens=True, max_length=max_length, truncation=True).input_ids
+    labels = _worker_tokenizer(ai_responses, add_special_tokens=True, max_length=max_length, truncation=True).input_ids
+    return inputs, labels
+
+
+def _iter_chunks(filenames, chunk_size):
+    user_inputs, ai_responses = [], []
+    for filename in filenames:
+        for entry in TrainingDataStore(filename).iter_entries():
+            user_inputs.append(entry["user_input"])
+            ai_responses.append(entry["ai_response"])
+            if len(user_inputs) == chunk_size:
+                yield user_inputs, ai_responses
+                user_inputs, ai_responses = [], []
+    if user_inputs:
+        yield user_inputs, ai_responses
+
+
+def pretokenize(filenames, tokenizer, max_length=512, num_workers=None, chunk_size=1024, cache_dir=token_cache_dir):
+    """
+    Tokenizes the training files into the on-disk token cache, unless the cache already holds them.
+    :param filenames: Training data file name or list of file names.
+    :param tokenizer: Tokenizer to use, it is sent once to every worker process.
+    :param max_length: Maximum number of tokens per input and label.
+    :param num_workers: Number of tokenizer processes, defaults to the number of CPUs.
+    :param chunk_size: Number of entries per task sent to a worker.
+    :return: Path of the cache folder.
+    """
+    filenames = [filenames] if isinstance(filenames, str) else list(filenames)
+    key = hashlib.sha256(
+        f"{tokenizer_fingerprint(tokenizer)}:{max_length}:{data_fingerprint(filenames)}".encode("utf-8")
+    ).hexdigest()[:32]
+    folder = os.path.join(cache_dir, key)
+    if os.path.exists(os.path.join(folder, META_FILE)):
+        print(f"Using cached token ids from {folder}")
+        return folder
+
+    num_workers = num_workers or os.cpu_count() or 1
+    temp_folder = folder + ".tmp"
+    shutil.rmtree(temp_folder, ignore_errors=True)
+    os.makedirs(temp_folder)
+    print(f"Pre-tokenizing {filenames} with {num_workers} processes into {folder}")
+
+    index = []
+    input_offset = label_offset = 0
+    with open(os.path.join(temp_folder, INPUTS_FILE), "wb") as inputs_file, \
+            open(os.path.join(temp_folder, LABELS_FILE), "wb") as labels_file, \
+            ProcessPoolExecutor(max_workers=num_workers, initializer=_init_worker, initargs=(tokenizer,)) as pool:
+        # Keep a bounded number of chunks in flight and write results in corpus order
+        in_flight = deque()
+
+        def write_result(future):
+            nonlocal input_offset, label_offset
+            inputs, labels = future.result()
+            for input_ids, label_ids in zip(inputs, labels):
+                index.append((input_offset, len(input_ids), label_offset, len(label_ids)))
+                np.asarray(input_ids, dtype=np.int32).tofile(inputs_file)
+                np.asarray(label_ids, dtype=np.int32).tofile(labels_file)
+                input_offset += len(input_ids)
+                label_offset += len(label_ids)
+
+        for user_inputs, ai_responses in _iter_chunks(filenames, chunk_size):
+            in_flight.append(pool.submit(_tokenize_chunk, user_inputs, ai_responses, max_length))
+            if len(in_flight) >= num_workers * 2:
+                write_result(in_flight.popleft())
+        while in_flight:
+            write_result(in_flight.popleft())
+
+    np.save(os.path.join(temp_folder, INDEX_FILE), np.asarray(index, dtype=np.int64).reshape(-1, 4))
+    with open(os.path.join(temp_folder, META_FILE), "w", encoding="utf-8") as f:
+        json.dump({"files": filenames, "max_length": max_length, "entries": len(index),
+                   "pad_token_id": tokenizer.pad_token_id}, f, indent=4)
+    shutil.rmtree(folder, ignore_errors=True)
+    os.replace(temp_folder, folder)
+    print(f"Pre-tokenized {len(index)} entries.")
+    return folder
+
+
+class PretokenizedDataset(Dataset):
+    def __init__(self, folder, pad_to_max_length=True):
+        """
+        Serves the entries of a token cache folder (see pretokenize()) in the same format as TextDataset.
+        :param folder: The cache folder returned by pretokenize().
+        :param pad_to_max_length: Pad every item to max_length, otherwise items are returned unpadded
+                                  (see DynamicPaddingCollator).
+        """
+        with open(os.path.join(folder, META_FILE), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        self.folder = folder
+        self.max_length = meta["max_length"]
+        self.pad_token_id = meta["pad_token_id"]
+        self.pad_to_max_length = pad_to_max_length
+        self.index = np.load(os.path.join(folder, INDEX_FILE), mmap_mode="r")
+        self.input_ids = self.open_memmap(INPUTS_FILE)
+        self.label_ids = self.open_memmap(LABELS_FILE)
+
+    def open_memmap(self, file_name):
+        path = os.path.join(self.folder, file_name)
+        if os.path.getsize(path) == 0:
+            return np.zeros(0, dtype=np.int32)
+        return np.memmap(path, dtype=np.int32, mode="r")
+
+    def __len__(self):
+        return len(self.index)
+
+    def get_ids(self, idx):
+        """
+        Returns the unpadded (input_ids, label_ids) of an entry as int64 tensors.
+        """
+        input_offset, input_length, label_offset, label_length = (int(value) for value in self.index[idx])
+        input_ids = torch.from_numpy(np.array(self.input_ids[input_offset:input_offset + input_length], dtype=np.int64))
+        label_ids = torch.from_numpy(np.array(self.label_ids[label_offset:label_offset + label_length], dtype=np.int64))
+        return input_ids, label_ids
+
+    def lengths(self):
+        """
+        Returns the number of input and label tokens of every entry, without reading the token ids.
+        """
+        return np.asarray(self.index[:, 1]), np.asarray(self.index[:, 3])
+
+    def pad(self, ids):
+        return torch.nn.functional.pad(ids, (0, self.max_length - len(ids)), value=self.pad_token_id)
+
+    def __getitem__(self, idx):
+        input_ids, label_ids = self.get_ids(idx)
+        if not self.pad_to_max_length:
+            return {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids), "labels": label_ids}
+        attention_mask = (torch.arange(self.max_length) < len(input_ids)).long()
+        labels = self.pad(label_ids)
+        # Same shift as TextDataset: labels without the last token, padded back to full length
+        decoder_input_ids = torch.nn.functional.pad(labels[:-1], (0, 1), value=self.pad_token_id)
+        return {
+            "input_ids": self.pad(input_ids),
+            "attention_mask": attention_mask,
+            "labels": labels,
+            "decoder_input_ids": decoder_input_ids,
+        }
@@ -0,0 +1,140 @@
+# src/core/response_cache.py
+"""
+This class is responsible for remembering responses of deterministic (greedy) generations.
+With greedy decoding the same weights, adapters and input ids always give the same output, so the response is
+stored under a hash of the input ids and a model fingerprint. Entries live in memory (LRU) and optionally in a
+size bounded folder on disk so they survive restarts. Sampled generations never use the cache.
+"""
+import hashlib
+import json
+import os
+from collections import OrderedDict
+
+
+class ResponseCache:
+    def __init__(self, max_entries=256, disk_dir=None, max_disk_entries=2048):
+        """
+        :param max_entries: Number of responses kept in memory, least recently used first out.
+        :param disk_dir: Folder for the on-disk tier, None keeps the cache in memory only.
+        :param max_disk_entries: Number of files kept in the disk tier, oldest first out.
+        """
+        self.max_entries = max_entries
+        self.disk_dir = disk_dir
+        self.max_disk_entries = max_disk_entries
+        self.entries = OrderedDict()  # key -> response
+        self.disk_keys = None  # key -> modification time, read from disk_dir on first use
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.bypassed = 0
+
+    @staticmethod
+    def make_key(input_ids, fingerprint):
+        """
+        Hashes the input ids together with the model fingerprint (model, adapters and generation settings).
+        """
+        digest = hashlib.sha256(json.dumps(fingerprint, sort_keys=True, default=str).encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(",".join(str(int(token_id)) for token_id in input_ids).encode("ascii"))
+        return digest.hexdigest()
+
+    def get(self, key):
+        """
+        Returns the cached response for the key or None, counting hits and misses.
+        """
+        response = self.entries.get(key)
+        if response is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return response
+        response = self.read_from_disk(key)
+        if response is not None:
+            self.store_in_memory(key, response)
+            self.hits += 1
+            self.disk_hits += 1
+            return response
+        self.misses += 1
+        return None
+
+    def put(self, key, response):
+        self.store_in_memory(key, response)
+        self.write_to_disk(key, response)
+
+    def bypass(self):
+        """
+        Records a generation that could not use the cache because it samples.
+        """
+        self.bypassed += 1
+
+    def store_in_memory(self, key, response):
+        self.entries[key] = response
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def load_disk_keys(self):
+        if self.disk_keys is None:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            entries = []
+            for file_name in os.listdir(self.disk_dir):
+                if file_name.endswith(".json"):
+                    entries.append((os.path.getmtime(os.path.join(self.disk_dir, file_name)), file_name[:-5]))
+            self.disk_keys = OrderedDict((key, mtime) for mtime, key in sorted(entries))
+        return self.disk_keys
+
+    def read_from_disk(self, key):
+        if self.disk_dir is None or key not in self.load_disk_keys():
+            return None
+        try:
+            with open(self.disk_path(key), "r", encoding="utf-8") as f:
+                return json.load(f)["response"]
+        except (OSError, ValueError, KeyError) as e:
+            print(f"(file: response_cache.py, method: read_from_disk) Dropping unreadable cache entry {key}: {e}")
+            self.disk_keys.pop(key, None)
+            return None
+
+    def write_to_disk(self, key, response):
+        if self.disk_dir is None:
+            return
+        disk_keys = self.load_disk_keys()
+        try:
+            temp_path = self.disk_path(key) + ".tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump({"response": response}, f)
+            os.replace(temp_path, self.disk_path(key))
+        except OSError as e:
+            print(f"(file: response_cache.py, method: write_to_disk) Error writing cache entry: {e}")
+            return
+        disk_keys[key] = os.path.getmtime(self.disk_path(key))
+        disk_keys.move_to_end(key)
+        while len(disk_keys) > self.max_disk_entries:
+            old_key, _ = disk_keys.popitem(last=False)
+            try:
+                os.remove(self.disk_path(old_key))
+            except OSError:
+                pass
+
+    def clear(self):
+        self.entries.clear()
+        if self.disk_dir is not None:
+            for key in list(self.load_disk_keys()):
+                try:
+                    os.remove(self.disk_path(key))
+                except OSError:
+                    pass
+            self.disk_keys.clear()
+
+    def get_stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "disk_entries": len(self.disk_keys) if self.disk_keys is not None else None,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "bypassed": self.bypassed,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,177 @@
+# src/core/sequence_packing.py
+"""
+This file is responsible for packing several short training examples into one T5 sequence.
+PackedDataset concatenates (user_input, ai_response) pairs until the encoder or decoder sequence is full and records
+which example every token belongs to (segment ids, 0 is padding). PackedAttention adds block-diagonal masks to the
+T5 attention layers, so the tokens of an example only attend to tokens of the same example, in the encoder, the
+decoder and the cross attention. T5 uses relative position biases, so an example sees the same positions packed
+as it does alone.
+"""
+import random
+
+import torch
+from torch.utils.data import Dataset
+from transformers.models.t5.modeling_t5 import T5Attention
+
+from src.core.batching import LABEL_PAD_ID
+
+
+class PackedDataset(Dataset):
+    def __init__(self, dataset, max_length=512, shuffle=True, seed=0, open_packs=64):
+        """
+        :param dataset: Dataset returning unpadded items (see prepare_data(dynamic_padding=True)), with lengths().
+        :param max_length: Maximum number of encoder tokens and of decoder tokens per pack.
+        :param shuffle: Pack the examples in a random order instead of the dataset order.
+        :param seed: Seed of that order.
+        :param open_packs: Number of recent packs an example is tried against before a new pack is started.
+        """
+        self.dataset = dataset
+        self.max_length = max_length
+        self.pad_token_id = dataset.pad_token_id if hasattr(dataset, "pad_token_id") else dataset.tokenizer.pad_token_id
+        self.packs = self.make_packs(*dataset.lengths(), shuffle, seed, open_packs)
+        self.pad_to_max_length = False
+
+    def make_packs(self, input_lengths, label_lengths, shuffle, seed, open_packs):
+        """
+        First fit over the last open_packs packs, an example goes into the first pack with room for both
+        its input and its labels.
+        """
+        order = list(range(len(input_lengths)))
+        if shuffle:
+            random.Random(seed).shuffle(order)
+        packs = []  # [indices, input_tokens, label_tokens]
+        for idx in order:
+            input_length = min(int(input_lengths[idx]), self.max_length)
+            label_length = min(int(label_lengths[idx]), self.max_length)
+            for pack in packs[-open_packs:]:
+                if pack[1] + input_length <= self.max_length and pack[2] + label_length <= self.max_length:
+                    pack[0].append(idx)
+                    pack[1] += input_length
+                    pack[2] += label_length
+                    break
+            else:
+                packs.append([[idx], input_length, label_length])
+        print(f"Packed {len(order)} examples into {len(packs)} sequences.")
+        return [pack[0] for pack in packs]
+
+    def __len__(self):
+        return len(self.packs)
+
+    def __getitem__(self, idx):
+        input_ids, labels, encoder_segments, decoder_segments = [], [], [], []
+        for segment, example_idx in enumerate(self.packs[idx], start=1):
+            item = self.dataset[example_idx]
+            input_ids.append(item["input_ids"][:self.max_length])
+            labels.append(item["labels"][:self.max_length])
+            encoder_segments.append(torch.full((len(input_ids[-1]),), segment, dtype=torch.long))
+            decoder_segments.append(torch.full((len(labels[-1]),), segment, dtype=torch.long))
+        input_ids = torch.cat(input_ids)
+        labels = torch.cat(labels)
+        return {
+            "input_ids": input_ids,
+            "attention_mask": torch.ones_like(input_ids),
+            "labels": labels,
+            # Same decoder inputs as TextDataset gives an example on its own
+            "decoder_input_ids": labels.clone(),
+            "encoder_segment_ids": torch.cat(encoder_segments),
+            "decoder_segment_ids": torch.cat(decoder_segments),
+        }
+
+
+class PackedCollator:
+    def __init__(self, pad_token_id):
+        """
+        Pads packs to the longest pack of the batch.
+        """
+        self.pad_token_id = pad_token_id
+        self.pad_values = {
+            "input_ids": pad_token_id,
+            "attention_mask": 0,
+            "labels": LABEL_PAD_ID,
+            "decoder_input_ids": pad_token_id,
+            "encoder_segment_ids": 0,
+            "decoder_segment_ids": 0,
+        }
+
+    def __call__(self, items):
+        batch = {}
+        for key, value in self.pad_values.items():
+            length = max(len(item[key]) for item in items)
+            batch[key] = torch.stack([
+                torch.nn.functional.pad(item[key], (0, length - len(item[key])), value=value) for item in items
+            ])
+        return batch
+
+
+def segment_mask(query_segments, key_segments, causal=False):
+    """
+    Returns a (batch, 1, query, key) boolean mask allowing attention only inside the same segment.
+    Padding queries (segment 0) keep their usual mask, so no row is fully masked.
+    """
+    allowed = query_segments[:, :, None] == key_segments[:, None, :]
+    allowed |= (query_segments == 0)[:, :, None]
+    if causal:
+        query_length, key_length = allowed.shape[1:]
+        allowed &= torch.ones(query_length, key_length, dtype=torch.bool, device=allowed.device).tril()
+    return allowed[:, None]
+
+
+class PackedAttention:
+    def __init__(self, model):
+        """
+        Registers the block-diagonal masking on every T5Attention module of a (peft) T5 model.
+        The masks follow the segment ids given to set_segments(), which stay in effect until replaced, so the forward
+        passes recomputed by gradient checkpointing during backward use the same masks.
+        """
+        self.encoder_segments = None
+        self.decoder_segments = None
+        self.masks = {}
+        self.handles = []
+        for name, module in model.named_modules():
+            if not isinstance(module, T5Attention):
+                continue
+            if "EncDecAttention" in name:
+                kind = "cross"
+            elif ".decoder." in f".{name}":
+                kind = "decoder"
+            else:
+                kind = "encoder"
+            self.handles.append(module.register_forward_pre_hook(self.make_hook(kind), with_kwargs=True))
+
+    def set_segments(self, encoder_segments, decoder_segments):
+        self.encoder_segments = encoder_segments
+        self.decoder_segments = decoder_segments
+        self.masks = {}
+
+    def get_mask(self, kind):
+        if kind not in self.masks:
+            if kind == "encoder":
+                self.masks[kind] = segment_mask(self.encoder_segments, self.encoder_segments)
+            elif kind == "decoder":
+                self.masks[kind] = segment_mask(self.decoder_segments, self.decoder_segments, causal=True)
+            else:
+                self.masks[kind] = segment_mask(self.decoder_segments, self.encoder_segments)
+        return self.masks[kind]
+
+    def make_hook(self, kind):
+        def hook(module, args, kwargs):
+            if self.encoder_segments is None:
+                return None
+            hidden_states = args[0] if args else kwargs["hidden_states"]
+            allowed = self.get_mask(kind)
+            mask = kwargs.get("mask")
+            if mask is not None and mask.dtype == torch.bool:
+                kwargs["mask"] = mask & allowed
+            else:
+                dtype = hidden_states.dtype if mask is None else mask.dtype
+                min_value = torch.finfo(dtype).min
+                block_mask = torch.zeros(allowed.shape, dtype=dtype, device=allowed.device).masked_fill(~allowed, min_value)
+                kwargs["mask"] = block_mask if mask is None else torch.clamp(mask + block_mask, min=min_value)
+            return args, kwargs
+        return hook
+
+    def remove(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+        self.set_segments(None, None)
@@ -0,0 +1,87 @@
+# src/core/stopping_criteria.py
+"""
+This class is responsible for ending generation when the AI's turn is over.
+Instead of letting the model run to its token limit and trimming the text afterwards, decoding stops as soon as
+the output starts the user's turn ("<user name>:" or "### USER") or starts repeating a sentence.
+T5's SentencePiece vocabulary has no newline token, so layout such as blank lines never shows up in its output and
+cannot mark the end of a turn.
+"""
+import re
+
+import torch
+from transformers import StoppingCriteria
+
+
+class EndOfTurnCriteria(StoppingCriteria):
+    def __init__(self, tokenizer, user_name, window=96, start_length=1, min_sentence_length=12):
+        """
+        :param tokenizer: Tokenizer used to decode the generated ids.
+        :param user_name: Name of the user, "<user_name>:" marks the start of the user's turn.
+        :param window: Number of most recent tokens decoded on every step.
+        :param start_length: Number of ids the decoder starts with (the decoder start token for T5).
+        :param min_sentence_length: Shorter sentences are not considered when looking for repetition loops.
+        """
+        self.tokenizer = tokenizer
+        self.window = window
+        self.start_length = start_length
+        self.min_sentence_length = min_sentence_length
+        self.markers = {
+            "user_turn": re.compile(rf"\b{re.escape(user_name)}\s*:") if user_name else None,
+            "user_marker": re.compile(r"###\s*USER"),
+        }
+        # Longest text that may be the beginning of a marker, used to hold back streamed text
+        self.holdback = max(len(user_name) + 1, len("### USER"))
+        self.stop_reason = None
+        self.generated_tokens = 0
+
+    def __call__(self, input_ids, scores, **kwargs):
+        self.generated_tokens = input_ids.shape[-1] - self.start_length
+        text = self.tokenizer.decode(input_ids[0][-self.window:], skip_special_tokens=True)
+        self.stop_reason = self.find_stop(text)[1]
+        return torch.full((input_ids.shape[0],), self.stop_reason is not None, dtype=torch.bool, device=input_ids.device)
+
+    def find_stop(self, text):
+        """
+        Finds where the AI's turn ends in the text.
+        :return: (index, reason) of the earliest end-of-turn signal, (None, None) if there is none.
+        """
+        found = []
+        for reason, pattern in self.markers.items():
+            if pattern is None:
+                continue
+            match = pattern.search(text)
+            if match:
+                found.append((match.start(), reason))
+        repeat_start = self.find_repeated_sentence(text)
+        if repeat_start is not None:
+            found.append((repeat_start, "repetition"))
+        return min(found) if found else (None, None)
+
+    def find_repeated_sentence(self, text):
+        """
+        Returns the start of the first complete sentence that repeats an earlier one, or None.
+        """
+        seen = set()
+        for match in re.finditer(r"[^.!?]+[.!?]", text):
+            sentence = " ".join(match.group().lower().split())
+            if len(sentence) < self.min_sentence_length:
+                continue
+            if sentence in seen:
+                return match.start() + len(match.group()) - len(match.group().lstrip())
+            seen.add(sentence)
+        return None
+
+    def trim(self, text):
+        """
+        Cuts the text at the end of the AI's turn.
+        """
+        index = self.find_stop(text)[0]
+        return text if index is None else text[:index]
+
+    def tokens_saved(self, max_new_tokens):
+        """
+        Number of tokens the model did not have to generate because the turn ended early.
+        """
+        if self.stop_reason is None:
+            return 0
+        return max(max_new_tokens - self.generated_tokens, 0)
@@ -0,0 +1,105 @@
+# src/core/streaming_text_dataset.py
+"""
+This class is responsible for feeding training files that do not fit in memory to an Adapter.
+Entries are read lazily from one or more JSONL shards (see TrainingDataStore), mixed through a shuffle buffer
+and tokenized in small batches. With several DataLoader workers every worker takes a fixed share of the entries,
+so each entry is seen exactly once per epoch and the split is the same on every run.
+"""
+import json
+import random
+
+from torch.utils.data import IterableDataset, get_worker_info
+
+from src.core.text_dataset import TextDataset
+from src.core.training_data_store import TrainingDataStore
+
+
+class StreamingTextDataset(IterableDataset):
+    def __init__(self, shards, tokenizer, max_length=512, shuffle_buffer=10000, seed=0, tokenize_batch_size=64,
+                 pad_to_max_length=True):
+        """
+        :param shards: Training data file names (see TrainingDataStore) read in order, or shuffled when shuffling.
+        :param tokenizer: Tokenizer used to encode the entries.
+        :param max_length: Maximum number of tokens per input and label.
+        :param shuffle_buffer: Number of entries mixed in memory, 0 keeps the file order.
+        :param seed: Base seed of the shuffling, combined with the epoch (see set_epoch()).
+        :param tokenize_batch_size: Number of entries tokenized per tokenizer call.
+        :param pad_to_max_length: Pad every item to max_length, otherwise items are returned unpadded
+                                  (see DynamicPaddingCollator).
+        """
+        self.shards = [shards] if isinstance(shards, str) else list(shards)
+        self.encoder = TextDataset([], tokenizer, max_length, pad_to_max_length)
+        self.pad_to_max_length = pad_to_max_length
+        self.tokenizer = tokenizer
+        self.max_length = max_length
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch = 0
+        self.tokenize_batch_size = tokenize_batch_size
+
+    def set_epoch(self, epoch):
+        """
+        Changes the shuffle order for the next pass, call it before iterating each epoch.
+        """
+        self.epoch = epoch
+
+    def get_worker_split(self):
+        worker_info = get_worker_info()
+        if worker_info is None:
+            return 0, 1
+        return worker_info.id, worker_info.num_workers
+
+    def iter_entries(self, shard_order, worker_id, num_workers):
+        """
+        Yields this worker's share of the entries, every num_workers-th entry starting at worker_id.
+        Lines of the other workers are skipped without being parsed.
+        """
+        index = 0
+        for shard in shard_order:
+            store = TrainingDataStore(shard)
+            store.migrate()
+            with open(store.store_file, "r", encoding="utf-8") as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    if index % num_workers == worker_id:
+                        try:
+                            yield json.loads(line)
+                        except json.JSONDecodeError:
+                            print(f"Warning: skipping damaged line in {store.store_file}")
+                    index += 1
+
+    def shuffled(self, entries, rng):
+        """
+        Mixes the entries through a fixed size buffer, memory use is bounded by shuffle_buffer.
+        """
+        buffer = []
+        for entry in entries:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(entry)
+                continue
+            position = rng.randrange(len(buffer))
+            yield buffer[position]
+            buffer[position] = entry
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def __iter__(self):
+        worker_id, num_workers = self.get_worker_split()
+        shard_order = list(self.shards)
+        if self.shuffle_buffer > 0:
+            # Same shard order in every worker, a different mixing stream per worker
+            random.Random(self.seed + self.epoch).shuffle(shard_order)
+            rng = random.Random((self.seed + self.epoch) * 1000003 + worker_id)
+            entries = self.shuffled(self.iter_entries(shard_order, worker_id, num_workers), rng)
+        else:
+            entries = self.iter_entries(shard_order, worker_id, num_workers)
+
+        batch = []
+        for entry in entries:
+            batch.append(entry)
+            if len(batch) == self.tokenize_batch_size:
+                yield from self.encoder.encode_items(batch)
+                batch = []
+        if batch:
+            yield from self.encoder.encode_items(batch)
@@ -1,29 +1,72 @@
 # src/core/t5_model.py
 import os.path
+import threading
+import time
 
-from transformers import T5ForConditionalGeneration, T5Tokenizer
+from transformers import T5ForConditionalGeneration, T5Tokenizer, T5TokenizerFast, TextIteratorStreamer, StoppingCriteriaList
 import torch
 import re
 from peft import PeftModel, PeftConfig, get_peft_model
 from src.core.paths import t5_adapters_dir
+from src.core.generation_policy import default_generation_policy, GREEDY, SHORT_CONTEXT
+from src.core.stopping_criteria import EndOfTurnCriteria
+from src.core.continual_trainer import PROFILE_ADAPTER_PREFIX
 
 
 class T5Model:
-    def __init__(self, model_dir, ai_profile_name="", user_profile_name="", device="cuda" if torch.cuda.is_available() else "cpu"):
+    def __init__(self, model_dir, ai_profile_name="", user_profile_name="", device="cuda" if torch.cuda.is_available() else "cpu", tokenizer=None, model=None):
         """
         Initialize the T5 model and tokenizer.
         :param model_dir: Path to the directory containing the model files.
         :param device: Device to run the model on (CPU or GPU).
+        :param tokenizer: Already loaded tokenizer to share (see ModelRegistry), loaded from model_dir if None.
+        :param model: Already loaded weights to share (see ModelRegistry), loaded from model_dir if None.
         """
         self.device = device
-        self.tokenizer = T5Tokenizer.from_pretrained(model_dir, local_files_only=True, legacy=False)
-        self.model = T5ForConditionalGeneration.from_pretrained(model_dir, local_files_only=True)
-        self.model.to(self.device)
+        self.model_dir = model_dir
+        self.tokenizer = tokenizer if tokenizer is not None else self.load_tokenizer(model_dir)
+        self.model = model if model is not None else self.load_weights(model_dir, self.device)
+        self.registry_key = None
         self.ai_profile_name = ai_profile_name
         self.user_profile_name = user_profile_name
         self.adapters_path = t5_adapters_dir
         self.active_adapters = []
         self.active_peft_models = {}
+        self.last_generation_metrics = {}
+        self.response_cache = None  # Optional ResponseCache for greedy generations
+        self.profile_adapter = None  # Name of this profile's adapter on the shared weights (see swap_profile_adapter())
+        self.profile_adapter_path = None
+
+    @staticmethod
+    def load_tokenizer(model_dir):
+        """
+        Loads the Rust backed fast tokenizer from the model's tokenizer.json.
+        """
+        return T5TokenizerFast.from_pretrained(model_dir, local_files_only=True, legacy=False)
+
+    @staticmethod
+    def load_slow_tokenizer(model_dir):
+        """
+        Loads the SentencePiece tokenizer, only used to check the fast tokenizer against it.
+        """
+        return T5Tokenizer.from_pretrained(model_dir, local_files_only=True, legacy=False)
+
+    @staticmethod
+    def load_weights(model_dir, device, dtype=None):
+        model = T5ForConditionalGeneration.from_pretrained(model_dir, local_files_only=True, torch_dtype=dtype)
+        model.to(device)
+        return model
+
+    @property
+    def max_input_length(self):
+        """
+        Maximum number of input tokens, T5 has relative positions so the tokenizer's limit is used (512 by default).
+        """
+        limit = self.tokenizer.model_max_length
+        return limit if limit and limit < 100000 else 512
+
+    def count_tokens(self, text, add_special_tokens=True):
+        return len(self.tokenizer(text, add_special_tokens=add_special_tokens).input_ids)
 
     def check_for_cuda(self):
         print(f"Cuda is available?: {torch.cuda.is_available()}")
@@ -74,41 +117,271 @@ class T5Model:
         if self.active_adapters:
             self.model.set_active_adapters(self.active_adapters)
 
-    def generate_response(self, prompt, context="", max_length=600):
+    def activate_profile_adapter(self):
+        """
+        The weights may be shared with other profiles (see ModelRegistry), so the profile's own adapter is
+        switched on before each generation and adapters are switched off for profiles without one.
+        """
+        if not getattr(self.model, "_hf_peft_config_loaded", False):
+            return
+        if self.profile_adapter is not None:
+            self.model.set_adapter(self.profile_adapter)
+            self.model.enable_adapters()
+        elif any(name.startswith(PROFILE_ADAPTER_PREFIX) for name in self.model.active_adapters()):
+            self.model.disable_adapters()
+
+    def swap_profile_adapter(self, full_file_name, adapter_name):
+        """
+        Loads a new version of the profile's adapter next to the current one, switches to it and removes the old
+        one, so a generation never runs on a partly loaded adapter.
+        :param full_file_name: Folder of the adapter (adapter_config.json and adapter_model.safetensors).
+        :param adapter_name: Unique name of this version, e.g. the profile and version number.
+        """
+        # Already on the shared weights when another wrapper of this profile loaded it
+        if adapter_name not in getattr(self.model, "peft_config", {}):
+            self.model.load_adapter(full_file_name, adapter_name=adapter_name)
+        previous = self.profile_adapter
+        self.profile_adapter = adapter_name
+        self.profile_adapter_path = full_file_name
+        self.activate_profile_adapter()
+        if previous is not None and previous != adapter_name:
+            self.model.delete_adapter(previous)
+        print(f"Switched {self.ai_profile_name} to adapter {adapter_name}")
+
+    def build_input_text(self, prompt, context=""):
+        """
+        Wraps the prompt and context in the template the model is prompted with.
+        """
+        if context == "":
+            context = "Answer as a helpful AI assistant:"
+        head, middle, tail = self.prompt_fragments()
+        return f"{head}{context}{middle}{prompt}{tail}"
+
+    def prompt_fragments(self):
+        """
+        Returns the fixed (head, middle, tail) text of the input template, around the context and the prompt.
+        """
+        return "### CONTEXT:\n", f"\n\n### USER: {self.user_profile_name} asks: ", "\n\n### RESPONSE: Please reply appropriately."
+
+    def clean_response(self, response):
+        """
+        Removes name prefixes and newlines from a decoded response.
+        """
+        response = re.sub(rf"^\s*({self.ai_profile_name}|{self.user_profile_name}):\s*", "",
+                          response).strip()  # Remove unwanted name prefixes
+        response = re.sub(r"\n+", " ", response).strip()  # Remove multiple newlines and excess spaces
+        return response
+
+    def generate_response(self, prompt, context="", max_length=600, policy=None, input_ids=None):
         """
         Generate a response based on the input prompt.
+        Empty answers are retried within the limits of the generation policy, escalating from greedy decoding
+        to sampling and then to a shorter context. The encoded prompt is reused by retries on the same context.
         :param prompt: Input text.
         :param context: Input text to provide a better response from the model
         :param max_length: Maximum length of the generated response.
-        :return: Generated response as a string.
+        :param policy: GenerationPolicy bounding attempts, time and new tokens, defaults to default_generation_policy.
+        :param input_ids: Already tokenized input for prompt and context (see ContextAssembler), skips tokenization.
+        :return: Generated response as a string, empty if every attempt failed.
         """
-        if context == "":
-            context = "Answer as a helpful AI assistant:"
+        policy = policy if policy is not None else default_generation_policy
+        deadline = time.monotonic() + policy.deadline
+        self.activate_profile_adapter()
+        encoded = {}  # context -> (attention_mask, encoder_outputs), so retries skip the encoder
+        max_new_tokens = min(policy.max_new_tokens, max_length)
 
-        # Prepare input text
-        input_text = f"### CONTEXT:\n{context}\n\n### USER: {self.user_profile_name} asks: {prompt}\n\n### RESPONSE: Please reply appropriately."
+        cache_key = None
+        if self.response_cache is not None:
+            if policy.strategy_for(0) == GREEDY:
+                if input_ids is None:
+                    input_ids = self.tokenize_for_generation(self.build_input_text(prompt, context))
+                cache_key = self.response_cache.make_key(input_ids, self.fingerprint(max_new_tokens))
+                cached = self.response_cache.get(cache_key)
+                if cached is not None:
+                    self.last_generation_metrics = {"streamed": False, "cached": True, "attempts": 0}
+                    return cached
+            else:
+                self.response_cache.bypass()
 
-        inputs = self.tokenizer(input_text, return_tensors="pt", padding=True, truncation=True).to(self.device)
+        for attempt in range(policy.max_attempts):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                print(f"Generation deadline of {policy.deadline}s reached after {attempt} attempt(s).")
+                break
+            strategy = policy.strategy_for(attempt)
+            attempt_context = policy.shorten_context(context) if strategy == SHORT_CONTEXT else context
+            if attempt_context not in encoded:
+                if input_ids is not None and attempt_context == context:
+                    encoded[attempt_context] = self.encode(input_ids=input_ids)
+                else:
+                    encoded[attempt_context] = self.encode(self.build_input_text(prompt, attempt_context))
+            attention_mask, encoder_outputs = encoded[attempt_context]
+            end_of_turn = self.make_stopping_criteria()
 
-        # Keep generating until we get a non-empty response
-        while True:
+            attempt_start = time.monotonic()
             output_ids = self.model.generate(
-                inputs.input_ids,
-                max_length=max_length,
+                encoder_outputs=encoder_outputs,
+                attention_mask=attention_mask,
+                max_new_tokens=max_new_tokens,
+                max_time=remaining,
                 num_return_sequences=1,
-                #temperature=0.5,
-                #top_p=0.35,
-                #repetition_penalty=5.0,
-                do_sample=False
+                stopping_criteria=StoppingCriteriaList([end_of_turn]),
+                **policy.decoding_kwargs(strategy)
             )
 
-            response = self.tokenizer.decode(output_ids[0], skip_special_tokens=True).strip()
-            response = re.sub(rf"^({self.ai_profile_name}|{self.user_profile_name}):\s*", "",
-                              response).strip()  # Remove unwanted name prefixes
-            response = re.sub(r"\n+", " ", response).strip()  # Remove multiple newlines and excess spaces
+            response = self.tokenizer.batch_decode(output_ids, skip_special_tokens=True)[0].strip()
+            response = self.clean_response(end_of_turn.trim(response))
+            self.last_generation_metrics = {
+                "streamed": False,
+                "attempts": attempt + 1,
+                "generated_tokens": end_of_turn.generated_tokens,
+                "stop_reason": end_of_turn.stop_reason,
+                "tokens_saved": end_of_turn.tokens_saved(max_new_tokens),
+            }
 
             # If the response is not empty, return it
             if response:
+                # Only complete greedy outputs are reproducible, a run cut short by the deadline is not
+                if cache_key is not None and strategy == GREEDY and time.monotonic() - attempt_start < remaining:
+                    self.response_cache.put(cache_key, response)
                 return response
-            else:
-                print("Generated an invalid response, retrying...")
+            print(f"Generated an invalid response with {strategy} decoding, retrying...")
+        print("Giving up on this response, the generation policy is exhausted.")
+        return ""
+
+    def fingerprint(self, max_new_tokens):
+        """
+        Identifies everything besides the input ids that decides a greedy output: the weights, the active adapters
+        (with their modification times, so a retrained adapter is a different model), the profile adapter version,
+        the names used by the stopping criteria and cleanup, and the token budget.
+        """
+        adapters = [
+            (adapter, os.path.getmtime(adapter) if os.path.exists(adapter) else None) for adapter in self.active_adapters
+        ]
+        return {
+            "model": self.registry_key or self.model_dir,
+            "adapters": adapters,
+            "profile_adapter": self.profile_adapter,
+            "ai_profile_name": self.ai_profile_name,
+            "user_profile_name": self.user_profile_name,
+            "max_new_tokens": max_new_tokens,
+        }
+
+    def make_stopping_criteria(self):
+        """
+        Returns a fresh EndOfTurnCriteria for one generate() call, it keeps state about the run.
+        """
+        return EndOfTurnCriteria(self.tokenizer, self.user_profile_name)
+
+    def tokenize_for_generation(self, input_text):
+        """
+        Returns the token ids of a generation input. If it ever overflows, the oldest context is dropped instead of
+        the question at the end. The shared tokenizer itself keeps truncating on the right, which training relies on.
+        """
+        input_ids = self.tokenizer(input_text).input_ids
+        limit = self.max_input_length
+        return input_ids[-limit:] if len(input_ids) > limit else input_ids
+
+    def tokenize_input(self, input_text=None, input_ids=None):
+        """
+        Returns (input_ids, attention_mask) tensors for either the input text or already tokenized ids.
+        """
+        if input_ids is None:
+            input_ids = self.tokenize_for_generation(input_text)
+        input_ids = torch.tensor([list(input_ids)], dtype=torch.long, device=self.device)
+        return input_ids, torch.ones_like(input_ids)
+
+    def encode(self, input_text=None, input_ids=None):
+        """
+        Tokenizes the input text (unless input_ids are given) and runs the encoder once.
+        :return: (attention_mask, encoder_outputs) ready to be passed to generate().
+        """
+        input_ids, attention_mask = self.tokenize_input(input_text, input_ids)
+        with torch.no_grad():
+            encoder_outputs = self.model.get_encoder()(
+                input_ids=input_ids, attention_mask=attention_mask, return_dict=True
+            )
+        return attention_mask, encoder_outputs
+
+    def generate_response_stream(self, prompt, context="", max_length=600, policy=None, input_ids=None):
+        """
+        Generate a response like generate_response(), yielding the decoded text piece by piece as it is produced.
+        The pieces are raw model output cut at the end of the AI's turn, pass their concatenation through
+        clean_response() for the final text. Timings of the run (time_to_first_token, total_time, in seconds) and
+        the tokens saved by stopping at the end of the turn are stored in self.last_generation_metrics.
+        :param prompt: Input text.
+        :param context: Input text to provide a better response from the model
+        :param max_length: Maximum length of the generated response.
+        :param policy: GenerationPolicy whose token budget and deadline bound the run, no retries are made here.
+        :param input_ids: Already tokenized input for prompt and context (see ContextAssembler), skips tokenization.
+        """
+        policy = policy if policy is not None else default_generation_policy
+        if input_ids is None:
+            model_input_ids, attention_mask = self.tokenize_input(self.build_input_text(prompt, context))
+        else:
+            model_input_ids, attention_mask = self.tokenize_input(input_ids=input_ids)
+        max_new_tokens = min(policy.max_new_tokens, max_length)
+        self.activate_profile_adapter()
+
+        # Streaming always decodes greedily, so a cached response can be replayed at once
+        cache_key = None
+        if self.response_cache is not None:
+            cache_key = self.response_cache.make_key(model_input_ids[0].tolist(), self.fingerprint(max_new_tokens))
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                self.last_generation_metrics = {"time_to_first_token": 0.0, "total_time": 0.0, "streamed": True,
+                                                "cached": True}
+                yield cached
+                return
+
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        end_of_turn = self.make_stopping_criteria()
+
+        def run_generate():
+            try:
+                self.model.generate(
+                    model_input_ids,
+                    attention_mask=attention_mask,
+                    max_new_tokens=max_new_tokens,
+                    max_time=policy.deadline,
+                    num_return_sequences=1,
+                    do_sample=False,
+                    streamer=streamer,
+                    stopping_criteria=StoppingCriteriaList([end_of_turn]),
+                )
+            except Exception as e:
+                print(f"(file: t5_model.py, method: generate_response_stream) Error during generation: {e}")
+                streamer.end()  # Unblock the consumer
+
+        start_time = time.perf_counter()
+        self.last_generation_metrics = {"time_to_first_token": None, "total_time": None, "streamed": True}
+        thread = threading.Thread(target=run_generate, name="t5-generate", daemon=True)
+        thread.start()
+        raw_response = ""
+        yielded = 0
+        for text in streamer:
+            if not text:
+                continue
+            if self.last_generation_metrics["time_to_first_token"] is None:
+                self.last_generation_metrics["time_to_first_token"] = time.perf_counter() - start_time
+            raw_response += text
+            # Hold back the tail, it could be the beginning of an end-of-turn marker
+            end = end_of_turn.find_stop(raw_response)[0]
+            safe_end = end if end is not None else max(len(raw_response) - end_of_turn.holdback, yielded)
+            if safe_end > yielded:
+                yield raw_response[yielded:safe_end]
+                yielded = safe_end
+        thread.join()
+        final_text = end_of_turn.trim(raw_response)
+        if len(final_text) > yielded:
+            yield final_text[yielded:]
+        total_time = time.perf_counter() - start_time
+        response = self.clean_response(final_text)
+        if cache_key is not None and response and total_time < policy.deadline:
+            self.response_cache.put(cache_key, response)
+        self.last_generation_metrics.update({
+            "total_time": total_time,
+            "generated_tokens": end_of_turn.generated_tokens,
+            "stop_reason": end_of_turn.stop_reason,
+            "tokens_saved": end_of_turn.tokens_saved(max_new_tokens),
+        })
@@ -8,20 +8,48 @@ import torch
 from torch.utils.data import Dataset, DataLoader
 
 class TextDataset(Dataset):
-    def __init__(self, data, tokenizer, max_length=512):
+    def __init__(self, data, tokenizer, max_length=512, pad_to_max_length=True):
+        """
+        :param pad_to_max_length: Pad every item to max_length, otherwise items are returned unpadded
+                                  (without decoder_input_ids) for DynamicPaddingCollator to pad per batch.
+        """
         self.data = data
         self.tokenizer = tokenizer
         self.max_length = max_length
+        self.pad_to_max_length = pad_to_max_length
 
     def __len__(self):
         return len(self.data)
 
     def __getitem__(self, idx):
-        item = self.data[idx]
+        return self.__getitems__([idx])[0]
 
-        # Tokenize user input
+    def __getitems__(self, indices):
+        """
+        Tokenizes all items of a batch with one call to the (fast) tokenizer, used by DataLoader for batched fetching.
+        """
+        return self.encode_items([self.data[idx] for idx in indices])
+
+    def lengths(self):
+        """
+        Returns the number of input and label tokens of every item, used to bucket items of similar length.
+        """
+        input_lengths = [len(ids) for ids in self.tokenizer(
+            [item['user_input'] for item in self.data], max_length=self.max_length, truncation=True).input_ids]
+        label_lengths = [len(ids) for ids in self.tokenizer(
+            [item['ai_response'] for item in self.data], max_length=self.max_length, truncation=True).input_ids]
+        return input_lengths, label_lengths
+
+    def encode_items(self, items):
+        """
+        Turns a list of {'user_input', 'ai_response'} entries into model inputs, tokenized in one call per field.
+        """
+        if not self.pad_to_max_length:
+            return self.encode_items_unpadded(items)
+
+        # Tokenize user inputs
         encoding = self.tokenizer(
-            item['user_input'],
+            [item['user_input'] for item in items],
             add_special_tokens=True,
             max_length=self.max_length,
             padding='max_length',
@@ -30,9 +58,9 @@ class TextDataset(Dataset):
             return_tensors='pt'
         )
 
-        # Tokenize AI response (for labels and decoder input)
+        # Tokenize AI responses (for labels and decoder input)
         label_encoding = self.tokenizer(
-            item['ai_response'],
+            [item['ai_response'] for item in items],
             add_special_tokens=True,
             max_length=self.max_length,
             padding='max_length',
@@ -41,10 +69,10 @@ class TextDataset(Dataset):
         )
 
         # Prepare inputs and labels
-        input_ids = encoding['input_ids'].squeeze(0)  # Remove batch dimension
-        attention_mask = encoding['attention_mask'].squeeze(0)
-        labels = label_encoding['input_ids'].squeeze(0)
-        decoder_input_ids = label_encoding['input_ids'][:, :-1].squeeze(0)  # Shift labels left
+        input_ids = encoding['input_ids']
+        attention_mask = encoding['attention_mask']
+        labels = label_encoding['input_ids']
+        decoder_input_ids = label_encoding['input_ids'][:, :-1]  # Shift labels left
 
         # Pad decoder_input_ids to match sequence length
         pad_token_id = self.tokenizer.pad_token_id
@@ -54,12 +82,26 @@ class TextDataset(Dataset):
             value=pad_token_id
         )
 
-        # Flatten labels for CrossEntropyLoss
-        labels = labels.view(-1)  # Shape: (sequence_length,)
+        return [
+            {
+                "input_ids": input_ids[row],
+                "attention_mask": attention_mask[row],
+                "labels": labels[row].view(-1),  # Flatten labels for CrossEntropyLoss, shape: (sequence_length,)
+                "decoder_input_ids": decoder_input_ids[row],
+            }
+            for row in range(len(items))
+        ]
 
-        return {
-            "input_ids": input_ids,
-            "attention_mask": attention_mask,
-            "labels": labels,
-            "decoder_input_ids": decoder_input_ids,
-        }
+    def encode_items_unpadded(self, items):
+        inputs = self.tokenizer([item['user_input'] for item in items], add_special_tokens=True,
+                                max_length=self.max_length, truncation=True).input_ids
+        labels = self.tokenizer([item['ai_response'] for item in items], add_special_tokens=True,
+                                max_length=self.max_length, truncation=True).input_ids
+        return [
+            {
+                "input_ids": torch.tensor(input_ids, dtype=torch.long),
+                "attention_mask": torch.ones(len(input_ids), dtype=torch.long),
+                "labels": torch.tensor(label_ids, dtype=torch.long),
+            }
+            for input_ids, label_ids in zip(inputs, labels)
+        ]
@@ -0,0 +1,77 @@
+# src/core/token_cache.py
+"""
+This class is responsible for remembering the token ids of context segments between turns.
+The persona text, every history turn and the fixed template fragments are tokenized once and reused,
+so each turn only tokenizes the new user message. The cache is cleared when the profile it was built for changes.
+"""
+from collections import OrderedDict
+
+
+class SegmentTokenCache:
+    def __init__(self, model, max_entries=1024):
+        """
+        :param model: T5Model (or LazyModel handle) whose tokenizer is used.
+        :param max_entries: Number of segments kept, least recently used segments are dropped first.
+        """
+        self.model = model
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # segment text -> list of token ids
+        self.fingerprint = None
+        self.hits = 0
+        self.misses = 0
+
+    def encode(self, text):
+        """
+        Returns the token ids of a segment, without special tokens.
+        """
+        ids = self.entries.get(text)
+        if ids is not None:
+            self.hits += 1
+            self.entries.move_to_end(text)
+            return ids
+        self.misses += 1
+        ids = self.model.tokenizer(text, add_special_tokens=False).input_ids
+        self.store(text, ids)
+        return ids
+
+    def encode_many(self, texts):
+        """
+        Returns the token ids of several segments, tokenizing all the missing ones in a single batch call.
+        """
+        missing = [text for text in dict.fromkeys(texts) if text not in self.entries]
+        if missing:
+            self.misses += len(missing)
+            for text, ids in zip(missing, self.model.tokenizer(missing, add_special_tokens=False).input_ids):
+                self.store(text, ids)
+        self.hits += len(texts) - len(missing)
+        return [self.encode_cached(text) for text in texts]
+
+    def encode_cached(self, text):
+        ids = self.entries.get(text)
+        if ids is None:  # Evicted by the batch it was stored with
+            ids = self.model.tokenizer(text, add_special_tokens=False).input_ids
+            self.store(text, ids)
+        return ids
+
+    def store(self, text, ids):
+        self.entries[text] = ids
+        self.entries.move_to_end(text)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def check_fingerprint(self, fingerprint):
+        """
+        Clears the cache if it was filled for a different profile state (name, mood, relationship, ...).
+        :return: True if the cache was invalidated.
+        """
+        if fingerprint == self.fingerprint:
+            return False
+        self.invalidate()
+        self.fingerprint = fingerprint
+        return True
+
+    def invalidate(self):
+        self.entries.clear()
+
+    def get_stats(self):
+        return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,62 @@
+# src/core/tokenizer_parity.py
+"""
+This file checks that the fast (Rust) tokenizers produce the same token ids as the slow tokenizers they replaced.
+Every user_input and ai_response in the training data files is encoded by both and the results are compared.
+Run it with: python -m src.core.tokenizer_parity [T5|GPT2] [data file names...]
+"""
+import sys
+
+from src.core.paths import t5_dir, gpt2_dir
+from src.core.training_data_store import TrainingDataStore
+from src.core.t5_model import T5Model
+from src.core.gpt2_model import GPT2Model
+
+parity_models = {
+    "T5": (T5Model, t5_dir),
+    "GPT2": (GPT2Model, gpt2_dir),
+}
+
+
+def load_training_texts(data_files=None):
+    """
+    Returns every user_input and ai_response text of the given training data files (all of them by default).
+    """
+    if data_files is None:
+        data_files = TrainingDataStore.list_files()
+    texts = []
+    for data_file in data_files:
+        for entry in TrainingDataStore(data_file).iter_entries():
+            texts.append(entry["user_input"])
+            texts.append(entry["ai_response"])
+    return texts
+
+
+def check_tokenizer_parity(model_name="T5", data_files=None, batch_size=256):
+    """
+    Encodes the training texts with the slow and the fast tokenizer of a model and reports the differences.
+    :return: List of (text, slow_ids, fast_ids) for every text that was encoded differently.
+    """
+    model_class, model_dir = parity_models[model_name]
+    slow_tokenizer = model_class.load_slow_tokenizer(model_dir)
+    fast_tokenizer = model_class.load_tokenizer(model_dir)
+    texts = load_training_texts(data_files)
+
+    mismatches = []
+    for start in range(0, len(texts), batch_size):
+        batch = texts[start:start + batch_size]
+        fast_ids = fast_tokenizer(batch).input_ids
+        for text, fast in zip(batch, fast_ids):
+            slow = slow_tokenizer(text).input_ids
+            if slow != fast:
+                mismatches.append((text, slow, fast))
+
+    print(f"{model_name} tokenizer parity: {len(texts) - len(mismatches)}/{len(texts)} texts encoded identically.")
+    for text, slow, fast in mismatches[:10]:
+        print(f"  Mismatch for {text!r}:\n    slow: {slow}\n    fast: {fast}")
+    return mismatches
+
+
+if __name__ == "__main__":
+    name = sys.argv[1] if len(sys.argv) > 1 else "T5"
+    files = sys.argv[2:] or None
+    sys.exit(1 if check_tokenizer_parity(name, files) else 0)
@@ -0,0 +1,164 @@
+# src/core/training_checkpoint.py
+"""
+This class is responsible for saving and restoring the state of an adapter training run.
+A checkpoint holds the LoRA weights, the optimizer state, the random number generator states and the position in
+the training data (epoch and batch), so an interrupted run continues from the exact step it reached. Only the
+newest 'keep_last' checkpoints are kept.
+"""
+import glob
+import os
+import random
+import time
+from collections import deque
+from itertools import islice
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+from peft import get_peft_model_state_dict, set_peft_model_state_dict
+
+CHECKPOINT_PREFIX = "checkpoint-"
+
+
+class ResumableBatchSampler(Sampler):
+    def __init__(self, batch_sampler, record_batches=False):
+        """
+        Wraps a batch sampler whose order only depends on the epoch (see set_epoch()), and starts an epoch at a
+        given batch. The skipped batches are never loaded.
+        :param record_batches: Remember the indices of every batch handed to the DataLoader, so the training loop
+                               can tell which examples a batch holds (see next_batch_indices()).
+        """
+        self.batch_sampler = batch_sampler
+        self.start_batch = 0
+        self.record_batches = record_batches
+        self.issued = deque()
+
+    def set_epoch(self, epoch, start_batch=0):
+        if hasattr(self.batch_sampler, "set_epoch"):
+            self.batch_sampler.set_epoch(epoch)
+        self.start_batch = start_batch
+
+    def __iter__(self):
+        self.issued.clear()
+        for batch in islice(iter(self.batch_sampler), self.start_batch, None):
+            if self.record_batches:
+                self.issued.append(batch)
+            yield batch
+
+    def next_batch_indices(self):
+        """
+        Returns the dataset indices of the next batch the DataLoader delivers. The DataLoader fetches batches
+        ahead but delivers them in sampler order, so the recorded batches are consumed first in, first out.
+        """
+        return self.issued.popleft()
+
+    def __len__(self):
+        return max(len(self.batch_sampler) - self.start_batch, 0)
+
+
+class CheckpointManager:
+    def __init__(self, checkpoint_dir, keep_last=3, save_every=100, save_interval=600.0):
+        """
+        :param checkpoint_dir: Folder of the checkpoints of one adapter.
+        :param keep_last: Number of checkpoints kept, older ones are deleted.
+        :param save_every: Save after this many optimizer steps, 0 disables it.
+        :param save_interval: Also save when this many seconds passed since the last checkpoint, 0 disables it.
+        """
+        self.checkpoint_dir = checkpoint_dir
+        self.keep_last = keep_last
+        self.save_every = save_every
+        self.save_interval = save_interval
+        self.last_step = 0
+        self.last_save_time = time.time()
+
+    def list_checkpoints(self):
+        """
+        Returns the checkpoint files, oldest first.
+        """
+        paths = glob.glob(os.path.join(self.checkpoint_dir, f"{CHECKPOINT_PREFIX}*.pt"))
+        return sorted(paths, key=lambda path: int(os.path.basename(path)[len(CHECKPOINT_PREFIX):-3]))
+
+    def latest(self):
+        checkpoints = self.list_checkpoints()
+        return checkpoints[-1] if checkpoints else None
+
+    def save_due(self, global_step):
+        if self.save_every and global_step - self.last_step >= self.save_every:
+            return True
+        return bool(self.save_interval) and time.time() - self.last_save_time >= self.save_interval
+
+    @staticmethod
+    def get_rng_state():
+        state = {
+            "python": random.getstate(),
+            "numpy": np.random.get_state(),
+            "torch": torch.get_rng_state(),
+        }
+        if torch.cuda.is_available():
+            state["cuda"] = torch.cuda.get_rng_state_all()
+        return state
+
+    @staticmethod
+    def set_rng_state(state):
+        random.setstate(state["python"])
+        np.random.set_state(state["numpy"])
+        torch.set_rng_state(state["torch"])
+        if "cuda" in state and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(state["cuda"])
+
+    def save(self, adapter, optimizer, epoch, batch, global_step, batches_per_epoch=None, extra=None):
+        """
+        Writes a checkpoint, to a temporary file first so a crash never leaves a half written checkpoint.
+        Must be called right after an optimizer step, gradients being accumulated are not saved.
+        :param epoch: Epoch to continue with.
+        :param batch: Number of batches of that epoch already trained.
+        :param global_step: Number of optimizer steps so far, used to name the checkpoint.
+        :param batches_per_epoch: Batches in an epoch, used to check the training data did not change on resume.
+        :param extra: Other values needed to resume the run the same way (e.g. the training plan).
+        """
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        state = {
+            "adapter": get_peft_model_state_dict(adapter),
+            "optimizer": optimizer.state_dict(),
+            "rng": self.get_rng_state(),
+            "epoch": epoch,
+            "batch": batch,
+            "global_step": global_step,
+            "batches_per_epoch": batches_per_epoch,
+            "extra": extra or {},
+        }
+        path = os.path.join(self.checkpoint_dir, f"{CHECKPOINT_PREFIX}{global_step}.pt")
+        temp_path = path + ".tmp"
+        torch.save(state, temp_path)
+        os.replace(temp_path, path)
+        self.last_step = global_step
+        self.last_save_time = time.time()
+        print(f"Saved training checkpoint {path} (epoch {epoch + 1}, batch {batch})")
+        self.rotate()
+        return path
+
+    def rotate(self):
+        for path in self.list_checkpoints()[:-self.keep_last or None]:
+            os.remove(path)
+
+    def load(self, adapter, optimizer, path=None):
+        """
+        Restores the newest (or the given) checkpoint into the adapter and optimizer.
+        :return: The checkpoint state (epoch, batch, global_step, batches_per_epoch, extra), or None if there is
+                 no checkpoint.
+        """
+        path = path or self.latest()
+        if path is None:
+            return None
+        state = torch.load(path, map_location="cpu", weights_only=False)
+        set_peft_model_state_dict(adapter, state["adapter"])
+        optimizer.load_state_dict(state["optimizer"])
+        self.set_rng_state(state["rng"])
+        self.last_step = state["global_step"]
+        self.last_save_time = time.time()
+        print(f"Resuming from {path} (epoch {state['epoch'] + 1}, batch {state['batch']})")
+        return state
+
+    def clear(self):
+        for path in self.list_checkpoints():
+            os.remove(path)
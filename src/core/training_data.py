@@ -2,10 +2,10 @@
 """
 This class is responsible for creating and loading the training data to train the models and adapters
 """
-import json
 import os
 from datetime import datetime
 from src.core.paths import training_data_dir
+from src.core.training_data_store import TrainingDataStore
 
 class TrainingData:
     def __init__(self, data_file_name="training_data.json"):
@@ -14,44 +14,27 @@ class TrainingData:
         :param data_file_name: Name of the file the training data will be stored.
         """
         self.data_dir = training_data_dir
-        self.training_file = os.path.join(training_data_dir, data_file_name)
-        self.history = self.load_existing_data()
+        self.store = TrainingDataStore(data_file_name)
+        self.training_file = self.store.store_file
+        self.history = []  # Entries not yet written to the store
 
         # Ensure the data directory exists
         if not os.path.exists(self.data_dir):
             os.makedirs(self.data_dir)
+        self.store.migrate()
 
     def load_existing_data(self):
         """
         Load existing training data from the file, if it exists.
+        Prefer iterating self.store.iter_entries() for large files.
         """
-        if os.path.exists(self.training_file):
-            try:
-                with open(self.training_file, "r") as f:
-                    return json.load(f)
-            except json.JSONDecodeError:
-                print("Warning: The training data file is not a valid JSON file, returning empty data.")
-                return []
-        return []
+        return list(self.store.iter_entries())
 
     def save_data(self):
         """
-        Save the collected data to the training data file.
+        Append the collected entries to the training data file.
         """
-        # Load existing data, if any
-        if os.path.exists(self.training_file):
-            try:
-                with open(self.training_file, "r") as f:
-                    existing_data = json.load(f)
-            except json.JSONDecodeError:
-                existing_data = []
-        else:
-            existing_data = []
-
-        # Append new history and clear it after saving
-        existing_data.extend(self.history)
-        with open(self.training_file, "w") as f:
-            json.dump(existing_data, f, indent=4)
+        self.store.append_many(self.history)
 
         # Clear history after saving to avoid duplicates
         self.history.clear()
@@ -0,0 +1,89 @@
+# src/core/training_data_store.py
+"""
+This class is responsible for storing training data as an append-only JSONL file.
+Adding an entry writes one line at the end of the file instead of re-reading and rewriting the whole data set,
+and the entries can be streamed back in order without loading the file into memory.
+A training file given as "<name>.json" is stored as "<name>.jsonl", an existing JSON list is migrated once.
+"""
+import json
+import os
+
+from src.core.paths import training_data_dir
+from src.core.persistence_worker import atomic_write_text
+
+
+class TrainingDataStore:
+    def __init__(self, data_file_name="training_data.json", data_dir=training_data_dir):
+        """
+        :param data_file_name: Name of the training data file, with or without the .json/.jsonl suffix.
+        :param data_dir: Folder the training data files are stored in.
+        """
+        base_name = os.path.splitext(data_file_name)[0]
+        self.data_dir = data_dir
+        self.store_file = os.path.join(data_dir, base_name + ".jsonl")
+        self.legacy_file = os.path.join(data_dir, base_name + ".json")
+
+    def exists(self):
+        return os.path.exists(self.store_file) or os.path.exists(self.legacy_file)
+
+    def migrate(self):
+        """
+        Converts a legacy JSON list file into the JSONL store, once. The legacy file is kept as <name>.json.migrated.
+        :return: Number of migrated entries.
+        """
+        if not os.path.exists(self.legacy_file) or os.path.exists(self.store_file):
+            return 0
+        try:
+            with open(self.legacy_file, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+        except json.JSONDecodeError:
+            print(f"Warning: {self.legacy_file} is not a valid JSON file, it was not migrated.")
+            return 0
+        atomic_write_text(self.store_file, "".join(json.dumps(entry, ensure_ascii=False) + "\n" for entry in entries))
+        os.replace(self.legacy_file, self.legacy_file + ".migrated")
+        print(f"Migrated {len(entries)} training entries to {self.store_file}")
+        return len(entries)
+
+    def append(self, entry):
+        """
+        Adds one entry to the end of the store.
+        """
+        self.append_many([entry])
+
+    def append_many(self, entries):
+        if not entries:
+            return
+        os.makedirs(self.data_dir, exist_ok=True)
+        self.migrate()
+        with open(self.store_file, "a", encoding="utf-8") as f:
+            f.write("".join(json.dumps(entry, ensure_ascii=False) + "\n" for entry in entries))
+
+    def iter_entries(self):
+        """
+        Yields the entries in order, one line at a time. A damaged line (e.g. cut off by a crash) is skipped.
+        """
+        self.migrate()
+        if not os.path.exists(self.store_file):
+            return
+        with open(self.store_file, "r", encoding="utf-8") as f:
+            for line_number, line in enumerate(f, start=1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    print(f"Warning: skipping damaged line {line_number} in {self.store_file}")
+
+    def count(self):
+        return sum(1 for _ in self.iter_entries())
+
+    @staticmethod
+    def list_files(data_dir=training_data_dir):
+        """
+        Returns the names of the training data sets in the folder, one per store whether migrated or not.
+        """
+        if not os.path.exists(data_dir):
+            return []
+        names = {os.path.splitext(name)[0] for name in os.listdir(data_dir) if name.endswith((".json", ".jsonl"))}
+        return sorted(name + ".jsonl" for name in names)
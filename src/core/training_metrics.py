@@ -0,0 +1,93 @@
+# src/core/training_metrics.py
+"""
+This class is responsible for collecting training loss without stopping the training loop.
+Losses and non-finite flags are summed on the training device; they are read back (one host sync) only when a
+report is due, every 'report_every' steps or every 'report_interval' seconds, and at the end of an epoch.
+"""
+import time
+
+import torch
+
+
+class TrainingMetrics:
+    def __init__(self, report_every=50, report_interval=30.0, debug=False):
+        """
+        :param report_every: Report after this many batches, 0 disables the step based report.
+        :param report_interval: Report when this many seconds passed since the last report, 0 disables it.
+        :param debug: Also scan the logits and labels of every batch for nan/inf values. This forces a
+                      host sync per batch, so it is off by default.
+        """
+        self.report_every = report_every
+        self.report_interval = report_interval
+        self.debug = debug
+        self.start_epoch(0)
+
+    def start_epoch(self, epoch):
+        self.epoch = epoch
+        self.epoch_start_time = time.time()
+        self.epoch_loss = None
+        self.epoch_batches = 0
+        self.non_finite = None
+        self.reset_window()
+
+    def reset_window(self):
+        self.window_loss = None
+        self.window_batches = 0
+        self.window_start_time = time.time()
+
+    @staticmethod
+    def accumulate(total, value):
+        return value if total is None else total + value
+
+    def update(self, loss, logits=None, labels=None):
+        """
+        Adds the (unscaled) loss of one batch, still on its device. Reports when due.
+        :param loss: Loss tensor of the batch, it is detached here.
+        :param logits: Logits of the batch, only scanned in debug mode.
+        :param labels: Labels of the batch, only scanned in debug mode.
+        """
+        loss = loss.detach()
+        self.window_loss = self.accumulate(self.window_loss, loss)
+        self.epoch_loss = self.accumulate(self.epoch_loss, loss)
+        self.non_finite = self.accumulate(self.non_finite, (~torch.isfinite(loss)).int())
+        self.window_batches += 1
+        self.epoch_batches += 1
+
+        if self.debug:
+            self.check_batch(logits, labels)
+        if self.report_due():
+            self.report()
+
+    def check_batch(self, logits, labels):
+        if logits is not None and not torch.isfinite(logits).all():
+            print(f"Epoch {self.epoch + 1}, Batch {self.epoch_batches}: model outputs (logits) contain nan or inf values!")
+        if labels is not None and labels.is_floating_point() and not torch.isfinite(labels).all():
+            print(f"Epoch {self.epoch + 1}, Batch {self.epoch_batches}: labels contain nan or inf values!")
+
+    def report_due(self):
+        if self.report_every and self.window_batches >= self.report_every:
+            return True
+        return bool(self.report_interval) and time.time() - self.window_start_time >= self.report_interval
+
+    def report(self):
+        if self.window_batches == 0:
+            return
+        elapsed = time.time() - self.window_start_time
+        average_loss = (self.window_loss / self.window_batches).item()
+        print(f"Epoch {self.epoch + 1}, Batch {self.epoch_batches}, Loss: {average_loss:.4f}, "
+              f"{elapsed / self.window_batches:.2f} seconds per batch")
+        self.reset_window()
+
+    def end_epoch(self):
+        """
+        Prints the epoch summary.
+        :return: Average loss of the epoch.
+        """
+        self.report()
+        average_loss = (self.epoch_loss / self.epoch_batches).item() if self.epoch_batches else 0.0
+        non_finite = int(self.non_finite.item()) if self.non_finite is not None else 0
+        epoch_time = time.time() - self.epoch_start_time
+        print(f"Epoch {self.epoch + 1}, Average Loss: {average_loss}, Time: {epoch_time:.2f} seconds")
+        if non_finite:
+            print(f"Warning: {non_finite} batches of epoch {self.epoch + 1} had a nan or inf loss.")
+        return average_loss
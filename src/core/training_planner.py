@@ -0,0 +1,308 @@
+# src/core/training_planner.py
+"""
+This class is responsible for choosing the adapter training settings that fit a memory budget.
+It runs a few trial training steps per candidate (batch size, with and without gradient checkpointing), measures
+the peak resident memory of the process and the tokens trained per second, and keeps the fastest candidate that
+stays within the budget. The worker count follows from how long loading a batch takes compared to a step.
+"""
+import contextlib
+import math
+import os
+import threading
+import time
+from itertools import islice
+
+from torch.utils.data import IterableDataset
+from torch.utils.data.dataloader import default_collate
+
+from src.core.batching import PaddingStats
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+def read_proc_status(field):
+    """
+    Returns a memory field (e.g. VmRSS, VmHWM) of /proc/self/status in bytes, or None where there is no /proc.
+    """
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def current_rss():
+    rss = read_proc_status("VmRSS")
+    if rss is None and psutil is not None:
+        rss = psutil.Process().memory_info().rss
+    return rss or 0
+
+
+def is_out_of_memory(error):
+    """
+    True for the errors torch raises when an allocation fails (CUDA out of memory, CPU allocator failures).
+    """
+    if isinstance(error, MemoryError):
+        return True
+    message = str(error).lower()
+    return "out of memory" in message or "can't allocate memory" in message
+
+
+def estimate_peak(base, peak, batch_size, next_batch_size):
+    """
+    Estimates the peak memory of the next batch size from the measured one: the memory above 'base' (the model
+    without a batch) is mostly activations, which grow about linearly with the batch size.
+    """
+    return base + max(peak - base, 0) * next_batch_size / batch_size
+
+
+def available_memory():
+    if psutil is not None:
+        return psutil.virtual_memory().available
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+class PeakMemoryMonitor:
+    """
+    Measures the peak resident memory of the process over a block of code. On Linux the kernel's high-water mark
+    (VmHWM) is reset through /proc/self/clear_refs, elsewhere the RSS is sampled by a thread.
+    """
+    def __init__(self, sample_interval=0.005):
+        self.sample_interval = sample_interval
+        self.peak = 0
+        self.use_hwm = False
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def reset_hwm(self):
+        try:
+            with open("/proc/self/clear_refs", "w") as f:
+                f.write("5")
+            return read_proc_status("VmHWM") is not None
+        except OSError:
+            return False
+
+    def sample(self):
+        while not self.stop_event.wait(self.sample_interval):
+            self.peak = max(self.peak, current_rss())
+
+    def __enter__(self):
+        self.peak = current_rss()
+        self.use_hwm = self.reset_hwm()
+        if not self.use_hwm:
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self.sample, daemon=True)
+            self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.use_hwm:
+            self.peak = max(self.peak, read_proc_status("VmHWM") or 0)
+        else:
+            self.stop_event.set()
+            self.thread.join()
+        self.peak = max(self.peak, current_rss())
+        return False
+
+
+class TrainingPlan:
+    def __init__(self, batch_size=2, gradient_accumulation_steps=4, gradient_checkpointing=True, num_workers=8,
+                 peak_memory=None, tokens_per_second=None, memory_budget=None):
+        """
+        The settings train_adapter() runs with. The defaults are the settings used before the planner existed.
+        """
+        self.batch_size = batch_size
+        self.gradient_accumulation_steps = gradient_accumulation_steps
+        self.gradient_checkpointing = gradient_checkpointing
+        self.num_workers = num_workers
+        self.peak_memory = peak_memory
+        self.tokens_per_second = tokens_per_second
+        self.memory_budget = memory_budget
+
+    def describe(self):
+        lines = [
+            "Training plan:",
+            f"  Batch size: {self.batch_size}",
+            f"  Gradient accumulation steps: {self.gradient_accumulation_steps} "
+            f"(effective batch size {self.batch_size * self.gradient_accumulation_steps})",
+            f"  Gradient checkpointing: {'on' if self.gradient_checkpointing else 'off'}",
+            f"  DataLoader workers: {self.num_workers}",
+        ]
+        if self.peak_memory is not None:
+            budget = f" of {self.memory_budget / 2 ** 30:.2f} GiB budget" if self.memory_budget else ""
+            lines.append(f"  Measured peak memory: {self.peak_memory / 2 ** 30:.2f} GiB{budget}")
+        if self.tokens_per_second is not None:
+            lines.append(f"  Measured throughput: {self.tokens_per_second:.0f} tokens/second")
+        return "\n".join(lines)
+
+
+class TrainingPlanner:
+    def __init__(self, memory_budget=None, batch_sizes=(1, 2, 4, 8, 16, 32), effective_batch_size=8, trial_steps=2,
+                 max_workers=None, worker_memory=256 * 2 ** 20):
+        """
+        :param memory_budget: Maximum resident memory of the training process in bytes. Defaults to the memory in
+                              use now plus 80% of the memory still available.
+        :param batch_sizes: Candidate batch sizes, tried in increasing order until one would exceed the budget. A
+                            candidate is only run when the peak estimated from the previous one fits, on the CPU an
+                            allocation over the limit ends in swapping or the OOM killer rather than an exception.
+        :param effective_batch_size: Examples per optimizer step, the accumulation steps are derived from it.
+        :param trial_steps: Measured training steps per candidate, after one warm-up step.
+        :param max_workers: Upper limit of DataLoader workers, defaults to a quarter of the CPUs.
+        :param worker_memory: Memory reserved per DataLoader worker.
+        """
+        if memory_budget is None:
+            available = available_memory()
+            memory_budget = current_rss() + int(available * 0.8) if available else None
+        self.memory_budget = memory_budget
+        self.batch_sizes = sorted(batch_sizes)
+        self.effective_batch_size = effective_batch_size
+        self.trial_steps = trial_steps
+        self.max_workers = max_workers if max_workers is not None else max((os.cpu_count() or 1) // 4, 1)
+        self.worker_memory = worker_memory
+
+    @staticmethod
+    def longest_first(training_data):
+        """
+        Returns the indices of a map-style dataset ordered from the longest example to the shortest.
+        """
+        if not hasattr(training_data, "lengths"):
+            return list(range(len(training_data)))
+        input_lengths, label_lengths = training_data.lengths()
+        totals = [int(i) + int(l) for i, l in zip(input_lengths, label_lengths)]
+        return sorted(range(len(totals)), key=lambda idx: totals[idx], reverse=True)
+
+    @staticmethod
+    def trial_batch(training_data, collate_fn, batch_size, order=None):
+        """
+        Builds a batch from the first examples of 'order' (the longest ones), so the measured peak is an upper bound
+        for the real batches.
+        :return: (batch, seconds it took to load)
+        """
+        start = time.time()
+        if isinstance(training_data, IterableDataset):
+            items = list(islice(iter(training_data), batch_size))
+        else:
+            items = [training_data[idx] for idx in order[:batch_size]]
+        batch = (collate_fn or default_collate)(items)
+        return batch, time.time() - start
+
+    @staticmethod
+    def set_gradient_checkpointing(model, enabled):
+        if enabled:
+            model.model.gradient_checkpointing_enable(gradient_checkpointing_kwargs={"use_reentrant": False})
+        else:
+            model.model.gradient_checkpointing_disable()
+
+    def measure(self, model, adapter, batch, forward_context=None):
+        """
+        Runs one warm-up and trial_steps training steps on the batch.
+        :return: (peak memory in bytes, seconds per step)
+        """
+        device = model.device
+        inputs = {key: batch[key].to(device) for key in ("input_ids", "attention_mask", "labels", "decoder_input_ids")}
+        adapter.train()
+        with PeakMemoryMonitor() as monitor:
+            start = time.time()
+            for step in range(self.trial_steps + 1):
+                if step == 1:  # After the warm-up step
+                    start = time.time()
+                with forward_context() if forward_context else contextlib.nullcontext():
+                    loss = adapter(**inputs).loss
+                loss.backward()
+            step_time = (time.time() - start) / max(self.trial_steps, 1)
+        adapter.zero_grad(set_to_none=True)
+        return monitor.peak, step_time
+
+    def plan(self, model, adapter, training_data, collate_fn=None, forward_context=None):
+        """
+        Probes the candidates and returns the fastest TrainingPlan within the memory budget.
+        :param model: The T5Model wrapper, its .model is the base model.
+        :param adapter: The peft model being trained.
+        :param training_data: The training dataset.
+        :param collate_fn: Collate function of the DataLoader (see Adapter.make_dataloader()).
+        :param forward_context: Callable returning the context the forward pass runs in (e.g. bf16 autocast).
+        """
+        pad_token_id = model.tokenizer.pad_token_id
+        budget = self.memory_budget
+        print(f"Planning training for a memory budget of {budget / 2 ** 30:.2f} GiB..." if budget
+              else "Planning training without a memory budget...")
+
+        order = None if isinstance(training_data, IterableDataset) else self.longest_first(training_data)
+        base = current_rss()  # The model and adapter without a batch
+        best = None
+        smallest = None
+        for checkpointing in (False, True):
+            self.set_gradient_checkpointing(model, checkpointing)
+            previous = None  # (batch size, peak) of the last measured candidate
+            for batch_size in self.batch_sizes:
+                if budget and previous is not None:
+                    estimate = estimate_peak(base, previous[1], previous[0], batch_size)
+                    if estimate > budget:
+                        print(f"  batch size {batch_size}, checkpointing {'on' if checkpointing else 'off'}: "
+                              f"skipped, estimated peak {estimate / 2 ** 30:.2f} GiB")
+                        break
+                batch, load_time = self.trial_batch(training_data, collate_fn, batch_size, order)
+                try:
+                    peak, step_time = self.measure(model, adapter, batch, forward_context)
+                except (RuntimeError, MemoryError) as e:
+                    if not is_out_of_memory(e):
+                        raise
+                    print(f"(file: training_planner.py, method: plan) Trial step ran out of memory: {e}")
+                    adapter.zero_grad(set_to_none=True)
+                    break
+                previous = (batch_size, peak)
+                stats = PaddingStats(pad_token_id)
+                stats.update(batch)
+                tokens_per_second = stats.real_tokens / step_time if step_time > 0 else 0.0
+                print(f"  batch size {batch_size}, checkpointing {'on' if checkpointing else 'off'}: "
+                      f"peak {peak / 2 ** 30:.2f} GiB, {tokens_per_second:.0f} tokens/second")
+
+                candidate = (tokens_per_second, batch_size, checkpointing, peak, step_time, load_time)
+                if smallest is None or peak < smallest[3]:
+                    smallest = candidate
+                if budget and peak > budget:
+                    break
+                if best is None or tokens_per_second > best[0]:
+                    best = candidate
+                if len(batch["input_ids"]) < batch_size:  # The data set has fewer examples than the batch
+                    break
+
+        if best is None:
+            print("Warning: no configuration fits the memory budget, using the smallest one.")
+            best = smallest
+        tokens_per_second, batch_size, checkpointing, peak, step_time, load_time = best
+        self.set_gradient_checkpointing(model, checkpointing)
+        return TrainingPlan(
+            batch_size=batch_size,
+            gradient_accumulation_steps=max(1, self.effective_batch_size // batch_size),
+            gradient_checkpointing=checkpointing,
+            num_workers=self.choose_workers(step_time, load_time, peak),
+            peak_memory=peak,
+            tokens_per_second=tokens_per_second,
+            memory_budget=budget,
+        )
+
+    def choose_workers(self, step_time, load_time, peak):
+        """
+        Enough workers to load batches as fast as they are trained, limited by the memory left in the budget.
+        Loading in the main process is used when it costs less than 5% of a step.
+        """
+        if step_time <= 0 or load_time < 0.05 * step_time:
+            return 0
+        workers = min(math.ceil(load_time / step_time), self.max_workers)
+        if self.memory_budget:
+            workers = min(workers, max(int((self.memory_budget - peak) // self.worker_memory), 0))
+        return workers
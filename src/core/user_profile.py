@@ -6,6 +6,7 @@ It stores and manages different AI personalities, relationship types, and moods.
 import os
 import json
 from src.core.paths import profiles_dir
+from src.core.persistence_worker import persistence_worker
 from src.core.ai_profile import AiProfile
 from src.core.contructs import Gender, Mood, RelationshipType
 
@@ -45,6 +46,7 @@ class UserProfile:
         Removes an AI profile from the user's profile collection.
         """
         if profile_name in self.ai_profiles:
+            self.ai_profiles[profile_name].unload_model()
             del self.ai_profiles[profile_name]
             print(f"Removed AI profile: {profile_name}")
             self.save_profile()
@@ -90,13 +92,14 @@ class UserProfile:
                     for profile in self.ai_profiles.values()
                 }
             }
-            with open(user_profile_file, 'w') as f:
-                json.dump(user_data, f, indent=4)
+            # Written atomically in the background by the persistence worker
+            persistence_worker.write_json(user_profile_file, user_data)
             print(f"User profile saved for {self.user_name}.")
         except Exception as e:
             print(f"Error saving user profile: {e}")
 
     def load_profile(self):
+        persistence_worker.flush()  # Read what earlier saves queued
         try:
             print(f"Loading profile, profile_folder: {self.profile_folder}")
 
@@ -111,7 +114,6 @@ class UserProfile:
                 self.user_name = user_data.get('user_name', self.user_name)
                 self.gender = Gender[user_data.get('gender', 'MALE')]  # Default to 'MALE' if missing
                 default_profile_name = user_data.get('default_profile')
-                self.default_profile = self.ai_profiles.get(default_profile_name) if default_profile_name else None
 
                 ai_profiles_data = user_data.get('ai_profiles', {})
                 for ai_name, ai_data in ai_profiles_data.items():
@@ -131,6 +133,7 @@ class UserProfile:
                     self.ai_profiles[ai_name] = ai_profile
 
                 print(f"Loaded AI profiles: {self.ai_profiles}")
+                self.default_profile = self.ai_profiles.get(default_profile_name) if default_profile_name else None
 
                 # Set profile folder
                 self.profile_folder = os.path.dirname(user_profile_file)
@@ -0,0 +1,52 @@
+# tests/test_ai_brain_stream.py
+"""
+Tests of how AiBrain.generate_response_stream() hides a leading name prefix from the streamed text.
+Run with: python -m pytest tests
+"""
+import re
+from types import SimpleNamespace
+
+from src.core.ai_brain import AiBrain
+
+
+class FakeModel:
+    def __init__(self, chunks, ai_name, user_name):
+        self.chunks = chunks
+        self.ai_name = ai_name
+        self.user_name = user_name
+
+    def generate_response_stream(self, prompt, context="", input_ids=None):
+        yield from self.chunks
+
+    def clean_response(self, response):
+        return re.sub(rf"^\s*({self.ai_name}|{self.user_name}):\s*", "", response).strip()
+
+
+def stream(chunks, ai_name="Alice", user_name="Hilda"):
+    profile = SimpleNamespace(
+        name=ai_name,
+        model=FakeModel(chunks, ai_name, user_name),
+        user_profile=SimpleNamespace(user_name=user_name),
+        get_user_profile_name=lambda: user_name,
+    )
+    brain = AiBrain.__new__(AiBrain)
+    brain.ai_profile = profile
+    shown = []
+    response = brain.generate_response_stream("hello", SimpleNamespace(text="", input_ids=None), shown.append)
+    return "".join(shown), response
+
+
+def test_short_reply_that_looks_like_a_user_prefix_is_shown():
+    assert stream(["Hi"]) == ("Hi", "Hi")
+
+
+def test_short_reply_that_looks_like_an_ai_prefix_is_shown():
+    assert stream(["A"]) == ("A", "A")
+
+
+def test_name_prefix_is_hidden():
+    assert stream(["Alice", ": Hello", " there"]) == ("Hello there", "Hello there")
+
+
+def test_bare_name_prefix_shows_nothing():
+    assert stream(["Alice:"]) == ("", "")
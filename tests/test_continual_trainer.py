@@ -0,0 +1,56 @@
+# tests/test_continual_trainer.py
+"""
+Tests of the file handling of the background adapter training: publishing versions and the training lock.
+Run with: python -m pytest tests
+"""
+import os
+
+from src.core.continual_trainer import (
+    KEEP_VERSIONS, LOCK_FILE_NAME, VERSIONS_DIR_NAME, TrainingLock, publish_adapter, read_pointer, version_folder_name,
+)
+
+
+def make_versions(profile_folder, versions):
+    versions_dir = os.path.join(profile_folder, VERSIONS_DIR_NAME)
+    for version in versions:
+        os.makedirs(os.path.join(versions_dir, version_folder_name(version)))
+    return versions_dir
+
+
+def test_publish_adapter_writes_pointer(tmp_path):
+    versions_dir = make_versions(tmp_path, [1])
+    path = os.path.join(versions_dir, version_folder_name(1))
+    publish_adapter(str(tmp_path), 1, path, "2026-01-01T10:00:00", 16)
+    assert read_pointer(str(tmp_path)) == {
+        "version": 1, "path": path, "trained_until": "2026-01-01T10:00:00", "examples": 16,
+    }
+
+
+def test_publish_adapter_removes_old_versions(tmp_path):
+    versions_dir = make_versions(tmp_path, [1, 2, 3, 4])
+    os.makedirs(os.path.join(versions_dir, "unrelated"))
+    publish_adapter(str(tmp_path), 4, os.path.join(versions_dir, version_folder_name(4)), None, 16)
+    kept = [version_folder_name(version) for version in range(5 - KEEP_VERSIONS, 5)]
+    assert sorted(os.listdir(versions_dir)) == sorted(kept + ["unrelated"])
+
+
+def test_training_lock_is_exclusive(tmp_path):
+    first = TrainingLock(str(tmp_path))
+    assert first.acquire()
+    assert not TrainingLock(str(tmp_path)).acquire()
+    first.release()
+    assert not os.path.exists(first.lock_file)
+    with TrainingLock(str(tmp_path)) as locked:
+        assert locked
+
+
+def test_training_lock_takes_over_stale_lock(tmp_path, monkeypatch):
+    lock_file = os.path.join(tmp_path, LOCK_FILE_NAME)
+    with open(lock_file, "w") as f:
+        f.write("12345")
+    monkeypatch.setattr("src.core.continual_trainer.process_is_running", lambda pid: False)
+    lock = TrainingLock(str(tmp_path))
+    assert lock.acquire()
+    with open(lock_file) as f:
+        assert f.read() == str(os.getpid())
+    lock.release()
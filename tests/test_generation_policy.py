@@ -0,0 +1,18 @@
+# tests/test_generation_policy.py
+"""
+Tests of the retry strategies of GenerationPolicy.
+Run with: python -m pytest tests
+"""
+from src.core.generation_policy import GenerationPolicy, GREEDY, SAMPLE, SHORT_CONTEXT
+
+
+def test_without_first_attempt_skips_greedy():
+    policy = GenerationPolicy(max_attempts=3).without_first_attempt()
+    assert policy.max_attempts == 2
+    assert [policy.strategy_for(attempt) for attempt in range(policy.max_attempts)] == [SAMPLE, SHORT_CONTEXT]
+
+
+def test_without_first_attempt_keeps_one_attempt():
+    policy = GenerationPolicy(max_attempts=1, strategies=(GREEDY,)).without_first_attempt()
+    assert policy.max_attempts == 1
+    assert policy.strategy_for(0) == GREEDY